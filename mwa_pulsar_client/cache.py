@@ -0,0 +1,122 @@
+# -*- coding: utf8 -*-
+import os
+import json
+import time
+import hashlib
+import threading
+
+# seconds a cached reply is used before it is checked with the server
+TTL = 3600
+
+
+class CatalogCache(object):
+    """
+    On disk cache of the replies of the pulsar database, shared by every
+    process that uses the same directory. Each reply is kept in its own
+    file, <directory>/<endpoint>/<hash of the server and query>.json, with
+    the time it was stored and the ETag and Last-Modified of the reply.
+
+    A reply younger than ttl seconds is used as it is. An older one is
+    revalidated: the request is sent with If-None-Match / If-Modified-Since
+    and a 304 reply renews it without transferring it again. Replies read
+    in this process are also kept in memory, so repeated lookups do not
+    touch the disk until they expire.
+
+    The data returned is shared with the cache and must not be modified.
+
+    Args:
+        directory: directory of the cache, created if needed.
+        ttl: seconds a reply is used before it is revalidated. (default 3600)
+    """
+
+    def __init__(self, directory, ttl=TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = {}
+
+    def path(self, addr, name, params):
+        query = json.dumps([addr, sorted((str(k), str(v)) for k, v in params.items())])
+        return os.path.join(self.directory, name, hashlib.sha1(query.encode('utf8')).hexdigest() + '.json')
+
+    def load(self, addr, name, params):
+        """
+        Return the cached entry of a request, a dict with its 'data',
+        'stored' time, 'etag' and 'last_modified', or None.
+        """
+        path = self.path(addr, name, params)
+        with self.lock:
+            entry = self.memory.get(path)
+        if entry is not None and self.fresh(entry):
+            return entry
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        with self.lock:
+            self.memory[path] = entry
+        return entry
+
+    def fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def store(self, addr, name, params, data, etag=None, last_modified=None):
+        """Cache the reply of a request and return its entry."""
+        entry = {'stored': time.time(), 'etag': etag, 'last_modified': last_modified, 'data': data}
+        path = self.path(addr, name, params)
+        temp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp, path)
+        except OSError:
+            # the cache is only an optimisation, a read only or full disk
+            # leaves this reply in memory
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+        with self.lock:
+            self.memory[path] = entry
+        return entry
+
+    def renew(self, addr, name, params, entry):
+        """Mark an entry that the server has revalidated as fresh again."""
+        return self.store(addr, name, params, entry['data'], entry['etag'], entry['last_modified'])
+
+    def invalidate(self, *names):
+        """
+        Drop the cached replies of the named endpoints. Other processes keep
+        the replies they already hold in memory until they expire.
+        """
+        for name in names:
+            directory = os.path.join(self.directory, name)
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                entries = []
+            for entry in entries:
+                try:
+                    os.remove(os.path.join(directory, entry))
+                except OSError:
+                    pass
+
+        with self.lock:
+            for path in list(self.memory):
+                if os.path.basename(os.path.dirname(path)) in names:
+                    del self.memory[path]
+
+    def clear(self):
+        """Drop every cached reply."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        self.invalidate(*names)
+        with self.lock:
+            self.memory.clear()
@@ -1,7 +1,893 @@
 # -*- coding: utf8 -*-
 import os
+import time
+import uuid
+import base64
+import hashlib
+import random
+import threading
 import urllib.parse
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mwa_pulsar_client.cache import CatalogCache, TTL
+
+# seconds to wait for a connection and then for each read from it
+TIMEOUT = (30, 600)
+
+# bytes of a file read and sent at a time
+CHUNK_SIZE = 1 << 20
+
+# statuses of a failed upload or download that are worth trying again for
+RETRY_STATUS = (500, 502, 503, 504)
+
+# part of a file fetched by each request of a parallel download
+SEGMENT_SIZE = 16 << 20
+
+# hashlib names of the algorithms of a Digest header (RFC 3230)
+DIGESTS = {'md5': 'md5', 'sha': 'sha1', 'sha-256': 'sha256', 'sha-512': 'sha512'}
+
+# cached replies dropped when an endpoint changes the database
+INVALIDATES = {
+    'calibrator_create': ('calibrator_list', 'calibrator_get', 'detection_find_calibrator',
+                          'calibration_file_by_observation_id'),
+    'calibrator_file_upload': ('calibrator_list', 'calibrator_get', 'detection_find_calibrator',
+                               'calibration_file_by_observation_id'),
+    'pulsar_create': ('pulsar_list', 'pulsar_get'),
+    'detection_create': ('detection_list', 'detection_get', 'detection_find_calibrator'),
+    'detection_update': ('detection_list', 'detection_get', 'detection_find_calibrator'),
+    'detection_file_upload': ('detection_list', 'detection_get'),
+}
+
+
+def detection_key(detection):
+    """
+    Return the (observationid, pulsar, subband, coherent) that identifies a
+    detection, from a detection passed to detection_create or one returned
+    by detection_list.
+    """
+    pulsar = detection['pulsar']
+    if isinstance(pulsar, dict):
+        pulsar = pulsar['name']
+    coherent = detection['coherent']
+    if isinstance(coherent, str):
+        coherent = coherent.lower() in ('true', 't', '1', 'yes')
+    return (int(detection['observationid']), str(pulsar), int(detection['subband']), bool(coherent))
+
+
+def parse_checksum(checksum):
+    """
+    Return the (hashlib algorithm, hex digest) of a checksum given as
+    'algorithm:hex', e.g. 'sha256:9f86...', or as a bare md5, sha1 or
+    sha256 hex digest.
+    """
+    algorithm, sep, digest = checksum.rpartition(':')
+    if not sep:
+        algorithm = {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(digest))
+    algorithm = DIGESTS.get(algorithm.lower(), algorithm.lower()) if algorithm else None
+    if algorithm not in hashlib.algorithms_available:
+        raise Exception('unknown checksum: {0}'.format(checksum))
+    return algorithm, digest.lower()
+
+
+def server_checksum(response):
+    """
+    Return the (hashlib algorithm, hex digest) of the whole file from the
+    Digest or Content-MD5 header of a download, or None. Content-MD5 only
+    covers the body, so it is not used for a range.
+    """
+    for item in response.headers.get('Digest', '').split(','):
+        algorithm, sep, value = item.strip().partition('=')
+        if sep and algorithm.lower() in DIGESTS:
+            return DIGESTS[algorithm.lower()], base64.b64decode(value).hex()
+    if response.headers.get('Content-MD5') and response.status_code == 200:
+        return 'md5', base64.b64decode(response.headers['Content-MD5']).hex()
+    return None
+
+
+class RangeError(requests.exceptions.ConnectionError):
+    """A server, or a proxy in front of it, answered a range request with something else."""
+
+
+class OrderedHash(object):
+    """
+    Hash of a file whose ranges are downloaded at the same time, computed in
+    file order while the bytes arrive. The bytes of a range are hashed as
+    they come in once every byte before them has been; until then they are
+    held in memory. wait() keeps the ranges started close enough to the
+    bytes hashed that what is held stays small.
+
+    Args:
+        algorithm: hashlib name of the algorithm.
+    """
+
+    def __init__(self, algorithm):
+        self.hasher = hashlib.new(algorithm)
+        self.cond = threading.Condition()
+        self.position = 0
+        self.next = {}
+        self.held = {}
+        self.failed = False
+
+    def start(self, start):
+        """Register the range that begins at start, before its first update."""
+        with self.cond:
+            self.next[start] = start
+            self.held[start] = []
+
+    def update(self, start, chunk):
+        """Add the next bytes of the range that begins at start."""
+        with self.cond:
+            if self.next[start] == self.position:
+                self.hasher.update(chunk)
+                self.position += len(chunk)
+            else:
+                self.held[start].append(chunk)
+            self.next[start] += len(chunk)
+            # the ranges that continue from the bytes hashed so far
+            while self.held.get(self.position):
+                for held in self.held.pop(self.position):
+                    self.hasher.update(held)
+                    self.position += len(held)
+            self.cond.notify_all()
+
+    def wait(self, start, limit):
+        """Wait until start is at most limit bytes past the bytes hashed, or a range failed."""
+        with self.cond:
+            while start - self.position > limit and not self.failed:
+                self.cond.wait()
+
+    def fail(self):
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class MultipartFile(object):
+    """
+    multipart/form-data body of one file that is read from disk a chunk at a
+    time while it is sent, so uploading a file of any size takes constant
+    memory. Its length is known, so it is sent with a Content-Length. It can
+    be iterated again to send the file again.
+
+    Args:
+        field: form field of the file.
+        filepath: path of the file.
+        chunk_size: bytes read and sent at a time.
+        progress: called with the bytes of the file sent so far and its size
+                  after each chunk.
+    """
+
+    def __init__(self, field, filepath, chunk_size=CHUNK_SIZE, progress=None):
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.size = os.path.getsize(filepath)
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+        self.head = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'
+                     .format(boundary, field, os.path.basename(filepath).replace('"', '%22'))).encode('utf8')
+        self.tail = '\r\n--{0}--\r\n'.format(boundary).encode('utf8')
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        sent = 0
+        with open(self.filepath, 'rb') as f:
+            while sent < self.size:
+                chunk = f.read(min(self.chunk_size, self.size - sent))
+                if not chunk:
+                    raise Exception('{0} is shorter than when the upload started'.format(self.filepath))
+                sent += len(chunk)
+                yield chunk
+                if self.progress:
+                    self.progress(sent, self.size)
+        yield self.tail
+
+
+class PulsarClient(object):
+    """
+    Client of the pulsar database that keeps its connections to the server
+    open between calls, so a call costs one round trip instead of a new
+    connection and TLS handshake. The methods take the same arguments as the
+    module functions of the same name without addr and auth. A client can be
+    shared between threads; pool_maxsize should then be at least the number
+    of threads.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        pool_maxsize: connections kept open to the server. (default 10)
+        timeout: seconds to wait to connect and for each read, either one
+                 number or a (connect, read) tuple. None waits forever, as
+                 the client did before there was a default.
+                 (default (30, 600))
+        retries: times a request is retried when the connection to the
+                 server fails. Requests that reached the server are never
+                 retried. (default 3)
+        cache: CatalogCache, or the directory of one, that keeps the replies
+               of the lookups. (default None, no cache)
+        index_ttl: seconds the indexes of pulsar_lookup, detection_lookup
+                   and calibrator_lookup are kept in memory when there is
+                   no cache. (default 0, the list is fetched for every
+                   lookup)
+    """
+
+    def __init__(self, addr, auth, pool_maxsize=10, timeout=TIMEOUT, retries=3, cache=None, index_ttl=0):
+        self.addr = addr.rstrip('/')
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.cache = CatalogCache(cache) if isinstance(cache, str) else cache
+        self.index_ttl = index_ttl
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.auth = tuple(auth) if isinstance(auth, list) else auth
+        # read=0: urllib3 would otherwise send a GET again after it reached the server
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                              max_retries=Retry(total=retries, read=0))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the connections to the server."""
+        self.session.close()
+
+    def url(self, name):
+        return '{0}/{1}/'.format(self.addr, name)
+
+    def get(self, name, params=None, **kwargs):
+        """GET an endpoint with the query params, raising for an error status."""
+        r = self.session.get(url=self.url(name),
+                             params=urllib.parse.urlencode(params or {}),
+                             timeout=self.timeout,
+                             **kwargs)
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # a streamed reply holds its pooled connection until closed
+            r.close()
+            raise
+        return r
+
+    def post(self, name, **kwargs):
+        """POST to an endpoint, raising for an error status."""
+        try:
+            r = self.session.post(url=self.url(name), timeout=self.timeout, **kwargs)
+        finally:
+            if name in INVALIDATES:
+                if self.cache:
+                    self.cache.invalidate(*INVALIDATES[name])
+                with self.lock:
+                    for key in [key for key in self.indexes if key[0] in INVALIDATES[name]]:
+                        del self.indexes[key]
+        r.raise_for_status()
+        return r
+
+    def lookup(self, name, params=None):
+        """
+        Return the JSON reply of a GET, from the cache when there is one.
+        A cached reply older than the cache ttl is revalidated with the
+        server before it is used.
+        """
+        params = params or {}
+        if not self.cache:
+            return self.get(name, params).json()
+
+        entry = self.cache.load(self.addr, name, params)
+        if entry is not None and self.cache.fresh(entry):
+            return entry['data']
+
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        r = self.get(name, params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            return self.cache.renew(self.addr, name, params, entry)['data']
+        return self.cache.store(self.addr, name, params, r.json(),
+                                r.headers.get('ETag'), r.headers.get('Last-Modified'))['data']
+
+    def index(self, name, *fields):
+        """
+        Return the entries of a list endpoint grouped by the values of fields,
+        {(str(value), ...): [entry, ...]}. With a cache the index is kept
+        until the list it was made from is replaced in the cache; without
+        one it is kept for index_ttl seconds. Either way a create or upload
+        through this client drops it.
+        """
+        with self.lock:
+            made = self.indexes.get((name, fields))
+        if made is not None and not self.cache and time.time() - made[2] < self.index_ttl:
+            return made[1]
+
+        data = self.lookup(name)
+        if made is None or made[0] is not data:
+            index = {}
+            for entry in data:
+                try:
+                    key = tuple(str(entry[field]) for field in fields)
+                except (KeyError, TypeError):
+                    continue
+                index.setdefault(key, []).append(entry)
+            made = (data, index, time.time())
+            with self.lock:
+                self.indexes[(name, fields)] = made
+        return made[1]
+
+    def pulsar_lookup(self, name):
+        """The pulsar_list entry of a pulsar, or None."""
+        found = self.index('pulsar_list', 'name').get((str(name),))
+        return found[0] if found else None
+
+    def detection_lookup(self, observationid):
+        """The detection_list entries of an observation."""
+        return self.index('detection_list', 'observationid').get((str(observationid),), [])
+
+    def calibrator_lookup(self, observationid, caltype=None):
+        """The calibrator_list entries of an observation, of one type if caltype is given."""
+        if caltype is None:
+            return self.index('calibrator_list', 'observationid').get((str(observationid),), [])
+        return self.index('calibrator_list', 'observationid', 'caltype').get((str(observationid), str(caltype)), [])
+
+    def detection_find_calibrator(self, **kwargs):
+        return self.lookup('detection_find_calibrator', kwargs)
+
+    def calibration_file_by_observation_id(self, **kwargs):
+        return self.lookup('calibration_file_by_observation_id', kwargs)
+
+    def calibrator_list(self):
+        return self.lookup('calibrator_list')
+
+    def calibrator_get(self, **kwargs):
+        return self.lookup('calibrator_get', kwargs)
+
+    def calibrator_create(self, **kwargs):
+        return self.post('calibrator_create', data=kwargs).json()
+
+    def pulsar_list(self):
+        return self.lookup('pulsar_list')
+
+    def pulsar_get(self, **kwargs):
+        return self.lookup('pulsar_get', kwargs)
+
+    def pulsar_create(self, **kwargs):
+        return self.post('pulsar_create', data=kwargs).json()
+
+    def detection_list(self):
+        return self.lookup('detection_list')
+
+    def detection_get(self, **kwargs):
+        return self.lookup('detection_get', kwargs)
+
+    def detection_update(self, **kwargs):
+        return self.post('detection_update', data=kwargs).json()
+
+    def detection_create(self, **kwargs):
+        return self.post('detection_create', data=kwargs).json()
+
+    def detection_ingest(self, detections, workers=None, existing=None, progress=None):
+        """
+        Create or update many detections, several at a time. Each detection
+        is created if it is not in the database yet and updated otherwise.
+        A failed detection does not stop the others.
+
+        Args:
+            detections: iterable of dicts of the detection_create arguments.
+            workers: detections sent at once. (default pool_maxsize)
+            existing: detections already in the database, used to choose
+                      between create and update. (default detection_list)
+            progress: called with the number of detections done so far and
+                      the number failed after each one.
+        Returns:
+            dict with 'results', a list with a dict of the 'detection',
+            the 'action' ('create' or 'update'), the server 'result' and the
+            'error' (or None) for each detection in the order given, the
+            number 'created', 'updated' and 'failed', the 'seconds' taken
+            and the detections sent 'per_second'.
+        """
+        start = time.time()
+        if existing is None:
+            existing = self.get('detection_list').json()
+        known = set()
+        for detection in existing:
+            try:
+                known.add(detection_key(detection))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        def send(entry, before):
+            # a detection given twice waits for the first to reach the server
+            if before is not None:
+                wait([before])
+            try:
+                if entry['action'] == 'create':
+                    entry['result'] = self.detection_create(**entry['detection'])
+                else:
+                    entry['result'] = self.detection_update(**entry['detection'])
+            except requests.exceptions.RequestException as e:
+                text = e.response.text if e.response is not None else ''
+                entry['error'] = '{0} {1}'.format(e, text).strip()
+            except Exception as e:
+                entry['error'] = str(e)
+            return entry
+
+        done = 0
+        failed = 0
+
+        def finished(entry):
+            nonlocal done, failed
+            done += 1
+            if entry['error']:
+                failed += 1
+            if progress:
+                progress(done, failed)
+
+        workers = workers or self.pool_maxsize
+        results = []
+        last = {}
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for detection in detections:
+                entry = {'detection': detection, 'action': 'create', 'result': None, 'error': None}
+                results.append(entry)
+                try:
+                    key = detection_key(detection)
+                except (KeyError, TypeError, ValueError) as e:
+                    entry['error'] = 'not a detection, {0} {1}'.format(type(e).__name__, e)
+                    finished(entry)
+                    continue
+                if key in known:
+                    entry['action'] = 'update'
+                known.add(key)
+
+                # keep few detections queued so a long iterable is not read ahead
+                while len(pending) >= 2 * workers:
+                    finished_futures, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished_futures:
+                        finished(future.result())
+
+                future = last[key] = pool.submit(send, entry, last.get(key))
+                pending.add(future)
+
+            while pending:
+                finished_futures, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished_futures:
+                    finished(future.result())
+
+        seconds = time.time() - start
+        return {'results': results,
+                'created': sum(1 for r in results if r['action'] == 'create' and not r['error']),
+                'updated': sum(1 for r in results if r['action'] == 'update' and not r['error']),
+                'failed': failed,
+                'seconds': seconds,
+                'per_second': len(results) / seconds if seconds > 0 else 0.0}
+
+    def detection_file_upload(self, **kwargs):
+        return self.file_upload('detection_file_upload', **kwargs)
+
+    def detection_file_download(self, filename, outputpath, **kwargs):
+        return self.file_download('detection_file_download', filename, outputpath, **kwargs)
+
+    def calibrator_file_upload(self, **kwargs):
+        return self.file_upload('calibrator_file_upload', **kwargs)
+
+    def calibrator_file_download(self, filename, outputpath, **kwargs):
+        return self.file_download('calibrator_file_download', filename, outputpath, **kwargs)
+
+    def psrcat(self, pulsar):
+        return self.lookup('psrcat', {'name': pulsar, 'format': 'json'})
+
+    def file_upload(self, name, progress=None, retries=3, chunk_size=CHUNK_SIZE, **kwargs):
+        """
+        Upload a file to detection_file_upload or calibrator_file_upload,
+        streaming it from disk. An upload that fails because the connection
+        broke or the server was unavailable is sent again, from the start as
+        the server cannot continue an upload, after a growing delay.
+
+        Args:
+            name: endpoint.
+            progress: called with the bytes sent so far and the file size.
+                      The count starts again when the upload is retried.
+            retries: times a failed upload is sent again. (default 3)
+            chunk_size: bytes read and sent at a time. (default 1 MiB)
+            kwargs: arguments of the endpoint, including filepath.
+        """
+        filepath = kwargs.get('filepath', None)
+        if not filepath:
+            raise Exception('filepath not found')
+        new_kwargs = {}
+        for k, v in kwargs.items():
+            new_kwargs[k] = str(v)
+
+        body = MultipartFile('path', filepath, chunk_size, progress)
+        new_kwargs['Content-Type'] = body.content_type
+        attempt = 0
+        while True:
+            try:
+                return self.post(name, data=body, headers=new_kwargs).json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.HTTPError) as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt >= retries or (status is not None and status not in RETRY_STATUS):
+                    raise
+            attempt += 1
+            time.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1))
+
+    def file_upload_batch(self, uploads, workers=None, retries=3, progress=None):
+        """
+        Upload many files, several at a time. A failed upload does not stop
+        the others.
+
+        Args:
+            uploads: iterable of (endpoint, arguments) where endpoint is
+                     'detection_file_upload' or 'calibrator_file_upload' and
+                     arguments is a dict of its arguments, with filepath.
+            workers: files sent at once. (default pool_maxsize)
+            retries: times a failed upload is sent again. (default 3)
+            progress: called with the filepath, the bytes of it sent so far
+                      and its size.
+        Returns:
+            dict with 'results', a list with a dict of the 'endpoint', the
+            'upload' arguments, the server 'result', the 'error' (or None)
+            and the 'bytes' uploaded for each upload in the order given, the
+            number 'uploaded' and 'failed', the total 'bytes', the 'seconds'
+            taken and the 'bytes_per_second'.
+        """
+        start = time.time()
+
+        def send(entry):
+            filepath = entry['upload'].get('filepath')
+            callback = (lambda sent, size: progress(filepath, sent, size)) if progress else None
+            try:
+                if entry['endpoint'] not in ('detection_file_upload', 'calibrator_file_upload'):
+                    raise Exception('not a file upload endpoint: {0}'.format(entry['endpoint']))
+                entry['result'] = self.file_upload(entry['endpoint'], callback, retries, **entry['upload'])
+                entry['bytes'] = os.path.getsize(filepath)
+            except requests.exceptions.RequestException as e:
+                text = e.response.text if e.response is not None else ''
+                entry['error'] = '{0} {1}'.format(e, text).strip()
+            except Exception as e:
+                entry['error'] = str(e)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=workers or self.pool_maxsize) as pool:
+            for endpoint, upload in uploads:
+                entry = {'endpoint': endpoint, 'upload': upload, 'result': None, 'error': None, 'bytes': 0}
+                results.append(entry)
+                pool.submit(send, entry)
+
+        seconds = time.time() - start
+        size = sum(r['bytes'] for r in results)
+        return {'results': results,
+                'uploaded': sum(1 for r in results if not r['error']),
+                'failed': sum(1 for r in results if r['error']),
+                'bytes': size,
+                'seconds': seconds,
+                'bytes_per_second': size / seconds if seconds > 0 else 0.0}
+
+    def file_download(self, name, filename, outputpath, chunk_size=CHUNK_SIZE, parallel=1, checksum=None,
+                      retries=3, progress=None):
+        """
+        Download a file from detection_file_download or
+        calibrator_file_download. The file is written to <filename>.part and
+        renamed when it is complete and its checksum matches, so a file
+        under its own name is always whole. A download that fails part way
+        continues from the end of the .part file, also in a later call, if
+        the server accepts ranges. A parallel download writes its ranges
+        into the .part file in place, so one that fails leaves nothing to
+        continue from and is started again; if a range was not honoured
+        the next attempt fetches the file in one stream.
+
+        Args:
+            name: endpoint.
+            filename: name of the file recorded in the database.
+            outputpath: local path where to place file.
+            chunk_size: bytes read and written at a time. (default 1 MiB)
+            parallel: ranges of a large file fetched at once. (default 1)
+            checksum: 'algorithm:hex' (or a bare md5/sha1/sha256 hex) the
+                      file must match. (default the Digest or Content-MD5
+                      header of the server, if it sends one)
+            retries: times a download that fails is continued. (default 3)
+            progress: called with the bytes of the file written so far and
+                      its size (or None if the server does not say).
+        Returns:
+            full path of the downloaded file.
+        Raises:
+            Exception if there is a file error, the file is not found or
+            the checksum does not match.
+        """
+        try:
+            os.makedirs(outputpath)
+        except OSError:
+            pass
+
+        full_output_path = '{0}/{1}'.format(outputpath, filename)
+        part = full_output_path + '.part'
+        expected = parse_checksum(checksum) if checksum else None
+
+        attempt = 0
+        while True:
+            try:
+                expected, digest = self.fetch(name, filename, part, chunk_size, parallel, expected, progress)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                if isinstance(e, RangeError):
+                    parallel = 1
+                status = e.response.status_code if e.response is not None else None
+                restart = status == 416 and os.path.exists(part)
+                if restart:
+                    # the .part file is not a beginning of the file, start again
+                    os.remove(part)
+                if attempt >= retries or (status is not None and status not in RETRY_STATUS and not restart):
+                    raise
+            attempt += 1
+            if not restart:
+                time.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1))
+
+        if expected and digest != expected[1]:
+            os.remove(part)
+            raise Exception('{0} does not match its {1} checksum, {2} instead of {3}'.format(
+                filename, expected[0], digest, expected[1]))
+
+        os.replace(part, full_output_path)
+        return full_output_path
+
+    def fetch(self, name, filename, part, chunk_size, parallel, expected, progress):
+        """
+        Download a file into part, continuing it if part already has some of
+        it. Returns the (algorithm, hex digest) the file should match, or
+        None, and the digest of part computed with that algorithm.
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+        with self.get(name, {'filename': filename}, stream=True, headers=headers) as r:
+            if r.status_code == 206:
+                size = int(r.headers['Content-Range'].rpartition('/')[2])
+            else:
+                # the whole file, the range was ignored or not asked for
+                offset = 0
+                size = r.headers.get('Content-Length')
+                size = int(size) if size is not None else None
+            if r.headers.get('Content-Encoding', 'identity') != 'identity':
+                size = None
+
+            expected = expected or server_checksum(r)
+
+            segments = 0
+            if size and not offset and r.headers.get('Accept-Ranges') == 'bytes':
+                segments = min(parallel, size // SEGMENT_SIZE)
+            if segments > 1:
+                hasher = OrderedHash(expected[0]) if expected else None
+                self.fetch_segments(r, name, filename, part, size, segments, chunk_size, progress, hasher)
+                return expected, hasher.hexdigest() if hasher else None
+
+            hasher = hashlib.new(expected[0]) if expected else None
+            with open(part, 'r+b' if offset else 'wb') as f:
+                if offset and hasher:
+                    for chunk in iter(lambda: f.read(min(chunk_size, offset - f.tell())), b''):
+                        hasher.update(chunk)
+                f.seek(offset)
+                f.truncate()
+                written = offset
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    written += len(chunk)
+                    if progress:
+                        progress(written, size)
+
+        if size is not None and written != size:
+            raise requests.exceptions.ConnectionError(
+                '{0} ended after {1} of {2} bytes'.format(filename, written, size))
+        return expected, hasher.hexdigest() if hasher else None
+
+    def fetch_segments(self, response, name, filename, part, size, segments, chunk_size, progress, hasher=None):
+        """
+        Download a file as ranges of SEGMENT_SIZE bytes, segments of them
+        fetched at once, each written in place into part. The first range
+        is read from response, which has the whole file. With an
+        OrderedHash the ranges are hashed while they arrive, and a range is
+        only started once it is within segments ranges of the bytes hashed,
+        so the file is never read back. part is removed if any range fails,
+        as it has holes.
+        """
+        lock = threading.Lock()
+        written = [0]
+        failed = threading.Event()
+        bounds = [(start, min(size, start + SEGMENT_SIZE)) for start in range(0, size, SEGMENT_SIZE)]
+        todo = iter(bounds[1:])
+
+        def segment(start, end, r=None):
+            if hasher:
+                hasher.wait(start, segments * SEGMENT_SIZE)
+                hasher.start(start)
+            if failed.is_set():
+                return
+            if r is None:
+                r = self.get(name, {'filename': filename}, stream=True,
+                             headers={'Range': 'bytes={0}-{1}'.format(start, end - 1)})
+                if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(
+                        'bytes {0}-'.format(start)):
+                    r.close()
+                    raise RangeError('{0}: the server did not return the range {1}-{2}'.format(
+                        filename, start, end - 1))
+            with r:
+                position = start
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    chunk = chunk[:end - position]
+                    os.pwrite(fd, chunk, position)
+                    if hasher:
+                        hasher.update(start, chunk)
+                    position += len(chunk)
+                    with lock:
+                        written[0] += len(chunk)
+                        if progress:
+                            progress(written[0], size)
+                    if position >= end or failed.is_set():
+                        break
+            if position < end and not failed.is_set():
+                raise requests.exceptions.ConnectionError(
+                    '{0} range {1}-{2} ended at {3}'.format(filename, start, end - 1, position))
+
+        def ranges(r=None):
+            # fetch the first range from r, then the next ranges nobody has taken
+            try:
+                if r is not None:
+                    segment(bounds[0][0], bounds[0][1], r)
+                while not failed.is_set():
+                    with lock:
+                        bound = next(todo, None)
+                    if bound is None:
+                        return
+                    segment(bound[0], bound[1])
+            except BaseException:
+                failed.set()
+                if hasher:
+                    hasher.fail()
+                raise
+
+        try:
+            with open(part, 'wb') as f:
+                f.truncate(size)
+                fd = f.fileno()
+                with ThreadPoolExecutor(max_workers=segments - 1) as pool:
+                    futures = [pool.submit(ranges) for i in range(segments - 1)]
+                    try:
+                        ranges(response)
+                    finally:
+                        for future in futures:
+                            future.result()
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+
+    def file_download_batch(self, downloads, workers=None, progress=None, **kwargs):
+        """
+        Download many files, several at a time. A failed download does not
+        stop the others.
+
+        Args:
+            downloads: iterable of (endpoint, filename, outputpath) or
+                       (endpoint, filename, outputpath, checksum) where
+                       endpoint is 'detection_file_download' or
+                       'calibrator_file_download'.
+            workers: files fetched at once. (default pool_maxsize)
+            progress: called with the filename, the bytes of it written so
+                      far and its size.
+            kwargs: chunk_size, parallel and retries of file_download.
+        Returns:
+            dict with 'results', a list with a dict of the 'endpoint', the
+            'filename', the 'path' of the file, the 'error' (or None) and
+            the 'bytes' downloaded for each download in the order given,
+            the number 'downloaded' and 'failed', the total 'bytes', the
+            'seconds' taken and the 'bytes_per_second'.
+        """
+        start = time.time()
+
+        def fetch(entry, outputpath, checksum):
+            filename = entry['filename']
+            callback = (lambda done, size: progress(filename, done, size)) if progress else None
+            try:
+                if entry['endpoint'] not in ('detection_file_download', 'calibrator_file_download'):
+                    raise Exception('not a file download endpoint: {0}'.format(entry['endpoint']))
+                entry['path'] = self.file_download(entry['endpoint'], filename, outputpath,
+                                                   checksum=checksum, progress=callback, **kwargs)
+                entry['bytes'] = os.path.getsize(entry['path'])
+            except requests.exceptions.RequestException as e:
+                text = e.response.text if e.response is not None else ''
+                entry['error'] = '{0} {1}'.format(e, text[:200]).strip()
+            except Exception as e:
+                entry['error'] = str(e)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=workers or self.pool_maxsize) as pool:
+            for download in downloads:
+                endpoint, filename, outputpath = download[:3]
+                checksum = download[3] if len(download) > 3 else None
+                entry = {'endpoint': endpoint, 'filename': filename, 'path': None, 'error': None, 'bytes': 0}
+                results.append(entry)
+                pool.submit(fetch, entry, outputpath, checksum)
+
+        seconds = time.time() - start
+        size = sum(r['bytes'] for r in results)
+        return {'results': results,
+                'downloaded': sum(1 for r in results if not r['error']),
+                'failed': sum(1 for r in results if r['error']),
+                'bytes': size,
+                'seconds': seconds,
+                'bytes_per_second': size / seconds if seconds > 0 else 0.0}
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+# cache of the module functions, turned on by set_cache or MWA_PULSAR_CACHE
+_cache = None
+if os.environ.get('MWA_PULSAR_CACHE'):
+    _cache = CatalogCache(os.environ['MWA_PULSAR_CACHE'], float(os.environ.get('MWA_PULSAR_CACHE_TTL', TTL)))
+
+
+def set_cache(directory, ttl=TTL):
+    """
+    Keep the replies of the lookups of the module functions in an on disk
+    cache that processes using the same directory share. The environment
+    variables MWA_PULSAR_CACHE and MWA_PULSAR_CACHE_TTL do the same for
+    processes that do not call this.
+
+    Args:
+        directory: directory of the cache, or None to stop caching.
+        ttl: seconds a reply is used before it is revalidated with the
+             server. (default 3600)
+    """
+    global _cache
+    with _clients_lock:
+        _cache = CatalogCache(directory, ttl) if directory else None
+        for client in _clients.values():
+            client.cache = _cache
+
+
+def get_client(addr, auth):
+    """
+    Return the PulsarClient shared by the module functions for addr and auth,
+    creating it on first use. A forked process does not reuse the
+    connections of its parent; it gets clients of its own.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+    """
+    global _clients_pid
+    key = (addr, tuple(auth) if isinstance(auth, list) else auth)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = PulsarClient(addr, auth, cache=_cache)
+        return client
 
 
 def detection_find_calibrator(addr, auth, **kwargs):
@@ -13,12 +899,8 @@ def detection_find_calibrator(addr, auth, **kwargs):
         auth: tuple of username and password. 
         detection_obsid: observation id of a detection
     """
-    path = '{0}/{1}/'.format(addr, 'detection_find_calibrator')
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(kwargs))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_find_calibrator(**kwargs)
+
 
 def calibration_file_by_observation_id(addr, auth, **kwargs):
     """
@@ -29,12 +911,8 @@ def calibration_file_by_observation_id(addr, auth, **kwargs):
         auth: tuple of username and password.
         obsid: observation id to search.
     """
-    path = '{0}/{1}/'.format(addr, 'calibration_file_by_observation_id')
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(kwargs))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).calibration_file_by_observation_id(**kwargs)
+
 
 def calibrator_list(addr, auth):
     """
@@ -44,10 +922,8 @@ def calibrator_list(addr, auth):
         addr: hostname or ip address of database server.
         auth: tuple of username and password. 
     """
-    path = '{0}/{1}/'.format(addr, 'calibrator_list')
-    r = requests.get(url=path, auth=auth)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).calibrator_list()
+
 
 def calibrator_get(addr, auth, **kwargs):
     """
@@ -59,12 +935,8 @@ def calibrator_get(addr, auth, **kwargs):
         observationid: observation id of the calibrator.
         caltype: id of calibrator type (check database for type id)
     """
-    path = '{0}/{1}/'.format(addr, 'calibrator_get')
-    r = requests.get(url=path,
-                     auth=auth,
-                     params=urllib.parse.urlencode(kwargs))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).calibrator_get(**kwargs)
+
 
 def calibrator_create(addr, auth, **kwargs):
     """
@@ -77,10 +949,8 @@ def calibrator_create(addr, auth, **kwargs):
         caltype: id of calibrator type
         notes: any notes regarding calibrator
     """
-    path = '{0}/{1}/'.format(addr, 'calibrator_create')
-    r = requests.post(url=path, auth=auth, data=kwargs)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).calibrator_create(**kwargs)
+
 
 def pulsar_list(addr, auth):
     """
@@ -90,10 +960,8 @@ def pulsar_list(addr, auth):
         addr: hostname or ip address of database server.
         auth: tuple of username and password. 
     """
-    path = '{0}/{1}/'.format(addr, 'pulsar_list')
-    r = requests.get(url=path, auth=auth)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).pulsar_list()
+
 
 def pulsar_get(addr, auth, **kwargs):
     """
@@ -104,12 +972,8 @@ def pulsar_get(addr, auth, **kwargs):
         auth: tuple of username and password.
         name: name of pulsar.
     """
-    path = '{0}/{1}/'.format(addr, 'pulsar_get')
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(kwargs))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).pulsar_get(**kwargs)
+
 
 def pulsar_create(addr, auth, **kwargs):
     """
@@ -124,10 +988,8 @@ def pulsar_create(addr, auth, **kwargs):
     Raises:
         Exception if pulsar already exists or there is an input error. 
     """
-    path = '{0}/{1}/'.format(addr, 'pulsar_create')
-    r = requests.post(url=path, auth=auth, data=kwargs)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).pulsar_create(**kwargs)
+
 
 def detection_list(addr, auth):
     """
@@ -137,10 +999,8 @@ def detection_list(addr, auth):
         addr: hostname or ip address of database server.
         auth: tuple of username and password. 
     """
-    path = '{0}/{1}/'.format(addr, 'detection_list')
-    r = requests.get(url=path, auth=auth)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_list()
+
 
 def detection_get(addr, auth, **kwargs):
     """
@@ -151,12 +1011,8 @@ def detection_get(addr, auth, **kwargs):
         auth: tuple of username and password.
         observationid: observation id.
     """
-    path = '{0}/{1}/'.format(addr, 'detection_get')
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(kwargs))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_get(**kwargs)
+
 
 def detection_update(addr, auth, **kwargs):
     """
@@ -187,10 +1043,8 @@ def detection_update(addr, auth, **kwargs):
     Raises:
         Exception if detection already exists or there is an input error.
     """
-    path = '{0}/{1}/'.format(addr, 'detection_update')
-    r = requests.post(url=path, auth=auth, data=kwargs)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_update(**kwargs)
+
 
 def detection_create(addr, auth, **kwargs):
     """
@@ -221,10 +1075,34 @@ def detection_create(addr, auth, **kwargs):
     Raises:
         Exception if detection already exists or there is an input error.
     """
-    path = '{0}/{1}/'.format(addr, 'detection_create')
-    r = requests.post(url=path, auth=auth, data=kwargs)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_create(**kwargs)
+
+
+def detection_ingest(addr, auth, detections, workers=8, existing=None, progress=None):
+    """
+    Create or update many detections, several at a time. Each detection is
+    created if it is not in the database yet and updated otherwise. A failed
+    detection does not stop the others.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        detections: iterable of dicts of the detection_create arguments.
+        workers: detections sent at once. (default 8)
+        existing: detections already in the database, used to choose between
+                  create and update. (default detection_list)
+        progress: called with the number of detections done so far and the
+                  number failed after each one.
+    Returns:
+        dict with 'results', a list with a dict of the 'detection', the
+        'action' ('create' or 'update'), the server 'result' and the 'error'
+        (or None) for each detection in the order given, the number
+        'created', 'updated' and 'failed', the 'seconds' taken and the
+        detections sent 'per_second'.
+    """
+    with PulsarClient(addr, auth, pool_maxsize=workers, cache=_cache) as client:
+        return client.detection_ingest(detections, workers, existing, progress)
+
 
 def detection_file_upload(addr, auth, **kwargs):
     """
@@ -239,20 +1117,14 @@ def detection_file_upload(addr, auth, **kwargs):
         coherent: coherent observation.
         filetype: (1: Archive, 2: Timeseries, 3: Diagnostics, 4: Calibration Solution, 5: Bestprof)
         filepath: full local path of the file to upload. 
+        progress: called with the bytes sent so far and the file size.
+        retries: times the upload is sent again if the connection breaks or
+                 the server is unavailable. (default 3)
     """
-    path = '{0}/{1}/'.format(addr, 'detection_file_upload')
-    filepath = kwargs.get('filepath', None)
-    if not filepath:
-        raise Exception('filepath not found')
-    files = {'path': open(filepath, 'rb')}
-    new_kwargs = {}
-    for k, v in kwargs.items():
-        new_kwargs[k] = str(v)
-    r = requests.post(url=path, auth=auth, files=files, headers=new_kwargs)
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).detection_file_upload(**kwargs)
 
-def detection_file_download(addr, auth, filename, outputpath):
+
+def detection_file_download(addr, auth, filename, outputpath, **kwargs):
     """
     Download a specific detection file. 
     
@@ -261,31 +1133,20 @@ def detection_file_download(addr, auth, filename, outputpath):
         auth: tuple of username and password.
         filename: name of the file recorded in the database. 
         out_path: local path where to place file.
+        chunk_size: bytes read and written at a time. (default 1 MiB)
+        parallel: ranges of a large file fetched at once. (default 1)
+        checksum: 'algorithm:hex' (or a bare md5/sha1/sha256 hex) the file
+                  must match. (default the Digest or Content-MD5 header of
+                  the server, if it sends one)
+        retries: times a download that fails is continued. (default 3)
+        progress: called with the bytes written so far and the file size.
     Returns:
         full path of the downloaded file.
     Raises:
-        Exception if there is a file error or file not found. 
+        Exception if there is a file error, the file is not found or the
+        checksum does not match.
     """
-    path = '{0}/{1}/'.format(addr, 'detection_file_download')
-    params = {'filename': filename}
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(params),
-                    stream=True)
-    r.raise_for_status()
-
-    try:
-        os.makedirs(outputpath)
-    except OSError:
-        pass
-
-    full_output_path = '{0}/{1}'.format(outputpath, filename)
-    with open(full_output_path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-
-    return full_output_path
+    return get_client(addr, auth).detection_file_download(filename, outputpath, **kwargs)
 
 
 def calibrator_file_upload(addr, auth, **kwargs):
@@ -298,21 +1159,40 @@ def calibrator_file_upload(addr, auth, **kwargs):
         observationid: observation id.
         caltype: (check database for id)
         filepath: full local path of the file to upload. 
+        progress: called with the bytes sent so far and the file size.
+        retries: times the upload is sent again if the connection breaks or
+                 the server is unavailable. (default 3)
+    """
+    return get_client(addr, auth).calibrator_file_upload(**kwargs)
+
+
+def file_upload_batch(addr, auth, uploads, workers=4, retries=3, progress=None):
+    """
+    Upload many detection and calibrator files, several at a time. A failed
+    upload does not stop the others.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        uploads: iterable of (endpoint, arguments) where endpoint is
+                 'detection_file_upload' or 'calibrator_file_upload' and
+                 arguments is a dict of its arguments, with filepath.
+        workers: files sent at once. (default 4)
+        retries: times a failed upload is sent again. (default 3)
+        progress: called with the filepath, the bytes of it sent so far and
+                  its size.
+    Returns:
+        dict with 'results', a list with a dict of the 'endpoint', the
+        'upload' arguments, the server 'result', the 'error' (or None) and
+        the 'bytes' uploaded for each upload in the order given, the number
+        'uploaded' and 'failed', the total 'bytes', the 'seconds' taken and
+        the 'bytes_per_second'.
     """
-    path = '{0}/{1}/'.format(addr, 'calibrator_file_upload')
-    filepath = kwargs.get('filepath', None)
-    if not filepath:
-        raise Exception('filepath not found')
-    files = {'path': open(filepath, 'rb')}
-    new_kwargs = {}
-    for k, v in kwargs.items():
-        new_kwargs[k] = str(v)
-    r = requests.post(url=path, auth=auth, files=files, headers=new_kwargs)
-    r.raise_for_status()
-    return r.json()
+    with PulsarClient(addr, auth, pool_maxsize=workers, cache=_cache) as client:
+        return client.file_upload_batch(uploads, workers, retries, progress)
 
 
-def calibrator_file_download(addr, auth, filename, outputpath):
+def calibrator_file_download(addr, auth, filename, outputpath, **kwargs):
     """
     Download a specific calibration file. 
     
@@ -321,31 +1201,48 @@ def calibrator_file_download(addr, auth, filename, outputpath):
         auth: tuple of username and password.
         filename: name of the file recorded in the database. 
         out_path: local path where to place file.
+        chunk_size: bytes read and written at a time. (default 1 MiB)
+        parallel: ranges of a large file fetched at once. (default 1)
+        checksum: 'algorithm:hex' (or a bare md5/sha1/sha256 hex) the file
+                  must match. (default the Digest or Content-MD5 header of
+                  the server, if it sends one)
+        retries: times a download that fails is continued. (default 3)
+        progress: called with the bytes written so far and the file size.
     Returns:
         full path of the downloaded file.
     Raises:
-        Exception if there is a file error or file not found. 
+        Exception if there is a file error, the file is not found or the
+        checksum does not match.
     """
-    path = '{0}/{1}/'.format(addr, 'calibrator_file_download')
-    params = {'filename': filename}
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(params),
-                    stream=True)
-    r.raise_for_status()
+    return get_client(addr, auth).calibrator_file_download(filename, outputpath, **kwargs)
 
-    try:
-        os.makedirs(outputpath)
-    except OSError:
-        pass
 
-    full_output_path = '{0}/{1}'.format(outputpath, filename)
-    with open(full_output_path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+def file_download_batch(addr, auth, downloads, workers=4, progress=None, **kwargs):
+    """
+    Download many detection and calibrator files, several at a time. A
+    failed download does not stop the others.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        downloads: iterable of (endpoint, filename, outputpath) or
+                   (endpoint, filename, outputpath, checksum) where endpoint
+                   is 'detection_file_download' or 'calibrator_file_download'.
+        workers: files fetched at once. (default 4)
+        progress: called with the filename, the bytes of it written so far
+                  and its size.
+        kwargs: chunk_size, parallel and retries of the downloads.
+    Returns:
+        dict with 'results', a list with a dict of the 'endpoint', the
+        'filename', the 'path' of the file, the 'error' (or None) and the
+        'bytes' downloaded for each download in the order given, the number
+        'downloaded' and 'failed', the total 'bytes', the 'seconds' taken and
+        the 'bytes_per_second'.
+    """
+    pool_maxsize = workers * max(1, kwargs.get('parallel', 1))
+    with PulsarClient(addr, auth, pool_maxsize=pool_maxsize, cache=_cache) as client:
+        return client.file_download_batch(downloads, workers, progress, **kwargs)
 
-    return full_output_path
 
 def psrcat(addr, auth, pulsar):
     """
@@ -358,10 +1255,51 @@ def psrcat(addr, auth, pulsar):
     Exception:
         pulsar not found or bad input.
     """
-    path = '{0}/{1}/'.format(addr, 'psrcat')
-    payload = {'name': pulsar, 'format': 'json'}
-    r = requests.get(url=path,
-                    auth=auth,
-                    params=urllib.parse.urlencode(payload))
-    r.raise_for_status()
-    return r.json()
+    return get_client(addr, auth).psrcat(pulsar)
+
+
+def pulsar_lookup(addr, auth, name):
+    """
+    Return a pulsar from the pulsar list, indexed by name. Meant to be used
+    with set_cache, when repeated lookups do not go to the server.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        name: name of pulsar.
+    Returns:
+        the pulsar_list entry of the pulsar, or None.
+    """
+    return get_client(addr, auth).pulsar_lookup(name)
+
+
+def detection_lookup(addr, auth, observationid):
+    """
+    Return the detections of an observation from the detection list, indexed
+    by observation id. Meant to be used with set_cache.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        observationid: observation id.
+    Returns:
+        list of detection_list entries.
+    """
+    return get_client(addr, auth).detection_lookup(observationid)
+
+
+def calibrator_lookup(addr, auth, observationid, caltype=None):
+    """
+    Return the calibrators of an observation from the calibrator list,
+    indexed by observation id and calibrator type. Meant to be used with
+    set_cache.
+
+    Args:
+        addr: hostname or ip address of database server.
+        auth: tuple of username and password.
+        observationid: observation id of the calibrator.
+        caltype: id of calibrator type, or None for every type.
+    Returns:
+        list of calibrator_list entries.
+    """
+    return get_client(addr, auth).calibrator_lookup(observationid, caltype)
@@ -0,0 +1,174 @@
+# -*- coding: utf8 -*-
+"""
+Benchmark of the NumPy ICS against the recombine binary.
+
+Writes one second of synthetic raw lane files and a metafits to a scratch
+directory, produces the ICS with the binary (-c, ICS only) and with
+mwa_recombine.ics, and prints the time taken by each and whether the bytes
+are identical. With --channels the binary also writes the course channel
+files and the ICS is rebuilt from them as well.
+
+python -m mwa_recombine.bench_ics --recombine=<path to recombine> [--lanes=8]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+
+from optparse import OptionParser
+
+import numpy as np
+from astropy.io import fits
+
+from mwa_recombine import ics
+from mwa_recombine.driver import recombine_second
+from mwa_recombine.metadata import (course_channel_swap, channel_filename, ics_filename, read_metafits,
+                                    VOLT_FILESIZE, BLOCKS_PER_SEC, LANES, PFBS,
+                                    TILES_PER_PFB)
+
+OBSID = 1000000000
+SECOND = 1000000008
+
+
+def lane_slots(count):
+    """The first count (pfb, lane) slots, spread over the PFBs."""
+    slots = [(pfb, lane) for lane in range(LANES) for pfb in range(PFBS)]
+    return slots[:count]
+
+
+def write_raw(path, pfb, lane, rng):
+    """Write a raw lane file of random samples whose first header names pfb and lane."""
+    with open(path, 'wb') as f:
+        for block in range(BLOCKS_PER_SEC):
+            data = rng.integers(0, 256, VOLT_FILESIZE, dtype=np.uint8)
+            if block == 0:
+                data[2] = (lane << 4) | 0x0f
+                data[4] = 0x11
+                data[5] = (pfb << 6) | 0x3f
+            data.tofile(f)
+
+
+def write_metafits(path, channels, flags):
+    """Write the CHANNELS keyword and Flag column that read_metafits() needs."""
+    primary = fits.PrimaryHDU()
+    primary.header['CHANNELS'] = ','.join(str(c) for c in channels)
+    column = fits.Column(name='Flag', format='B', array=np.array(flags, dtype=np.uint8).ravel())
+    fits.HDUList([primary, fits.BinTableHDU.from_columns([column])]).writeto(path, overwrite=True)
+
+
+def make_second(dir, lanes, flagged, seed):
+    """
+    Write the inputs of one second.
+
+    Returns:
+        (metafits path, list of raw lane file paths)
+    """
+    rng = np.random.default_rng(seed)
+
+    # a mix of low and high channels so the course channel swap is exercised
+    channels = list(range(57, 69)) + list(range(133, 145))
+    channels = channels[5:] + channels[:5]
+
+    flags = np.zeros(PFBS * TILES_PER_PFB, dtype=np.uint8)
+    flags[rng.choice(flags.size, size=flagged, replace=False)] = 1
+    flags = flags.reshape(PFBS, TILES_PER_PFB).tolist()
+
+    metafits = os.path.join(dir, '%d.metafits' % OBSID)
+    write_metafits(metafits, channels, flags)
+
+    paths = []
+    for i, (pfb, lane) in enumerate(lane_slots(lanes)):
+        path = os.path.join(dir, '%d_%d_vcs%02d_1.dat' % (OBSID, SECOND, i + 1))
+        write_raw(path, pfb, lane, rng)
+        paths.append(path)
+
+    return metafits, paths
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def compare(label, ours, elapsed, reference, reference_elapsed):
+    same = np.array_equal(ours, reference)
+    logging.info('%-10s binary %7.2fs numpy %7.2fs speedup %5.2fx identical: %s',
+                 label, reference_elapsed, elapsed, reference_elapsed / elapsed, same)
+    if not same:
+        logging.info('%-10s %d of %d bytes differ', label, int((ours != reference).sum()), ours.size)
+    return same
+
+
+def run(binary, dir, lanes, flagged, seed, channels):
+    """Run the benchmark in dir. Returns True if every ICS matched."""
+    metafits, paths = make_second(dir, lanes, flagged, seed)
+    chans, flags = read_metafits(metafits)
+    logging.info('%d lane files, %d flagged inputs', len(paths), sum(sum(row) for row in flags))
+
+    output = os.path.join(dir, 'out')
+    os.makedirs(output, exist_ok=True)
+
+    _, elapsed, error = recombine_second(binary, OBSID, SECOND, metafits, paths, output, skip_chan=True)
+    if error:
+        raise Exception('recombine failed: %s' % error)
+    reference = np.fromfile(ics_filename(output, OBSID, SECOND), dtype=np.uint8)
+
+    ours, ours_elapsed = timed(ics.ics_from_raw, paths, chans, flags)
+    ok = compare('raw', ours.ravel(), ours_elapsed, reference, elapsed)
+
+    if channels:
+        _, elapsed, error = recombine_second(binary, OBSID, SECOND, metafits, paths, output)
+        if error:
+            raise Exception('recombine failed: %s' % error)
+
+        freqs, _ = course_channel_swap(chans)
+        files = [channel_filename(output, OBSID, SECOND, f) for f in freqs]
+        ours, ours_elapsed = timed(ics.ics_from_channels, files, flags)
+        ok = compare('channels', ours.ravel(), ours_elapsed, reference, elapsed) and ok
+
+    return ok
+
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]', version='%prog 1.0')
+    parser.add_option('--recombine', default='recombine', dest='binary', help='Path of the recombine binary')
+    parser.add_option('--dir', default=None, dest='dir', help='Scratch directory (default: a new temporary directory)')
+    parser.add_option('--lanes', default='8', type='int', dest='lanes',
+                      help='Number of raw lane files to generate, 1-32 (default: 8)')
+    parser.add_option('--flagged', default='16', type='int', dest='flagged',
+                      help='Number of flagged inputs (default: 16)')
+    parser.add_option('--seed', default='1', type='int', dest='seed', help='Random seed (default: 1)')
+    parser.add_option('--channels', action='store_true', default=False, dest='channels',
+                      help='Also write the course channel files and rebuild the ICS from them')
+    parser.add_option('--keep', action='store_true', default=False, dest='keep',
+                      help='Keep the generated files')
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    if not 1 <= options.lanes <= PFBS * LANES:
+        print('--lanes must be between 1 and 32')
+        sys.exit(-1)
+
+    if not 0 <= options.flagged < PFBS * TILES_PER_PFB:
+        print('--flagged must be between 0 and 255')
+        sys.exit(-1)
+
+    dir = options.dir or tempfile.mkdtemp(prefix='bench_ics_')
+    os.makedirs(dir, exist_ok=True)
+    try:
+        ok = run(options.binary, dir, options.lanes, options.flagged, options.seed, options.channels)
+    finally:
+        if not options.keep:
+            shutil.rmtree(dir, ignore_errors=True)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# -*- coding: utf8 -*-
+"""
+Recombine a range of seconds of an observation with the recombine binary.
+
+The binary handles one second per run. This driver reads the metafits
+once, finds the raw input files of every second with a single directory
+scan, skips seconds whose products are already complete and runs the
+rest on a pool of recombine processes sized to fit a memory budget.
+
+Usage:
+    python -m mwa_recombine.driver --obs=<obsid> --from=<gps> --to=<gps>
+        --metafits=<obsid>.metafits --input=<raw dir> --output=<out dir>
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import subprocess
+from optparse import OptionParser
+from concurrent.futures import ThreadPoolExecutor
+
+from mwa_recombine.metadata import (read_metafits, course_channel_swap, channel_filename,
+                                    ics_filename, CHAN_FILESIZE, ICS_FILESIZE,
+                                    RECOMBINE_MEMORY)
+
+logger = logging.getLogger(__name__)
+
+RAW_FILENAME = re.compile(r'^(\d+)_(\d+)_vcs(\d+)_\d+\.dat$')
+
+
+def find_inputs(directory, obsid, start, end):
+    """
+    Raw voltage files of an observation grouped by second.
+
+    Returns:
+        {second: [path, ...]} for start <= second < end, paths in lane order.
+    """
+    seconds = {}
+    for entry in os.scandir(directory):
+        match = RAW_FILENAME.match(entry.name)
+        if not match or match.group(1) != str(obsid):
+            continue
+        second = int(match.group(2))
+        if start <= second < end:
+            seconds.setdefault(second, []).append((int(match.group(3)), entry.path))
+
+    return dict((second, [path for lane, path in sorted(files)]) for second, files in seconds.items())
+
+
+def products_complete(directory, obsid, second, freqs, skip_chan=False, skip_ics=False):
+    """True if every product of a second is on disk at its full size."""
+    paths = []
+    if not skip_chan:
+        paths += [(channel_filename(directory, obsid, second, f), CHAN_FILESIZE) for f in freqs]
+    if not skip_ics:
+        paths.append((ics_filename(directory, obsid, second), ICS_FILESIZE))
+
+    for path, size in paths:
+        try:
+            if os.stat(path).st_size != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def worker_count(procs, max_memory=None):
+    """Number of recombine processes to run at once within a memory budget."""
+    if max_memory:
+        procs = min(procs, max(1, max_memory // RECOMBINE_MEMORY))
+    return max(1, procs)
+
+
+def recombine_second(binary, obsid, second, metafits, files, output, skip_chan=False, skip_ics=False,
+                     ionice=None):
+    """
+    Run the recombine binary for one second.
+
+    Returns:
+        (second, seconds taken, error message or None)
+    """
+    cmd = [binary, '-o', str(obsid), '-t', str(second), '-m', metafits, '-i', output]
+    if skip_chan:
+        cmd.append('-c')
+    if skip_ics:
+        cmd.append('-s')
+    cmd += ['-f'] + files
+
+    if ionice:
+        cmd = ['ionice', '-c', str(ionice)] + cmd
+
+    start = time.time()
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return second, time.time() - start, str(e)
+
+    elapsed = time.time() - start
+    if result.returncode != 0:
+        return second, elapsed, result.stdout.decode(errors='replace').strip()
+    return second, elapsed, None
+
+
+def collect_results(futures, done):
+    """
+    Wait for the per second futures in order and log each result.
+
+    Returns:
+        list of their (second, seconds taken, error message or None).
+    """
+    results = []
+    for future in futures:
+        second, elapsed, error = future.result()
+        if error:
+            logger.error('Second %d failed after %.1fs: %s' % (second, elapsed, error))
+        else:
+            logger.info('Second %d %s in %.1fs' % (second, done, elapsed))
+        results.append((second, elapsed, error))
+    return results
+
+
+def summarise(results, start, done):
+    """
+    Log the min/mean/max time per second and the totals of a range that
+    started at time start.
+
+    Returns:
+        the seconds that failed.
+    """
+    times = [elapsed for second, elapsed, error in results if not error]
+    errors = [second for second, elapsed, error in results if error]
+    if times:
+        logger.info('Per second: min %.1fs mean %.1fs max %.1fs' % (min(times), sum(times) / len(times),
+                                                                  max(times)))
+    logger.info('%d seconds %s in %.1fs, %d failed' % (len(times), done, time.time() - start, len(errors)))
+    return errors
+
+
+def recombine_range(obsid, start, end, metafits, input_dir, output_dir, binary='recombine',
+                    procs=4, max_memory=None, skip_chan=False, skip_ics=False, ionice=None):
+    """
+    Recombine the seconds start <= second < end of an observation.
+
+    Args:
+        obsid: observation id.
+        start, end: gps second range.
+        metafits: meta-data fits file of the observation.
+        input_dir: directory of the raw (type 11) files.
+        output_dir: directory for the course channel and ics products.
+        binary: path of the recombine binary.
+        procs: largest number of recombine processes at once.
+        max_memory: memory budget in bytes; limits procs to what fits.
+        skip_chan, skip_ics: do not generate course channel or ics products;
+            at most one of them may be set.
+        ionice: ionice class (1-3) to run the binary with, None to leave it.
+            The class is only honoured by the BFQ and CFQ I/O schedulers and
+            does nothing under others, so the number of processes reading at
+            once is bounded by procs alone.
+    Returns:
+        list of (second, seconds taken, error message or None) for every
+        second that was run, in second order.
+    """
+    if skip_chan and skip_ics:
+        raise Exception('skip_chan and skip_ics together leave nothing to recombine')
+
+    channels, _ = read_metafits(metafits)
+    freqs, _ = course_channel_swap(channels)
+
+    inputs = find_inputs(input_dir, obsid, start, end)
+    todo = []
+    for second in sorted(inputs):
+        if products_complete(output_dir, obsid, second, freqs, skip_chan, skip_ics):
+            logger.info('Second %d already recombined' % second)
+            continue
+        todo.append(second)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    workers = worker_count(procs, max_memory)
+    logger.info('Recombining %d of %d seconds with %d processes' % (len(todo), len(inputs), workers))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(recombine_second, binary, obsid, second, metafits, inputs[second],
+                               output_dir, skip_chan, skip_ics, ionice) for second in todo]
+        return collect_results(futures, 'recombined')
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] :: %(message)s',
+                        datefmt='%a %b %d %H:%M:%S', level=logging.INFO)
+
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--obs', action='store', dest='obs', help='Observation ID')
+    parser.add_option('--from', action='store', type='int', dest='start', help='First gps second')
+    parser.add_option('--to', action='store', type='int', dest='end', help='Last gps second (inclusive)')
+    parser.add_option('--metafits', action='store', dest='metafits', help='Meta-data fits file')
+    parser.add_option('--input', default='./', action='store', dest='input',
+                      help='Directory of the raw voltage files (default: ./)')
+    parser.add_option('--output', default='./', action='store', dest='output',
+                      help='Output directory (default: ./)')
+    parser.add_option('--recombine', default='recombine', action='store', dest='binary',
+                      help='recombine binary (default: %default)')
+    parser.add_option('--procs', default=4, action='store', type='int', dest='procs',
+                      help='Recombine processes to run at once (default: %default)')
+    parser.add_option('--max-memory', action='store', type='int', dest='maxmemory',
+                      help='Memory budget in MB for all recombine processes')
+    parser.add_option('--ionice', action='store', type='int', dest='ionice',
+                      help='Run recombine with this ionice class (1: realtime, 2: best-effort, 3: idle); '
+                           'only the BFQ and CFQ I/O schedulers honour it')
+    parser.add_option('--skip-chan', default=False, action='store_true', dest='skipchan',
+                      help='Do not generate the course channel products')
+    parser.add_option('--skip-ics', default=False, action='store_true', dest='skipics',
+                      help='Do not generate the incoherent sum')
+
+    (options, args) = parser.parse_args()
+
+    if options.obs is None or options.start is None or options.end is None or options.metafits is None:
+        print('--obs, --from, --to and --metafits are required')
+        sys.exit(-1)
+
+    if options.skipchan and options.skipics:
+        print('--skip-chan and --skip-ics together leave nothing to recombine')
+        sys.exit(-1)
+
+    if options.ionice and shutil.which('ionice') is None:
+        print('ionice not found')
+        sys.exit(-1)
+
+    max_memory = options.maxmemory * 1024 * 1024 if options.maxmemory else None
+
+    start = time.time()
+    results = recombine_range(options.obs, options.start, options.end + 1, options.metafits,
+                              options.input, options.output, options.binary, options.procs,
+                              max_memory, options.skipchan, options.skipics, options.ionice)
+
+    if summarise(results, start, 'recombined'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# -*- coding: utf8 -*-
+"""
+Incoherent sum (ICS) computed with NumPy.
+
+Produces the same bytes as the ICS loop in recombine(), either from the
+32 raw lane files of a second or from the 24 recombined course channel
+files. For every sample, course channel and fine channel the recombiner
+adds byte_to_sum[] (the power of a 4+4 bit sample) over the unflagged
+inputs of the four PFBs, then scales by 5 / contributing inputs and
+clips to a byte.
+
+Here each 50ms block is handled at once: samples are read as pairs of
+bytes through 65536 entry tables that hold the power of both bytes, or
+of only one of them, so one lookup covers two inputs. The power of the
+few flagged inputs is looked up separately and taken off the total.
+"""
+import numpy as np
+
+from mwa_recombine.metadata import (course_channel_swap, source_position, VOLT_FILESIZE,
+                                    PACKET_SIZE_BYTES, BLOCKS_PER_SEC, SAMPLES_PER_BLOCK,
+                                    COURSE_CHANS, LANES, PFBS, TILES_PER_PFB, RAW_FILESIZE,
+                                    CHAN_FILESIZE)
+from mwa_recombine.reader import SAMPLES_PER_SEC, FINE_CHANS, input_position
+
+BYTE_TO_SUM = np.array([
+    0, 1, 4, 9, 16, 25, 36, 49, 49, 49, 36, 25, 16, 9, 4, 1, 1, 2, 5, 10, 17, 26, 37, 50, 50, 50, 37, 26, 17, 10, 5, 2,
+    4, 5, 8, 13, 20, 29, 40, 53, 53, 53, 40, 29, 20, 13, 8, 5, 9, 10, 13, 18, 25, 34, 45, 58, 58, 58, 45, 34, 25, 18, 13, 10,
+    16, 17, 20, 25, 32, 41, 52, 65, 65, 65, 52, 41, 32, 25, 20, 17, 25, 26, 29, 34, 41, 50, 61, 74, 74, 74, 61, 50, 41, 34, 29, 26,
+    36, 37, 40, 45, 52, 61, 72, 85, 85, 85, 72, 61, 52, 45, 40, 37, 49, 50, 53, 58, 65, 74, 85, 98, 98, 98, 85, 74, 65, 58, 53, 50,
+    49, 50, 53, 58, 65, 74, 85, 98, 98, 98, 85, 74, 65, 58, 53, 50, 49, 50, 53, 58, 65, 74, 85, 98, 98, 98, 85, 74, 65, 58, 53, 50,
+    36, 37, 40, 45, 52, 61, 72, 85, 85, 85, 72, 61, 52, 45, 40, 37, 25, 26, 29, 34, 41, 50, 61, 74, 74, 74, 61, 50, 41, 34, 29, 26,
+    16, 17, 20, 25, 32, 41, 52, 65, 65, 65, 52, 41, 32, 25, 20, 17, 9, 10, 13, 18, 25, 34, 45, 58, 58, 58, 45, 34, 25, 18, 13, 10,
+    4, 5, 8, 13, 20, 29, 40, 53, 53, 53, 40, 29, 20, 13, 8, 5, 1, 2, 5, 10, 17, 26, 37, 50, 50, 50, 37, 26, 17, 10, 5, 2],
+    dtype=np.uint16)
+
+HEADER_BYTES = 6
+PAIRS_PER_PFB = TILES_PER_PFB // 2
+
+# power of a little endian byte pair, indexed by (low byte kept, high byte kept)
+_pair = np.arange(65536)
+PAIR_TABLES = {
+    (True, True): BYTE_TO_SUM[_pair & 0xff] + BYTE_TO_SUM[_pair >> 8],
+    (True, False): BYTE_TO_SUM[_pair & 0xff],
+    (False, True): BYTE_TO_SUM[_pair >> 8],
+}
+del _pair
+
+
+def pair_groups(flag_rows):
+    """
+    The table lookups that give the power of the unflagged inputs of
+    consecutive PFBs.
+
+    Args:
+        flag_rows: the 64 flags of each PFB whose input bytes follow each
+            other in the data.
+    Returns:
+        list of (table, pair indexes, subtract) where pair index 32 * i + k
+        covers the bytes 2k and 2k+1 of the i-th PFB's 64 input bytes. When
+        few inputs are flagged every pair is looked up in the full table and
+        the flagged bytes are subtracted again, which avoids gathering the
+        kept pairs.
+    """
+    keep = []
+    for flags in flag_rows:
+        row = [False] * TILES_PER_PFB
+        for tile in range(TILES_PER_PFB):
+            if flags[tile] == 0:
+                row[input_position(tile)] = True
+        keep += row
+
+    npairs = len(keep) // 2
+    kept = {}
+    flagged = {}
+    for k in range(npairs):
+        low, high = keep[2 * k], keep[2 * k + 1]
+        if low or high:
+            kept.setdefault((low, high), []).append(k)
+        if not (low and high):
+            flagged.setdefault((not low, not high), []).append(k)
+
+    if sum(len(pairs) for pairs in flagged.values()) * 2 < npairs:
+        result = [(PAIR_TABLES[(True, True)], slice(None), False)]
+        for key, pairs in sorted(flagged.items()):
+            result.append((PAIR_TABLES[key], np.array(pairs, dtype=np.intp), True))
+        return result
+
+    return [(PAIR_TABLES[key], np.array(pairs, dtype=np.intp), False) for key, pairs in sorted(kept.items())]
+
+
+def masked_power(pairs, groups):
+    """Sum the power of the kept inputs over the last axis of a uint16 pair array."""
+    total = np.zeros(pairs.shape[:-1], dtype=np.uint16)
+    for table, index, subtract in groups:
+        # uint16 wraps, so taking off what was added before stays exact
+        part = table[pairs[..., index]].sum(axis=-1, dtype=np.uint16)
+        if subtract:
+            total -= part
+        else:
+            total += part
+    return total
+
+
+def normalise(sums, contrib):
+    """
+    Scale summed power to the ICS byte: (sum * 5) / contributing inputs,
+    clipped to 255, and 0 where nothing contributes. contrib is broadcast
+    against sums.
+    """
+    contrib = np.asarray(contrib, dtype=np.uint32)
+    scaled = sums.astype(np.uint32) * 5 // np.maximum(contrib, 1)
+    return np.where(contrib > 0, np.minimum(scaled, 255), 0).astype(np.uint8)
+
+
+def contributing_inputs(flags, present):
+    """
+    Inputs contributing to each lane: for every PFB with data on that lane,
+    64 less its flagged inputs (m_contributing_tiles summed over PFBs).
+
+    Args:
+        flags: 4 x 64 tile flags.
+        present: 4 x 8 booleans, True where a PFB/lane has data.
+    """
+    unflagged = [TILES_PER_PFB - sum(1 for f in flags[p] if f) for p in range(PFBS)]
+    return np.array([sum(unflagged[p] for p in range(PFBS) if present[p][lane])
+                     for lane in range(LANES)], dtype=np.uint32)
+
+
+def identify_lane(path):
+    """
+    (pfb, lane) of a raw lane file from its first packet header.
+
+    Follows read_from_input(), including its sign extension of the header
+    bytes: a set top bit in byte 4 makes the receiver index 3.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_BYTES)
+    if len(header) != HEADER_BYTES:
+        raise Exception('%s is too short' % path)
+
+    lane = (header[2] >> 4) & 0x7
+    pfb = 3 if header[4] & 0x80 else (header[5] >> 6) & 0x3
+    return pfb, lane
+
+
+def ics_from_raw(paths, channels, flags):
+    """
+    ICS of one second from its raw lane files.
+
+    Args:
+        paths: up to 32 raw lane files; missing lanes are treated as zeros,
+            as the recombiner pads them.
+        channels: the 24 course channels from the metafits.
+        flags: 4 x 64 tile flags from the metafits.
+    Returns:
+        (time, course channel, fine channel) uint8 array, the content of
+        <obsid>_<second>_ics.dat.
+    """
+    freqs, swap_index = course_channel_swap(channels)
+    source = np.array([source_position(c, swap_index) for c in range(COURSE_CHANS)], dtype=np.intp)
+
+    inputs = {}
+    for path in paths:
+        inputs[identify_lane(path)] = path
+
+    present = [[(p, l) in inputs for l in range(LANES)] for p in range(PFBS)]
+    contrib = contributing_inputs(flags, present)
+    groups = [pair_groups([flags[p]]) for p in range(PFBS)]
+
+    maps = {}
+    for key, path in inputs.items():
+        maps[key] = np.memmap(path, dtype='<u2', mode='r', shape=(RAW_FILESIZE // 2,))
+
+    ics = np.empty((SAMPLES_PER_SEC, COURSE_CHANS, LANES, 4, 4), dtype=np.uint8)
+    words = VOLT_FILESIZE // 2
+    header = HEADER_BYTES // 2
+
+    for block in range(BLOCKS_PER_SEC):
+        sums = np.zeros((SAMPLES_PER_BLOCK, COURSE_CHANS, LANES, 4, 4), dtype=np.uint16)
+
+        for (pfb, lane), data in maps.items():
+            # a 50ms block is [course channel][group][sample][packet]
+            chunk = data[block * words:(block + 1) * words]
+            chunk = chunk.reshape(COURSE_CHANS, 4, SAMPLES_PER_BLOCK, PACKET_SIZE_BYTES // 2)
+            payload = chunk[:, :, :, header:header + 4 * PAIRS_PER_PFB]
+            payload = payload.reshape(COURSE_CHANS, 4, SAMPLES_PER_BLOCK, 4, PAIRS_PER_PFB)
+
+            power = masked_power(payload, groups[pfb])[source]
+            sums[:, :, lane] += power.transpose(2, 0, 1, 3)
+
+        start = block * SAMPLES_PER_BLOCK
+        ics[start:start + SAMPLES_PER_BLOCK] = normalise(sums, contrib[:, None, None])
+
+    return ics.reshape(SAMPLES_PER_SEC, COURSE_CHANS, FINE_CHANS)
+
+
+def ics_from_channels(paths, flags, missing=None):
+    """
+    ICS of one second from its 24 recombined course channel files.
+
+    Args:
+        paths: the course channel files in ascending frequency order.
+        flags: 4 x 64 tile flags to apply.
+        missing: (pfb, lane) pairs that had no input when the files were
+            recombined. By default a PFB/lane whose first 50ms block is all
+            zero in every channel is taken as missing, which is how the
+            recombiner pads it.
+    Returns:
+        (time, course channel, fine channel) uint8 array.
+    """
+    if len(paths) != COURSE_CHANS:
+        raise Exception('need %d course channel files, got %d' % (COURSE_CHANS, len(paths)))
+
+    # all four PFBs of a fine channel are adjacent, so one lookup per table covers them
+    groups = pair_groups(flags)
+    sums = np.empty((SAMPLES_PER_SEC, COURSE_CHANS, LANES, 4, 4), dtype=np.uint16)
+    nonzero = np.zeros((LANES, PFBS), dtype=bool)
+
+    for c, path in enumerate(paths):
+        data = np.memmap(path, dtype='<u2', mode='r', shape=(CHAN_FILESIZE // 2,))
+        data = data.reshape(SAMPLES_PER_SEC, LANES, 4, 4, PFBS * PAIRS_PER_PFB)
+
+        if missing is None:
+            first = data[:SAMPLES_PER_BLOCK].reshape(SAMPLES_PER_BLOCK, LANES, 4, 4, PFBS, PAIRS_PER_PFB)
+            nonzero |= first.any(axis=(0, 2, 3, 5))
+
+        for block in range(BLOCKS_PER_SEC):
+            start = block * SAMPLES_PER_BLOCK
+            samples = data[start:start + SAMPLES_PER_BLOCK]
+            sums[start:start + SAMPLES_PER_BLOCK, c] = masked_power(samples, groups)
+
+    if missing is None:
+        present = nonzero.T.tolist()
+    else:
+        present = [[(p, l) not in missing for l in range(LANES)] for p in range(PFBS)]
+
+    contrib = contributing_inputs(flags, present)
+    return normalise(sums, contrib[:, None, None]).reshape(SAMPLES_PER_SEC, COURSE_CHANS, FINE_CHANS)
+
+
+def write_ics(path, ics):
+    """Write an ICS array in the layout of <obsid>_<second>_ics.dat."""
+    np.ascontiguousarray(ics, dtype=np.uint8).tofile(path)
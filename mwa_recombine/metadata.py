@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+"""
+Observation metadata and product layout shared by the recombine tools.
+
+The constants mirror recombine.h and recombine.cpp so that the Python
+tools agree with the recombine binary on file sizes and names.
+"""
+import os
+
+from astropy.io import fits
+
+
+PACKETS_PER_50MS = 48000
+PACKET_SIZE_BYTES = 264
+VOLT_FILESIZE = PACKETS_PER_50MS * PACKET_SIZE_BYTES
+ICS_BUFF = 30720000
+COURSE_CHAN_BUFF = 64000 * 256
+
+BLOCKS_PER_SEC = 20
+SAMPLES_PER_BLOCK = 500
+COURSE_CHANS = 24
+LANES = 8
+PFBS = 4
+TILES_PER_PFB = 64
+
+# bytes of one second of each product
+RAW_FILESIZE = VOLT_FILESIZE * BLOCKS_PER_SEC
+CHAN_FILESIZE = COURSE_CHAN_BUFF * BLOCKS_PER_SEC
+ICS_FILESIZE = ICS_BUFF
+
+# buffers one recombine process holds: 24 course channel buffers, the ics
+# buffer and one 50ms buffer for each of the 32 inputs
+RECOMBINE_MEMORY = COURSE_CHANS * COURSE_CHAN_BUFF + ICS_BUFF + PFBS * LANES * VOLT_FILESIZE
+
+
+def read_metafits(path):
+    """
+    Read the course channels and tile flags of an observation.
+
+    Args:
+        path: meta-data fits file of the observation.
+    Returns:
+        (channels, flags): the 24 course channel numbers in the order of the
+        CHANNELS keyword and a 4 x 64 list of flags (PFB x input, 0 keep,
+        1 flag out), the same values read_metadata() gives the binary.
+    Raises:
+        Exception if the file does not describe 24 channels and 256 inputs,
+        has duplicate channels or every input is flagged.
+    """
+    with fits.open(path) as hdus:
+        channels = [int(c) for c in str(hdus[0].header['CHANNELS']).split(',') if c.strip()]
+        if len(channels) != COURSE_CHANS:
+            raise Exception('Did not find 24 channels in meta data fits file %s' % path)
+
+        if len(set(channels)) != len(channels):
+            raise Exception('Duplicate course channel frequency entry found in %s' % path)
+
+        table = hdus[1].data
+        if len(table) != PFBS * TILES_PER_PFB:
+            raise Exception('Number of rows in binary table != 256 in %s' % path)
+
+        values = [int(f) for f in table['Flag']]
+
+    flags = [values[p * TILES_PER_PFB:(p + 1) * TILES_PER_PFB] for p in range(PFBS)]
+    if all(all(row) for row in flags):
+        raise Exception('All the tiles are flagged out in %s' % path)
+
+    return channels, flags
+
+
+def course_channel_swap(channels):
+    """
+    Sort the course channels the way course_channel_swap() does.
+
+    Returns:
+        (freqs, swap_index): channels in ascending order and the index of the
+        first channel >= 129, whose data the receivers deliver in reverse
+        order (24 if there is none).
+    """
+    freqs = sorted(channels)
+    swap_index = COURSE_CHANS
+    for i, freq in enumerate(freqs):
+        if freq >= 129:
+            swap_index = i
+            break
+    return freqs, swap_index
+
+
+def source_position(course_ch, swap_index):
+    # position of output course channel course_ch in the raw input data
+    if course_ch < swap_index:
+        return course_ch
+    return COURSE_CHANS - 1 - course_ch + swap_index
+
+
+def channel_filename(directory, obsid, second, freq):
+    return os.path.join(directory, '%s_%s_ch%d.dat' % (obsid, second, freq))
+
+
+def ics_filename(directory, obsid, second):
+    return os.path.join(directory, '%s_%s_ics.dat' % (obsid, second))
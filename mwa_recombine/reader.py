@@ -0,0 +1,179 @@
+# -*- coding: utf8 -*-
+"""
+Memory mapped access to the products written by recombine.
+
+A course channel file <obsid>_<second>_ch<NNN>.dat holds 20 blocks of
+500 samples; each sample has 128 ten kHz fine channels (8 lanes x 4
+groups x 4) of 256 inputs (4 PFBs x 64). Within a PFB the fPFB stores
+its 64 inputs in the order 0,16,32,48,1,17,...,63 (see the ICS loop in
+recombine()). Every sample is one byte, 4 bit real (high nibble) and
+4 bit imaginary (low nibble).
+
+An ICS file <obsid>_<second>_ics.dat holds one byte per sample, course
+channel and fine channel.
+
+The views returned here share memory with the file: nothing is read
+until it is used. Only gather() and reads spanning several seconds copy.
+"""
+import numpy as np
+
+from mwa_recombine.metadata import (channel_filename, ics_filename, BLOCKS_PER_SEC,
+                                    SAMPLES_PER_BLOCK, COURSE_CHANS, LANES, PFBS,
+                                    TILES_PER_PFB)
+
+SAMPLES_PER_SEC = BLOCKS_PER_SEC * SAMPLES_PER_BLOCK
+FINE_CHANS = LANES * 4 * 4
+INPUTS = PFBS * TILES_PER_PFB
+TILES = INPUTS // 2
+
+
+def input_position(inp):
+    """Byte offset within a sample of input inp (metafits row order)."""
+    pfb, tile = divmod(inp, TILES_PER_PFB)
+    return pfb * TILES_PER_PFB + (((tile & 0x30) >> 4) | ((tile & 0x0f) << 2))
+
+
+# byte offset of every input, and of every (tile, pol) with input = 2 * tile + pol
+INPUT_POSITIONS = np.array([input_position(i) for i in range(INPUTS)], dtype=np.intp)
+TILE_POL_POSITIONS = INPUT_POSITIONS.reshape(TILES, 2)
+
+
+def _complex_table():
+    nibble = np.arange(16, dtype=np.int8)
+    nibble[nibble > 7] -= 16
+    byte = np.arange(256)
+    return (nibble[byte >> 4] + 1j * nibble[byte & 0x0f]).astype(np.complex64)
+
+
+COMPLEX_TABLE = _complex_table()
+
+
+def to_complex(samples):
+    """Decode packed 4+4 bit samples into complex64 (copies)."""
+    return COMPLEX_TABLE[samples]
+
+
+class ChannelFile(object):
+    """
+    One second of one course channel.
+
+    Attributes:
+        raw: (time, fine channel, byte) view in file order.
+        voltages: (time, fine channel, pfb, a, b, pol) view with the fPFB
+            order undone, where tile = 32 * pfb + 8 * a + b.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.raw = np.memmap(path, dtype=np.uint8, mode='r', shape=(SAMPLES_PER_SEC, FINE_CHANS, INPUTS))
+
+        # in memory each PFB is [b][pol][a]; swap to [a][b][pol]
+        v = self.raw.reshape(SAMPLES_PER_SEC, FINE_CHANS, PFBS, 8, 2, 4)
+        self.voltages = v.transpose(0, 1, 2, 5, 3, 4)
+
+    def tile(self, tile, pol):
+        """(time, fine channel) view of one tile and polarisation."""
+        return self.raw[:, :, TILE_POL_POSITIONS[tile, pol]]
+
+    def gather(self, tiles=None, pols=(0, 1), start=0, stop=None):
+        """(time, fine channel, tile, pol) copy of the selected tiles and samples."""
+        positions = TILE_POL_POSITIONS if tiles is None else TILE_POL_POSITIONS[np.asarray(tiles)]
+        positions = positions[:, np.asarray(pols)]
+        return self.raw[start:stop][:, :, positions]
+
+
+class IcsFile(object):
+    """
+    One second of the incoherent sum.
+
+    Attributes:
+        data: (time, course channel, fine channel) view.
+        spectrum: (time, frequency) view over all 3072 fine channels.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', shape=(SAMPLES_PER_SEC, COURSE_CHANS, FINE_CHANS))
+        self.spectrum = self.data.reshape(SAMPLES_PER_SEC, COURSE_CHANS * FINE_CHANS)
+
+
+class Series(object):
+    """
+    Consecutive one second files joined along the time axis.
+
+    Files are only mapped when a read touches them. A read inside one
+    second returns a view of that file; a read across seconds returns the
+    concatenated copy of just the requested samples.
+    """
+
+    def __init__(self, paths, opener):
+        self.paths = list(paths)
+        self.opener = opener
+        self.files = [None] * len(self.paths)
+
+    def __len__(self):
+        return len(self.paths) * SAMPLES_PER_SEC
+
+    def file(self, index):
+        if self.files[index] is None:
+            self.files[index] = self.opener(self.paths[index])
+        return self.files[index]
+
+    def read(self, select, start=0, stop=None):
+        """
+        Apply select(file, lo, hi) to every second overlapping [start, stop)
+        and join the results along the time axis.
+        """
+        start, stop, step = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        pieces = []
+        for index in range(start // SAMPLES_PER_SEC, -(-stop // SAMPLES_PER_SEC)):
+            offset = index * SAMPLES_PER_SEC
+            lo = max(start, offset) - offset
+            hi = min(stop, offset + SAMPLES_PER_SEC) - offset
+            pieces.append(select(self.file(index), lo, hi))
+
+        if not pieces:
+            return select(self.file(0), 0, 0)
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces)
+
+
+class ChannelSeries(Series):
+    """A course channel over many seconds."""
+
+    def __init__(self, paths):
+        Series.__init__(self, paths, ChannelFile)
+
+    def tile(self, tile, pol, start=0, stop=None):
+        return self.read(lambda f, lo, hi: f.tile(tile, pol)[lo:hi], start, stop)
+
+    def voltages(self, start=0, stop=None):
+        return self.read(lambda f, lo, hi: f.voltages[lo:hi], start, stop)
+
+    def gather(self, tiles=None, pols=(0, 1), start=0, stop=None):
+        return self.read(lambda f, lo, hi: f.gather(tiles, pols, lo, hi), start, stop)
+
+
+class IcsSeries(Series):
+    """The incoherent sum over many seconds."""
+
+    def __init__(self, paths):
+        Series.__init__(self, paths, IcsFile)
+
+    def data(self, start=0, stop=None):
+        return self.read(lambda f, lo, hi: f.data[lo:hi], start, stop)
+
+    def spectrum(self, start=0, stop=None):
+        return self.read(lambda f, lo, hi: f.spectrum[lo:hi], start, stop)
+
+
+def open_channel(directory, obsid, freq, seconds):
+    """ChannelSeries of course channel freq for the given gps seconds."""
+    return ChannelSeries([channel_filename(directory, obsid, s, freq) for s in seconds])
+
+
+def open_ics(directory, obsid, seconds):
+    """IcsSeries for the given gps seconds."""
+    return IcsSeries([ics_filename(directory, obsid, s) for s in seconds])
@@ -0,0 +1,205 @@
+# -*- coding: utf8 -*-
+"""
+Rebuild the ICS of a range of seconds from recombined course channel files.
+
+The course channel files hold the samples of every input, so when the tile
+flags change the incoherent sum can be made again from them with the new
+flags instead of downloading the raw files and running recombine -c. The
+flags come from a metafits, optionally with extra inputs flagged or
+unflagged on the command line. Seconds are processed in parallel, each one
+streaming through its memory mapped channel files a 50ms block at a time.
+
+Usage:
+    python -m mwa_recombine.reflag --obs=<obsid> --from=<gps> --to=<gps>
+        --metafits=<obsid>.metafits --input=<channel dir> --output=<out dir>
+"""
+import os
+import re
+import sys
+import time
+import logging
+from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
+
+from mwa_recombine import ics
+from mwa_recombine.driver import collect_results, summarise
+from mwa_recombine.metadata import (read_metafits, course_channel_swap, ics_filename, CHAN_FILESIZE,
+                                    COURSE_CHANS, PFBS, TILES_PER_PFB)
+
+logger = logging.getLogger(__name__)
+
+CHAN_FILENAME = re.compile(r'^(\d+)_(\d+)_ch(\d+)\.dat$')
+
+
+def find_channel_files(directory, obsid, start, end, freqs):
+    """
+    Course channel files of an observation grouped by second.
+
+    Returns:
+        ({second: [path, ...]} for the seconds start <= second < end whose
+        24 files are all present at full size, paths in ascending frequency,
+        sorted list of the seconds with some files missing or short)
+    """
+    found = {}
+    for entry in os.scandir(directory):
+        match = CHAN_FILENAME.match(entry.name)
+        if not match or match.group(1) != str(obsid):
+            continue
+        second = int(match.group(2))
+        if start <= second < end:
+            found.setdefault(second, {})[int(match.group(3))] = entry
+
+    complete = {}
+    incomplete = []
+    for second, entries in sorted(found.items()):
+        try:
+            paths = [entries[f].path for f in freqs if entries[f].stat().st_size == CHAN_FILESIZE]
+        except (KeyError, OSError):
+            paths = []
+        if len(paths) == COURSE_CHANS:
+            complete[second] = paths
+        else:
+            incomplete.append(second)
+
+    return complete, incomplete
+
+
+def parse_inputs(value):
+    """Metafits rows (0-255) from a comma separated list with a-b ranges."""
+    rows = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        rows.update(range(int(first), int(last if sep else first) + 1))
+
+    if any(row < 0 or row >= PFBS * TILES_PER_PFB for row in rows):
+        raise Exception('input rows must be between 0 and %d' % (PFBS * TILES_PER_PFB - 1))
+    return rows
+
+
+def override_flags(flags, flag=(), unflag=()):
+    """
+    Copy of the 4 x 64 metafits flags with the rows in flag set and the
+    rows in unflag cleared.
+    """
+    values = [int(f) for row in flags for f in row]
+    for row in flag:
+        values[row] = 1
+    for row in unflag:
+        values[row] = 0
+
+    if all(values):
+        raise Exception('All the tiles are flagged out')
+    return [values[p * TILES_PER_PFB:(p + 1) * TILES_PER_PFB] for p in range(PFBS)]
+
+
+def reflag_second(obsid, second, paths, flags, output):
+    """
+    Rebuild the ICS of one second. The file is written under a temporary
+    name and renamed into place, so an existing ICS is only replaced by a
+    complete one.
+
+    Returns:
+        (second, seconds taken, error message or None)
+    """
+    start = time.time()
+    path = ics_filename(output, obsid, second)
+    temp = path + '.tmp'
+    try:
+        ics.write_ics(temp, ics.ics_from_channels(paths, flags))
+        os.replace(temp, path)
+    except Exception as e:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        return second, time.time() - start, str(e)
+
+    return second, time.time() - start, None
+
+
+def reflag_range(obsid, start, end, metafits, input_dir, output_dir, procs=4, flag=(), unflag=()):
+    """
+    Rebuild the ICS of the seconds start <= second < end of an observation.
+
+    Args:
+        obsid: observation id.
+        start, end: gps second range.
+        metafits: meta-data fits file with the course channels and flags.
+        input_dir: directory of the course channel files.
+        output_dir: directory for the ics files.
+        procs: number of seconds to process at once.
+        flag, unflag: metafits rows to flag or unflag on top of the metafits.
+    Returns:
+        list of (second, seconds taken, error message or None) for every
+        second that was processed, in second order.
+    """
+    channels, flags = read_metafits(metafits)
+    flags = override_flags(flags, flag, unflag)
+    freqs, _ = course_channel_swap(channels)
+
+    inputs, incomplete = find_channel_files(input_dir, obsid, start, end, freqs)
+    for second in incomplete:
+        logger.warning('Second %d does not have all 24 course channel files, skipping' % second)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    workers = max(1, procs)
+    logger.info('Rebuilding the ICS of %d seconds with %d processes, %d inputs flagged' %
+                (len(inputs), workers, sum(sum(row) for row in flags)))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(reflag_second, obsid, second, inputs[second], flags, output_dir)
+                   for second in sorted(inputs)]
+        return collect_results(futures, 'rebuilt')
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] :: %(message)s',
+                        datefmt='%a %b %d %H:%M:%S', level=logging.INFO)
+
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--obs', action='store', dest='obs', help='Observation ID')
+    parser.add_option('--from', action='store', type='int', dest='start', help='First gps second')
+    parser.add_option('--to', action='store', type='int', dest='end', help='Last gps second (inclusive)')
+    parser.add_option('--metafits', action='store', dest='metafits', help='Meta-data fits file with the new flags')
+    parser.add_option('--input', default='./', action='store', dest='input',
+                      help='Directory of the course channel files (default: ./)')
+    parser.add_option('--output', default=None, action='store', dest='output',
+                      help='Output directory (default: the input directory)')
+    parser.add_option('--flag', default='', action='store', dest='flag',
+                      help='Extra metafits rows to flag, e.g. 0,17,64-67')
+    parser.add_option('--unflag', default='', action='store', dest='unflag',
+                      help='Metafits rows to unflag')
+    parser.add_option('--procs', default=4, action='store', type='int', dest='procs',
+                      help='Seconds to process at once (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    if options.obs is None or options.start is None or options.end is None or options.metafits is None:
+        print('--obs, --from, --to and --metafits are required')
+        sys.exit(-1)
+
+    try:
+        flag = parse_inputs(options.flag)
+        unflag = parse_inputs(options.unflag)
+    except ValueError:
+        print('--flag and --unflag take comma separated rows or ranges')
+        sys.exit(-1)
+    except Exception as e:
+        print(str(e))
+        sys.exit(-1)
+
+    start = time.time()
+    results = reflag_range(options.obs, options.start, options.end + 1, options.metafits, options.input,
+                           options.output or options.input, options.procs, flag, unflag)
+
+    if summarise(results, start, 'rebuilt'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
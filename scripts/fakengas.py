@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for the NGAS RETRIEVE service and the data_files metadata
+# service, for testing and benchmarking voltdownload.py offline.
+#
+# Serves one synthetic observation. File names and archive sizes follow the
+# real products (raw lanes, ics, combined tar), scaled down with --scale.
+# Content is a repeating pseudo random pattern per file so it can be checked
+# after download; combined .tar files are valid tar archives of the channel
+# and ics files of their second. Range requests and keep-alive are supported,
+# and latency, bandwidth caps, errors, truncated and stalled bodies can be
+# injected.
+#
+# python fakengas.py --port=7790 --obs=1000000000 --seconds=10 --scale=0.001
+# voltdownload.py --ngas=127.0.0.1:7790 --meta-url=http://127.0.0.1:7790/ ...
+
+import sys
+import time
+import json
+import random
+import tarfile
+import threading
+import functools
+import urllib.parse
+from optparse import OptionParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s] :: %(message)s',
+                    datefmt='%a %b %d %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# archive sizes of the voltage products
+RAW_SIZE = 253440000
+CHAN_SIZE = 327680000
+ICS_SIZE = 30720000
+LANES = 32
+CHANNELS = 24
+
+PATTERN_SIZE = 65536
+CHUNK = 65536
+
+
+@functools.lru_cache(maxsize=1024)
+def pattern(name):
+   # the bytes a file's content repeats, derived from its name
+   rng = random.Random(name)
+   return rng.getrandbits(8 * PATTERN_SIZE).to_bytes(PATTERN_SIZE, 'little')
+
+
+class Payload(object):
+   """
+   Content of a synthetic file as a list of segments, each either literal
+   bytes or a run of a named pattern, readable at any offset.
+   """
+
+   def __init__(self):
+      self.segments = []
+      self.size = 0
+
+   def add_bytes(self, data):
+      self.segments.append((self.size, len(data), data, None))
+      self.size += len(data)
+
+   def add_pattern(self, name, size):
+      self.segments.append((self.size, size, None, name))
+      self.size += size
+
+   def read(self, offset, length):
+      """Up to length bytes from offset."""
+      out = []
+      end = min(self.size, offset + length)
+      for start, size, data, name in self.segments:
+         if start + size <= offset or start >= end:
+            continue
+         lo = max(offset, start) - start
+         hi = min(end, start + size) - start
+         if data is not None:
+            out.append(data[lo:hi])
+            continue
+         pat = pattern(name)
+         while lo < hi:
+            p = lo % PATTERN_SIZE
+            n = min(hi - lo, PATTERN_SIZE - p)
+            out.append(pat[p:p + n])
+            lo += n
+      return b''.join(out)
+
+
+def scaled(size, scale):
+   return max(1, int(size * scale))
+
+
+def tar_payload(obs, second, scale):
+   # a combined product: the 24 channel files and the ics of a second
+   payload = Payload()
+   members = ['%d_%d_ch%d.dat' % (obs, second, 109 + c) for c in range(CHANNELS)]
+   members.append('%d_%d_ics.dat' % (obs, second))
+   for name in members:
+      size = scaled(ICS_SIZE if name.endswith('_ics.dat') else CHAN_SIZE, scale)
+      info = tarfile.TarInfo(name)
+      info.size = size
+      info.mtime = 0
+      payload.add_bytes(info.tobuf(format=tarfile.USTAR_FORMAT))
+      payload.add_pattern(name, size)
+      if size % tarfile.BLOCKSIZE:
+         payload.add_bytes(b'\0' * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+   payload.add_bytes(b'\0' * (2 * tarfile.BLOCKSIZE))
+   return payload
+
+
+def observation(obs, start, seconds, types, scale):
+   """
+   {filename: (filetype, gps second, Payload)} of a synthetic observation.
+   """
+   files = {}
+   for second in range(start, start + seconds):
+      if 11 in types:
+         for lane in range(1, LANES + 1):
+            name = '%d_%d_vcs%02d_1.dat' % (obs, second, lane)
+            payload = Payload()
+            payload.add_pattern(name, scaled(RAW_SIZE, scale))
+            files[name] = (11, second, payload)
+
+      if 15 in types or 16 in types:
+         name = '%d_%d_ics.dat' % (obs, second)
+         payload = Payload()
+         payload.add_pattern(name, scaled(ICS_SIZE, scale))
+         files[name] = (15, second, payload)
+
+      if 16 in types:
+         files['%d_%d_combined.tar' % (obs, second)] = (16, second, tar_payload(obs, second, scale))
+   return files
+
+
+class Faults(object):
+   """Fault injection settings, drawn per request."""
+
+   def __init__(self, latency=0.0, jitter=0.0, bandwidth=0.0, error_rate=0.0, truncate_rate=0.0,
+                ignore_range=False, seed=None, stall_rate=0.0, stall=60.0, chunked=False):
+      self.latency = latency
+      self.jitter = jitter
+      self.bandwidth = bandwidth
+      self.error_rate = error_rate
+      self.truncate_rate = truncate_rate
+      self.ignore_range = ignore_range
+      self.stall_rate = stall_rate
+      self.stall = stall
+      self.chunked = chunked
+      self.rng = random.Random(seed)
+      self.lock = threading.Lock()
+
+   def draw(self):
+      """(delay before the response, 'error', 'truncate', 'stall' or None)"""
+      with self.lock:
+         delay = self.latency + self.rng.uniform(0, self.jitter)
+         r = self.rng.random()
+      if r < self.error_rate:
+         return delay, 'error'
+      if r < self.error_rate + self.truncate_rate:
+         return delay, 'truncate'
+      if r < self.error_rate + self.truncate_rate + self.stall_rate:
+         return delay, 'stall'
+      return delay, None
+
+
+class RequestLog(object):
+   """One JSON line per RETRIEVE request."""
+
+   def __init__(self, path):
+      self.f = open(path, 'a') if path else None
+      self.lock = threading.Lock()
+
+   def write(self, entry):
+      if not self.f:
+         return
+      with self.lock:
+         self.f.write(json.dumps(entry) + '\n')
+         self.f.flush()
+
+
+class Handler(BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def log_message(self, format, *args):
+      pass
+
+   def do_GET(self):
+      url = urllib.parse.urlparse(self.path)
+      params = dict(urllib.parse.parse_qsl(url.query))
+      if url.path == '/RETRIEVE':
+         self.retrieve(params.get('file_id'))
+      elif url.path == '/metadata/data_files':
+         self.data_files(params)
+      else:
+         self.reply(404, b'not found')
+
+   def reply(self, status, body):
+      self.send_response(status)
+      self.send_header('Content-Type', 'text/plain')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def data_files(self, params):
+      server = self.server
+      if params.get('obs_id') != str(server.obs):
+         self.reply(200, b'{}')
+         return
+
+      mintime = int(params['mintime']) if 'mintime' in params else None
+      maxtime = int(params['maxtime']) if 'maxtime' in params else None
+      result = {}
+      for name, (filetype, second, payload) in server.files.items():
+         if mintime is not None and not mintime <= second < maxtime:
+            continue
+         result[name] = {'filetype': filetype, 'size': payload.size,
+                         'remote_archived': True, 'deleted': False}
+
+      body = json.dumps(result).encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def retrieve(self, file_id):
+      server = self.server
+      start = time.time()
+      entry = {'file': file_id, 'start': start, 'status': 0, 'offset': 0, 'bytes': 0, 'fault': None,
+               'prestage': self.headers.get('prestagefilelist')}
+
+      if file_id not in server.files:
+         entry['status'] = 404
+         self.reply(404, b'file not found')
+         server.log.write(entry)
+         return
+
+      payload = server.files[file_id][2]
+      delay, fault = server.faults.draw()
+      entry['fault'] = fault
+      if delay:
+         time.sleep(delay)
+
+      if fault == 'error':
+         entry['status'] = 503
+         entry['ttfb'] = entry['duration'] = time.time() - start
+         self.reply(503, b'NGAMS_ER_RETRIEVE_CMD: injected error')
+         server.log.write(entry)
+         return
+
+      offset = 0
+      status = 200
+      header = self.headers.get('Range')
+      if header and not server.faults.ignore_range and header.startswith('bytes=') and \
+            header[6:].endswith('-'):
+         offset = int(header[6:-1])
+         status = 206
+         if offset >= payload.size:
+            entry['status'] = 416
+            self.reply(416, b'range not satisfiable')
+            server.log.write(entry)
+            return
+
+      length = payload.size - offset
+      chunked = server.faults.chunked
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/octet-stream')
+      if chunked:
+         self.send_header('Transfer-Encoding', 'chunked')
+      else:
+         self.send_header('Content-Length', str(length))
+      self.send_header('Content-Disposition', 'attachment; filename="%s"' % file_id)
+      if status == 206:
+         self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, payload.size - 1, payload.size))
+      self.end_headers()
+      entry['ttfb'] = time.time() - start
+      entry['status'] = status
+      entry['offset'] = offset
+
+      # a truncated reply stops half way and drops the connection, a stalled
+      # one stops half way and goes quiet for faults.stall seconds first
+      send = length // 2 if fault in ('truncate', 'stall') else length
+      sent = 0
+      began = time.time()
+      try:
+         while sent < send:
+            data = payload.read(offset + sent, min(CHUNK, send - sent))
+            if chunked:
+               self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+               self.wfile.write(data)
+            sent += len(data)
+            if server.faults.bandwidth:
+               ahead = sent / server.faults.bandwidth - (time.time() - began)
+               if ahead > 0:
+                  time.sleep(ahead)
+         if chunked and sent == length:
+            self.wfile.write(b'0\r\n\r\n')
+      except (BrokenPipeError, ConnectionResetError):
+         pass
+
+      if fault == 'stall':
+         time.sleep(server.faults.stall)
+      if fault in ('truncate', 'stall'):
+         self.close_connection = True
+
+      entry['bytes'] = sent
+      entry['duration'] = time.time() - start
+      server.log.write(entry)
+
+
+class FakeNGAS(ThreadingHTTPServer):
+   daemon_threads = True
+   request_queue_size = 512
+
+   def __init__(self, address, obs, files, faults, log):
+      ThreadingHTTPServer.__init__(self, address, Handler)
+      self.obs = obs
+      self.files = files
+      self.faults = faults
+      self.log = log
+
+
+def main():
+   parser = OptionParser(usage='usage: %prog [options]', version='%prog 1.0')
+   parser.add_option('--host', default='127.0.0.1', action='store', dest='host',
+                     help='Address to listen on (default: %default)')
+   parser.add_option('--port', default=7790, action='store', type='int', dest='port',
+                     help='Port to listen on (default: %default)')
+   parser.add_option('--obs', default=1000000000, action='store', type='int', dest='obs',
+                     help='Observation ID (default: %default)')
+   parser.add_option('--start', action='store', type='int', dest='start',
+                     help='First gps second (default: the observation ID)')
+   parser.add_option('--seconds', default=10, action='store', type='int', dest='seconds',
+                     help='Number of seconds of data (default: %default)')
+   parser.add_option('--types', default='11,15,16', action='store', dest='types',
+                     help='File types to serve (default: %default)')
+   parser.add_option('--scale', default=0.001, action='store', type='float', dest='scale',
+                     help='File sizes relative to the archive (default: %default)')
+   parser.add_option('--latency', default=0.0, action='store', type='float', dest='latency',
+                     help='Seconds before each RETRIEVE reply')
+   parser.add_option('--jitter', default=0.0, action='store', type='float', dest='jitter',
+                     help='Random extra latency up to this many seconds')
+   parser.add_option('--bandwidth', default=0.0, action='store', type='float', dest='bandwidth',
+                     help='Per stream bandwidth cap in MB/s, 0 for none')
+   parser.add_option('--error-rate', default=0.0, action='store', type='float', dest='errorrate',
+                     help='Fraction of RETRIEVE requests answered with 503')
+   parser.add_option('--truncate-rate', default=0.0, action='store', type='float', dest='truncaterate',
+                     help='Fraction of RETRIEVE replies cut off half way')
+   parser.add_option('--stall-rate', default=0.0, action='store', type='float', dest='stallrate',
+                     help='Fraction of RETRIEVE replies that stop half way and send nothing more')
+   parser.add_option('--stall', default=60.0, action='store', type='float', dest='stall',
+                     help='Seconds a stalled reply stays silent before the connection is dropped '
+                          '(default: %default)')
+   parser.add_option('--ignore-range', default=False, action='store_true', dest='ignorerange',
+                     help='Answer Range requests with the whole file')
+   parser.add_option('--chunked', default=False, action='store_true', dest='chunked',
+                     help='Send RETRIEVE replies with Transfer-Encoding: chunked instead of a Content-Length')
+   parser.add_option('--seed', action='store', type='int', dest='seed', help='Seed for fault injection')
+   parser.add_option('--log', action='store', dest='log',
+                     help='Append one JSON line per RETRIEVE request to this file')
+
+   (options, args) = parser.parse_args()
+
+   try:
+      types = set(int(t) for t in options.types.split(','))
+   except ValueError:
+      print('--types takes comma separated file types')
+      sys.exit(-1)
+
+   if options.seconds <= 0 or options.scale <= 0:
+      print('--seconds and --scale must be > 0')
+      sys.exit(-1)
+
+   start = options.start if options.start is not None else options.obs
+   files = observation(options.obs, start, options.seconds, types, options.scale)
+   faults = Faults(options.latency, options.jitter, options.bandwidth * 1e6, options.errorrate,
+                   options.truncaterate, options.ignorerange, options.seed, options.stallrate, options.stall,
+                   options.chunked)
+
+   server = FakeNGAS((options.host, options.port), options.obs, files, faults, RequestLog(options.log))
+   logger.info('Serving %d files (%.1f MB) of observation %d on %s:%d' %
+               (len(files), sum(f[2].size for f in files.values()) / 1e6, options.obs,
+                options.host, server.server_address[1]))
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   server.server_close()
+
+
+if __name__ == '__main__':
+   main()
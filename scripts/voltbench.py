@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# End to end throughput benchmark of voltdownload.py against fakengas.py.
+#
+# Starts a fake NGAS server on a local port and downloads its observation
+# once for every combination of --parallel, --bufsize and --engine, each
+# into an empty directory. Reports MB/s and files/s from the wall time of
+# each run and request latency percentiles from the server's request log.
+#
+# python voltbench.py --parallel=1,6,12 --bufsize=65536,1048576 --engine=thread,async
+
+import sys
+import os
+import time
+import json
+import socket
+import shutil
+import tempfile
+import itertools
+import subprocess
+import urllib.request
+from optparse import OptionParser
+import logging
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s] :: %(message)s',
+                    datefmt='%a %b %d %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+   s = socket.socket()
+   s.bind(('127.0.0.1', 0))
+   port = s.getsockname()[1]
+   s.close()
+   return port
+
+
+def percentile(values, p):
+   if not values:
+      return 0.0
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def start_server(port, log, args):
+   cmd = [sys.executable, os.path.join(SCRIPTS, 'fakengas.py'), '--port=%d' % port, '--log=%s' % log] + args
+   proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+   # wait until it answers
+   deadline = time.time() + 30
+   while time.time() < deadline:
+      if proc.poll() is not None:
+         raise Exception('fakengas.py exited with %d' % proc.returncode)
+      try:
+         urllib.request.urlopen('http://127.0.0.1:%d/' % port, timeout=1)
+      except urllib.error.HTTPError:
+         return proc
+      except OSError:
+         time.sleep(0.2)
+   proc.kill()
+   raise Exception('fakengas.py did not start')
+
+
+def verify(dir, files):
+   # compare every downloaded file with the content the server generates
+   bad = 0
+   for name, (filetype, second, payload) in files.items():
+      path = os.path.join(dir, name)
+      if not os.path.exists(path):
+         bad += 1
+         continue
+      with open(path, 'rb') as f:
+         offset = 0
+         while offset < payload.size:
+            data = f.read(1 << 20)
+            if data != payload.read(offset, len(data)) or not data:
+               bad += 1
+               break
+            offset += len(data)
+   return bad
+
+
+def run_once(options, port, log, parallel, bufsize, engine):
+   dir = tempfile.mkdtemp(prefix='voltbench_', dir=options.dir)
+   env = dict(os.environ, MWAVOLT_USER='bench', MWAVOLT_PASS='bench',
+              MWAVOLT_SERVER_URL='127.0.0.1:%d' % port)
+   cmd = [sys.executable, os.path.join(SCRIPTS, 'voltdownload.py'), '--obs=%d' % options.obs,
+          '--type=%d' % options.filetype, '--ngas=127.0.0.1:%d' % port,
+          '--meta-url=http://127.0.0.1:%d/' % port, '--meta-cache=', '--dir=%s' % dir,
+          '--parallel=%d' % parallel, '--bufsize=%d' % bufsize, '--engine=%s' % engine]
+
+   with open(log) as f:
+      skip = len(f.readlines())
+
+   start = time.time()
+   result = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+   elapsed = time.time() - start
+
+   with open(log) as f:
+      entries = [json.loads(line) for line in f.readlines()[skip:]]
+
+   files = 0
+   size = 0
+   for entry in os.scandir(dir):
+      files += 1
+      size += entry.stat().st_size
+
+   bad = None
+   if options.verify:
+      import fakengas
+      types = set([options.filetype, 15]) if options.filetype == 16 else set([options.filetype])
+      start_second = options.start if options.start is not None else options.obs
+      served = fakengas.observation(options.obs, start_second, options.seconds, types, options.scale)
+      served = dict((n, v) for n, v in served.items() if v[0] in types)
+      bad = verify(dir, served)
+
+   shutil.rmtree(dir, ignore_errors=True)
+
+   durations = [e['duration'] for e in entries if 'duration' in e]
+   ttfbs = [e['ttfb'] for e in entries if 'ttfb' in e]
+   return {'parallel': parallel, 'bufsize': bufsize, 'engine': engine, 'exit': result.returncode,
+           'seconds': elapsed, 'files': files, 'bytes': size, 'requests': len(entries),
+           'failed_requests': sum(1 for e in entries if e['status'] not in (200, 206) or e['fault']),
+           'mb_per_s': size / elapsed / 1e6, 'files_per_s': files / elapsed,
+           'p50': percentile(durations, 50), 'p95': percentile(durations, 95), 'p99': percentile(durations, 99),
+           'ttfb_p99': percentile(ttfbs, 99), 'corrupt': bad}
+
+
+def main():
+   parser = OptionParser(usage='usage: %prog [options]', version='%prog 1.0')
+   parser.add_option('--parallel', default='1,6,12', action='store', dest='parallel',
+                     help='Comma separated --parallel values (default: %default)')
+   parser.add_option('--bufsize', default='65536', action='store', dest='bufsize',
+                     help='Comma separated --bufsize values (default: %default)')
+   parser.add_option('--engine', default='thread', action='store', dest='engine',
+                     help='Comma separated engines (default: %default)')
+   parser.add_option('--repeat', default=1, action='store', type='int', dest='repeat',
+                     help='Runs of each combination (default: %default)')
+   parser.add_option('--obs', default=1000000000, action='store', type='int', dest='obs',
+                     help='Observation ID served (default: %default)')
+   parser.add_option('--start', action='store', type='int', dest='start',
+                     help='First gps second served (default: the observation ID)')
+   parser.add_option('--type', default=11, action='store', type='int', dest='filetype',
+                     help='File type downloaded (default: %default)')
+   parser.add_option('--seconds', default=4, action='store', type='int', dest='seconds',
+                     help='Seconds of data served (default: %default)')
+   parser.add_option('--scale', default=0.001, action='store', type='float', dest='scale',
+                     help='File sizes relative to the archive (default: %default)')
+   parser.add_option('--server-args', default='', action='store', dest='serverargs',
+                     help='Extra fakengas.py options, e.g. "--latency=0.05 --bandwidth=50"')
+   parser.add_option('--dir', action='store', dest='dir',
+                     help='Directory for the downloads (default: the system temporary directory)')
+   parser.add_option('--verify', default=False, action='store_true', dest='verify',
+                     help='Check the content of every downloaded file')
+   parser.add_option('--json', action='store', dest='json', help='Also write the results to this file')
+
+   (options, args) = parser.parse_args()
+
+   try:
+      parallels = [int(p) for p in options.parallel.split(',')]
+      bufsizes = [int(b) for b in options.bufsize.split(',')]
+   except ValueError:
+      print('--parallel and --bufsize take comma separated numbers')
+      sys.exit(-1)
+   engines = options.engine.split(',')
+
+   if options.verify:
+      sys.path.insert(0, SCRIPTS)
+
+   port = free_port()
+   workdir = tempfile.mkdtemp(prefix='voltbench_')
+   log = os.path.join(workdir, 'requests.log')
+   open(log, 'w').close()
+
+   server_args = ['--obs=%d' % options.obs, '--seconds=%d' % options.seconds, '--scale=%s' % options.scale,
+                  '--types=%d' % options.filetype] + options.serverargs.split()
+   if options.start is not None:
+      server_args.append('--start=%d' % options.start)
+
+   server = start_server(port, log, server_args)
+   results = []
+   try:
+      for parallel, bufsize, engine in itertools.product(parallels, bufsizes, engines):
+         for r in range(options.repeat):
+            logger.info('parallel %d, bufsize %d, engine %s, run %d' % (parallel, bufsize, engine, r + 1))
+            results.append(run_once(options, port, log, parallel, bufsize, engine))
+   finally:
+      server.terminate()
+      server.wait()
+      shutil.rmtree(workdir, ignore_errors=True)
+
+   print('%8s %8s %7s %5s %7s %8s %8s %8s %8s %8s %8s %6s' % ('parallel', 'bufsize', 'engine', 'exit',
+         'files', 'MB', 'MB/s', 'files/s', 'p50 s', 'p95 s', 'p99 s', 'fails'))
+   for r in results:
+      print('%8d %8d %7s %5d %7d %8.1f %8.1f %8.1f %8.3f %8.3f %8.3f %6d' % (r['parallel'], r['bufsize'],
+            r['engine'], r['exit'], r['files'], r['bytes'] / 1e6, r['mb_per_s'], r['files_per_s'],
+            r['p50'], r['p95'], r['p99'], r['failed_requests']))
+      if r['corrupt']:
+         print('%8s %d files differ from the served content' % ('', r['corrupt']))
+
+   if options.json:
+      with open(options.json, 'w') as f:
+         json.dump(results, f, indent=1)
+
+   if any(r['exit'] != 0 or r['corrupt'] for r in results):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+   main()
@@ -24,14 +24,31 @@ import sys
 import os
 import time
 import json
+import tempfile
 import threading
+import asyncio
+import socket
+import io
 import urllib.request
+import urllib.parse
+import http.client
 import base64
 import time
-import datetime
+import array
+import bisect
+import itertools
+import subprocess
+import shlex
 import calendar
+import random
+import heapq
+import hashlib
+import ctypes
+import tarfile
 from optparse import OptionParser
-from queue import Empty, Queue
+from queue import Empty
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 # set up the logger for stand-alone execution
@@ -55,10 +72,31 @@ else:
                    "Downloads will not be possible")
 
 
+FILE_LIMIT = 12000
+PART_SUFFIX = '.part'
+PARTIAL_AGE = 600
+MEMBERS_SUFFIX = '.members'
+META_URL = 'http://ws.mwatelescope.org/'
+META_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mwa-voltage')
+
 LOCK = threading.RLock()
 ERRORS = []
 COMPLETE = 0
 TOTAL_FILES = 0
+CONNECTIONS = 0
+REQUESTS = 0
+SECONDS = None
+METRICS = None
+CONTROLLER = None
+RETRIES = None
+HOSTS = None
+RECEIVED = 0
+READS = 0
+PREALLOCATE = True
+UNTAR = False
+# files downloaded on their own, which --untar leaves out of the archives
+UNTAR_SKIP = frozenset()
+TIMEOUT = 120
 
 sec_const = 315964784
 
@@ -79,13 +117,44 @@ def file_starting(filename):
    with LOCK:
       logging.info('Downloading %s' % (filename))
 
-def file_complete(filename):
+def file_complete(filename, downloaded = True):
    global COMPLETE
    global TOTAL_FILES
    with LOCK:
       COMPLETE = COMPLETE + 1
       logging.info('%s complete [%d of %d]' % (filename,
                                                   COMPLETE, TOTAL_FILES))
+   if SECONDS:
+      SECONDS.file_done(filename, downloaded)
+
+def transfer_done(download, error = None, retrying = False, fault = True):
+   if METRICS:
+      METRICS.record(download, error, retrying)
+   if CONTROLLER:
+      CONTROLLER.transfer_done(error)
+   if HOSTS and download.host:
+      HOSTS.finished(download, error, fault)
+
+def bytes_received(n):
+   global RECEIVED
+   global READS
+   with LOCK:
+      RECEIVED = RECEIVED + n
+      READS = READS + 1
+
+def connection_opened():
+   global CONNECTIONS
+   with LOCK:
+      CONNECTIONS = CONNECTIONS + 1
+
+def request_sent():
+   global REQUESTS
+   with LOCK:
+      REQUESTS = REQUESTS + 1
+
+def basic_auth(user, passwd):
+   # computed once per run and shared by every connection
+   return 'Basic %s' % base64.b64encode(('%s:%s' % (user, passwd)).encode()).decode()
 
 def split_raw_recombined(filename):
 
@@ -110,8 +179,8 @@ def split_raw_recombined(filename):
          chan = part[2]
          tm = int(part[3].split('.')[0])
 
-      dtm = datetime.datetime.utcfromtimestamp(int(tm))
-      gps = UTCToGPS(dtm.year, dtm.month, dtm.day, dtm.hour, dtm.minute, dtm.second)
+      # unix to gps seconds, same as UTCToGPS(utcfromtimestamp(tm))
+      gps = tm - sec_const
       return obsid, gps, chan
 
    except Exception as e:
@@ -166,6 +235,94 @@ def split_combined(filename):
       raise Exception('invalid combined filename %s' % file)
 
 
+# archive file types returned for each --type
+FILETYPES = {11: (11,), 12: (12,), 15: (15,), 16: (15, 16)}
+
+
+def product_key(filename, filetype):
+   # (gps second, lane) of a voltage product; lane is the vcs lane of raw
+   # files, the coarse channel of recombined files and -1 otherwise
+   try:
+      if filetype == 11:
+         obsid, second, vcs, part = split_raw_voltage(filename)
+         return second, int(vcs[3:])
+      elif filetype == 12:
+         obsid, second, chan = split_raw_recombined(filename)
+         return second, int(chan[2:])
+      elif filetype == 15:
+         return split_ics(filename)[1], -1
+      elif filetype == 16:
+         return split_combined(filename)[1], -1
+   except Exception:
+      pass
+   return -1, -1
+
+
+class ObservationCatalog(object):
+   """
+   The files of one observation in compact arrays sorted by gps second.
+
+   Filenames are parsed once when the catalog is built. Time ranges are
+   found by bisection on the second array; file type, lane/channel and
+   archive state are then tested only inside that range. Files whose name
+   can not be parsed get second -1 and sort first.
+   """
+
+   ARCHIVED = 1
+   DELETED = 2
+
+   def __init__(self, files):
+      rows = []
+      for f, v in files.items():
+         ft = int(v['filetype'])
+         second, lane = product_key(f, ft)
+         state = 0
+         if v.get('remote_archived'):
+            state |= self.ARCHIVED
+         if v.get('deleted'):
+            state |= self.DELETED
+         rows.append((second, ft, lane, f, int(v['size']), state))
+      rows.sort()
+
+      self.names = [r[3] for r in rows]
+      self.gps = array.array('q', [r[0] for r in rows])
+      self.filetype = array.array('b', [r[1] for r in rows])
+      self.lane = array.array('h', [r[2] for r in rows])
+      self.size = array.array('q', [r[4] for r in rows])
+      self.state = array.array('b', [r[5] for r in rows])
+      self.unparsed = bisect.bisect_left(self.gps, 0)
+
+   def __len__(self):
+      return len(self.names)
+
+   def span(self, start = None, end = None):
+      """Index range of the files with start <= second < end."""
+      lo = 0 if start is None else bisect.bisect_left(self.gps, start)
+      hi = len(self.gps) if end is None else bisect.bisect_left(self.gps, end)
+      return lo, max(lo, hi)
+
+   def select(self, start = None, end = None, filetypes = None, lanes = None, available = False):
+      """
+      Indexes of the files in [start, end) matching the given file types and
+      lanes/channels. available keeps only archived files that are not deleted.
+      """
+      lo, hi = self.span(start, end)
+      result = []
+      for i in range(lo, hi):
+         if filetypes is not None and self.filetype[i] not in filetypes:
+            continue
+         if lanes is not None and self.lane[i] not in lanes:
+            continue
+         if available and self.state[i] != self.ARCHIVED:
+            continue
+         result.append(i)
+      return result
+
+   def files(self, *args, **kwargs):
+      """{filename: size} of the selected files."""
+      return dict((self.names[i], self.size[i]) for i in self.select(*args, **kwargs))
+
+
 def getmeta(servicetype='metadata', service='obs', params=None):
     """
     Function to call a JSON web service and return a dictionary:
@@ -177,7 +334,7 @@ def getmeta(servicetype='metadata', service='obs', params=None):
     import json
 
     # Append the service name to this base URL, eg 'con', 'obs', etc.
-    BASEURL = 'http://ws.mwatelescope.org/'
+    BASEURL = META_URL
 
 
     if params:
@@ -198,56 +355,124 @@ def getmeta(servicetype='metadata', service='obs', params=None):
     return result
 
 
-def query_observation(obs, host, filetype, timefrom, duration):
+def meta_cache_dir(cache_dir):
+   # each metadata service, e.g. a local fakengas.py, gets its own entries
+   return os.path.join(cache_dir, hashlib.sha1(META_URL.encode('utf8')).hexdigest())
+
+
+def meta_cache_path(cache_dir, obs, mintime, maxtime):
+   if mintime is None:
+      return os.path.join(cache_dir, '%s.json' % obs)
+   return os.path.join(cache_dir, '%s_%d_%d.json' % (obs, mintime, maxtime))
+
+
+def meta_cache_load(cache_dir, obs, mintime, maxtime, ttl):
+   """
+   Return the cached data_files result for an observation and time window.
+
+   An exact entry is used first; otherwise any fresh entry of the same
+   observation whose window covers the request is filtered down to it.
+   Returns None when nothing usable is cached.
+   """
+   cache_dir = meta_cache_dir(cache_dir)
+   if not os.path.isdir(cache_dir):
+      return None
+
+   exact = meta_cache_path(cache_dir, obs, mintime, maxtime)
+   candidates = [exact]
+   for name in sorted(os.listdir(cache_dir)):
+      path = os.path.join(cache_dir, name)
+      if path != exact and name.endswith('.json') and \
+         (name == '%s.json' % obs or name.startswith('%s_' % obs)):
+         candidates.append(path)
+
+   now = time.time()
+   for path in candidates:
+      try:
+         with open(path) as f:
+            entry = json.load(f)
+      except (OSError, ValueError):
+         continue
+
+      if now - entry['fetched'] > ttl:
+         continue
+
+      if path == exact:
+         return entry['files']
+
+      if entry['mintime'] is not None:
+         if mintime is None or mintime < entry['mintime'] or maxtime > entry['maxtime']:
+            continue
+
+      # wider window: keep the files in [mintime, maxtime) as the archive would
+      catalog = ObservationCatalog(entry['files'])
+      if catalog.unparsed:
+         continue
+
+      lo, hi = catalog.span(mintime, maxtime)
+      return dict((f, entry['files'][f]) for f in catalog.names[lo:hi])
+
+   return None
+
+
+def meta_cache_store(cache_dir, obs, mintime, maxtime, files):
+   cache_dir = meta_cache_dir(cache_dir)
+   try:
+      if not os.path.isdir(cache_dir):
+         os.makedirs(cache_dir)
+
+      # write and rename so concurrent jobs never see half an entry
+      fd, tmp = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+      with os.fdopen(fd, 'w') as f:
+         json.dump({'obs': obs, 'mintime': mintime, 'maxtime': maxtime,
+                    'fetched': time.time(), 'files': files}, f)
+      os.replace(tmp, meta_cache_path(cache_dir, obs, mintime, maxtime))
+
+   except OSError as e:
+      logger.warning('Could not write metadata cache: %s' % str(e))
+
+
+def query_catalog(obs, timefrom, duration, cache_dir = None, ttl = 0, refresh = False):
 
    processRange = False
    if timefrom != None and duration != None:
       processRange = True
 
-   files = getmeta(service='data_files', params={'obs_id':obs, 'nocache':1, 'mintime':timefrom, 'maxtime':timefrom + duration + 1})
-   keymap = {}
+   params = {'obs_id':obs, 'nocache':1}
+   mintime = None
+   maxtime = None
    if processRange:
-      second = None
-      for f, v in files.items():
-         ft = v['filetype']
-         size = v['size']
-         add = False
-         deleted = v['deleted']
-         remote_archived = v["remote_archived"]
-         if filetype == 11 and ft == 11:
-            obsid, second, vcs, part = split_raw_voltage(f)
-            add = True
-         elif filetype == 12 and ft == 12:
-               obsid, second, chan = split_raw_recombined(f)
-               add = True
-         elif filetype == 15 and ft == 15:
-            obsid, second = split_ics(f)
-            add = True
-         elif filetype == 16:
-            if ft == 16:
-               obsid, second = split_combined(f)
-               add = True
-            elif ft == 15:
-               obsid, second = split_ics(f)
-               add = True
-
-         if add and remote_archived and not deleted:
-               keymap[f] = size
+      mintime = timefrom
+      maxtime = timefrom + duration + 1
+      params['mintime'] = mintime
+      params['maxtime'] = maxtime
 
-   else:
-      for f, v in files.items():
-         ft = v['filetype']
-         size = v['size']
-         if filetype == 11 and ft == 11:
-            keymap[f] = size
-         elif filetype == 12 and ft == 12:
-            keymap[f] = size
-         elif filetype == 15 and ft == 15:
-            keymap[f] = size
-         elif filetype == 16 and (ft == 15 or ft == 16):
-            keymap[f] = size
+   files = None
+   if cache_dir and ttl > 0 and not refresh:
+      files = meta_cache_load(cache_dir, obs, mintime, maxtime, ttl)
+      if files is not None:
+         logger.info('Using cached metadata for observation %s' % obs)
+
+   if files is None:
+      files = getmeta(service='data_files', params=params)
+      if files is None:
+         raise Exception('Metadata query for observation %s failed' % obs)
+      if cache_dir:
+         meta_cache_store(cache_dir, obs, mintime, maxtime, files)
 
-   return keymap
+   return ObservationCatalog(files)
+
+
+def query_observation(obs, host, filetype, timefrom, duration, cache_dir = None, ttl = 0, refresh = False):
+
+   processRange = False
+   if timefrom != None and duration != None:
+      processRange = True
+
+   catalog = query_catalog(obs, timefrom, duration, cache_dir, ttl, refresh)
+
+   # a time range only returns archived files that have not been deleted
+   return catalog.files(filetypes = FILETYPES.get(filetype, ()), available = processRange)
 
 
 
@@ -263,67 +488,1643 @@ def check_complete(filename, size, dir):
     return False
 
 
-def download_queue_thread(queue):
-   while not queue.empty():
+def check_extracted(filename, size, dir):
+    # a tar extracted by --untar is complete when its manifest and members are
+    try:
+        with open(dir + filename + MEMBERS_SUFFIX) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if manifest.get('size') != int(size):
+        return False
+    for name, member_size in manifest['members'].items():
+        if not check_complete(name, member_size, dir):
+            return False
+    return True
+
+
+def is_complete(filename, size, dir):
+    if UNTAR and filename.endswith('.tar'):
+        return check_extracted(filename, size, dir)
+    return check_complete(filename, size, dir)
+
+
+def partial_size(filename, size, dir):
+    # number of bytes of an interrupted download that can be kept and resumed from
+    path = dir + filename + PART_SUFFIX
+
+    if os.path.isfile(path) is True:
+        filesize = os.stat(path).st_size
+        if filesize < int(size):
+            return filesize
+    return 0
+
+
+def sweep_partials(dir, age = PARTIAL_AGE, keep = ()):
+    """
+    Remove the partial files of earlier runs from the output directory.
+    Files written to in the last age seconds are left alone, in case another
+    download is still working on them, as are the partial files of the names
+    in keep, which this run resumes. Returns the number removed.
+    """
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(dir):
+        if not entry.name.endswith(PART_SUFFIX) or not entry.is_file():
+            continue
+        if entry.name[:-len(PART_SUFFIX)] in keep:
+            continue
+        try:
+            if now - entry.stat().st_mtime > age:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning('Could not remove %s: %s' % (entry.path, str(e)))
+    return removed
+
+
+def content_range_start(content_range):
+    # 'bytes 1024-2047/2048' -> 1024
+    try:
+        unit, span = content_range.split(' ', 1)
+        if unit != 'bytes':
+            return None
+        return int(span.split('-', 1)[0])
+    except Exception:
+        return None
+
+
+def content_length(headers):
+    # None for a chunked reply, whose size is only checked against the catalogue
+    length = headers['Content-Length']
+    return int(length) if length is not None else None
+
+
+class TransferError(Exception):
+   """
+   A failed transfer and whether trying again can help: 'staging' when the
+   archive is still bringing the file online, 'transient' for server and
+   network failures, 'permanent' otherwise.
+   """
+
+   def __init__(self, message, kind = 'permanent', status = None):
+      Exception.__init__(self, message)
+      self.kind = kind
+      self.status = status
+
+
+def http_error(status, body):
+   # NGAS answers 503 while a file is being staged from tape
+   text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else str(body)
+   if status == 503 or 'stag' in text.lower():
+      kind = 'staging'
+   elif status in (408, 429, 500, 502, 504):
+      kind = 'transient'
+   else:
+      kind = 'permanent'
+   return TransferError(str(body), kind, status)
+
+
+def error_kind(exp):
+   if isinstance(exp, TransferError):
+      return exp.kind
+   if isinstance(exp, (ConnectionError, socket.timeout, TimeoutError, asyncio.TimeoutError,
+                       http.client.HTTPException, EOFError)):
+      return 'transient'
+   return 'permanent'
+
+
+def host_fault(exp):
+   # whether a failure says something about the host it came from: a
+   # broken or silent connection or a 5xx does, a 404 or a full disk not
+   if isinstance(exp, TransferError):
+      if exp.status is not None:
+         return exp.status >= 500
+      return exp.kind == 'transient'
+   return error_kind(exp) == 'transient'
+
+
+class TransferMetrics(object):
+   """
+   Per file and aggregate transfer statistics for monitoring.
+
+   Every finished or failed file gives one record with its time to first
+   byte, duration, bytes and MB/s. A background thread writes the new
+   records plus a progress line to a JSON lines file, and the running
+   totals with the rolling throughput to a Prometheus textfile collector
+   file, every interval seconds.
+   """
+
+   def __init__(self, obs, json_path = None, prom_path = None, interval = 10, window = 60):
+      self.obs = str(obs)
+      self.json_path = json_path
+      self.prom_path = prom_path
+      self.interval = interval
+      self.window = window
+      self.lock = threading.Lock()
+      self.records = []
+      self.files = {'complete': 0, 'error': 0, 'retry': 0}
+      self.hosts = {}
+      self.started = time.time()
+      self.samples = deque([(self.started, 0)])
+      self.stopping = threading.Event()
+      self.thread = None
+      self.f = open(json_path, 'a') if json_path else None
+
+   def record(self, download, error = None, retrying = False):
+      now = time.time()
+      transferred = download.received - download.resumed
+      duration = now - download.started
+      ttfb = download.first_byte - download.started if download.first_byte else None
+      entry = {'type': 'file', 'time': now, 'obs': self.obs, 'file': download.filename,
+               'host': download.host, 'attempt': download.attempt,
+               'status': ('retry' if retrying else 'error') if error else 'complete',
+               'bytes': transferred, 'ttfb': ttfb, 'duration': duration,
+               'mb_per_s': transferred / duration / 1e6 if duration > 0 else 0.0,
+               'resumed_from': download.resumed, 'reads': download.reads,
+               'bytes_per_read': transferred // download.reads if download.reads else 0, 'error': error}
+
+      with self.lock:
+         self.records.append(entry)
+         self.files[entry['status']] += 1
+         # files, errors, bytes, ttfb sum, ttfb count, duration sum
+         host = self.hosts.setdefault(download.host, [0, 0, 0, 0.0, 0, 0.0])
+         host[0] += 1
+         host[1] += 1 if error else 0
+         host[2] += transferred
+         if ttfb is not None:
+            host[3] += ttfb
+            host[4] += 1
+         host[5] += duration
+
+   def throughput(self, now, total):
+      # bytes per second over the last window, from the totals seen at each flush
+      self.samples.append((now, total))
+      while len(self.samples) > 1 and now - self.samples[0][0] > self.window:
+         self.samples.popleft()
+      then, before = self.samples[0]
+      if now <= then:
+         return 0.0
+      return (total - before) / (now - then)
+
+   def flush(self):
+      now = time.time()
+      with self.lock:
+         records = self.records
+         self.records = []
+         files = dict(self.files)
+         hosts = dict((h, list(v)) for h, v in self.hosts.items())
+      with LOCK:
+         expected = TOTAL_FILES
+         total = RECEIVED
+         reads = READS
+      rate = self.throughput(now, total)
+
+      if self.f:
+         for entry in records:
+            self.f.write(json.dumps(entry) + '\n')
+         self.f.write(json.dumps({'type': 'progress', 'time': now, 'obs': self.obs, 'elapsed': now - self.started,
+                                  'files_total': expected, 'files_complete': files['complete'],
+                                  'files_error': files['error'], 'files_retry': files['retry'],
+                                  'bytes': total, 'reads': reads,
+                                  'bytes_per_read': total // reads if reads else 0,
+                                  'mb_per_s': rate / 1e6}) + '\n')
+         self.f.flush()
+
+      if self.prom_path:
+         self.write_prom(now, total, reads, files, hosts, expected, rate)
+
+   def write_prom(self, now, total, reads, files, hosts, expected, rate):
+      obs = 'obs="%s"' % self.obs
+      by_host = sorted(hosts.items())
+      host = lambda h: '%s,host="%s"' % (obs, h)
+      lines = []
+
+      def metric(name, kind, text, samples):
+         # samples are (metric name suffix, labels, value)
+         lines.append('# HELP %s %s' % (name, text))
+         lines.append('# TYPE %s %s' % (name, kind))
+         for suffix, labels, value in samples:
+            lines.append('%s%s{%s} %r' % (name, suffix, labels, float(value)))
+
+      metric('mwa_voltdownload_bytes_total', 'counter', 'Bytes received.', [('', obs, total)])
+      metric('mwa_voltdownload_reads_total', 'counter', 'Socket reads that returned data.', [('', obs, reads)])
+      metric('mwa_voltdownload_files_total', 'counter', 'Transfer attempts finished by status.',
+             [('', '%s,status="%s"' % (obs, status), n) for status, n in sorted(files.items())])
+      metric('mwa_voltdownload_files_expected', 'gauge', 'Files to download.', [('', obs, expected)])
+      metric('mwa_voltdownload_throughput_bytes_per_second', 'gauge',
+             'Rolling throughput over the last %d seconds.' % self.window, [('', obs, rate)])
+      metric('mwa_voltdownload_host_bytes_total', 'counter', 'Bytes of finished files per NGAS host.',
+             [('', host(h), v[2]) for h, v in by_host])
+      metric('mwa_voltdownload_host_errors_total', 'counter', 'Failed transfer attempts per NGAS host.',
+             [('', host(h), v[1]) for h, v in by_host])
+      metric('mwa_voltdownload_ttfb_seconds', 'summary', 'Time to first byte per NGAS host.',
+             [s for h, v in by_host for s in (('_sum', host(h), v[3]), ('_count', host(h), v[4]))])
+      metric('mwa_voltdownload_transfer_seconds', 'summary', 'Transfer time per NGAS host.',
+             [s for h, v in by_host for s in (('_sum', host(h), v[5]), ('_count', host(h), v[0]))])
+      metric('mwa_voltdownload_last_update_timestamp_seconds', 'gauge', 'Time of this update.',
+             [('', obs, now)])
+
+      # the collector must never read half a file
+      try:
+         dir = os.path.dirname(os.path.abspath(self.prom_path))
+         fd, tmp = tempfile.mkstemp(dir = dir, suffix = '.tmp')
+         with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+         os.chmod(tmp, 0o644)
+         os.replace(tmp, self.prom_path)
+      except OSError as e:
+         logger.warning('Could not write metrics: %s' % str(e))
+
+   def run(self):
+      while not self.stopping.wait(self.interval):
+         self.flush()
+
+   def start(self):
+      self.thread = threading.Thread(target = self.run)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      self.stopping.set()
+      if self.thread:
+         self.thread.join()
+      self.flush()
+      if self.f:
+         self.f.close()
+         self.f = None
+
+
+class ConcurrencyController(object):
+   """
+   Chooses the number of simultaneous downloads for --parallel=auto.
+
+   The engines start the maximum number of workers and each one takes a
+   slot before fetching a file, so only limit of them transfer at a time;
+   the prestage downloads take slots too. With a fixed --parallel the
+   controller is not started and only hands out the slots.
+   Every interval the aggregate throughput is measured: the limit is raised
+   by one while that keeps throughput rising by at least GAIN, put back
+   when the extra stream did not help, and halved when more than
+   ERROR_RATIO of the transfers that ended in the interval failed, so an
+   odd 503 or dropped connection that a retry gets past does not shrink
+   it. After a step down the limit is held for HOLD intervals before
+   probing upwards again.
+   """
+
+   GAIN = 0.05
+   HOLD = 3
+   ERROR_RATIO = 0.25
+
+   def __init__(self, minimum, maximum, interval, start = 2):
+      self.minimum = minimum
+      self.maximum = maximum
+      self.interval = interval
+      self.limit = max(minimum, min(maximum, start))
+      self.active = 0
+      self.transfers = 0
+      self.errors = 0
+      self.baseline = None
+      self.probing = False
+      self.hold = 0
+      self.cond = threading.Condition()
+      self.stopping = threading.Event()
+      self.thread = None
+
+   def acquire(self, queue):
+      # wait for a slot; False once the queue has nothing left to take
+      with self.cond:
+         while self.active >= self.limit:
+            if not work_left(queue):
+               return False
+            self.cond.wait(0.25)
+         self.active += 1
+         return True
+
+   async def acquire_async(self, queue):
+      # the limit changes from another thread, so parked tasks poll it
+      while True:
+         with self.cond:
+            if self.active < self.limit:
+               self.active += 1
+               return True
+         if not work_left(queue):
+            return False
+         await asyncio.sleep(0.05)
+
+   def release(self):
+      with self.cond:
+         self.active -= 1
+         self.cond.notify()
+
+   def transfer_done(self, error):
+      with self.cond:
+         self.transfers += 1
+         if error:
+            self.errors += 1
+
+   def step(self, rate, errors, transfers):
+      """
+      New limit and the reason for it after an interval at rate bytes/s in
+      which errors of transfers failed.
+      """
+      limit = self.limit
+      if errors > transfers * self.ERROR_RATIO:
+         self.baseline = None
+         self.probing = False
+         self.hold = self.HOLD
+         return max(self.minimum, limit // 2), '%d of %d transfers failed' % (errors, transfers)
+
+      if self.hold > 0:
+         self.hold -= 1
+         self.baseline = rate
+         return limit, None
+
+      if self.probing and self.baseline is not None and rate < self.baseline * (1 + self.GAIN):
+         self.probing = False
+         self.hold = self.HOLD
+         return max(self.minimum, limit - 1), 'flat throughput %.1f MB/s' % (rate / 1e6)
+
+      self.baseline = rate
+      if limit >= self.maximum:
+         self.probing = False
+         return limit, None
+      self.probing = True
+      return limit + 1, 'throughput %.1f MB/s' % (rate / 1e6)
+
+   def run(self):
+      with LOCK:
+         last = RECEIVED
+      then = time.time()
+      while not self.stopping.wait(self.interval):
+         now = time.time()
+         with LOCK:
+            total = RECEIVED
+         with self.cond:
+            errors, transfers = self.errors, self.transfers
+            self.errors = self.transfers = 0
+         rate = (total - last) / (now - then)
+         last, then = total, now
+
+         limit, reason = self.step(rate, errors, transfers)
+         if limit != self.limit:
+            logger.info('Parallel downloads %d -> %d (%s)' % (self.limit, limit, reason))
+            with self.cond:
+               self.limit = limit
+               self.cond.notify_all()
+
+   def start(self):
+      logger.info('Parallel downloads auto: starting at %d, between %d and %d' %
+                  (self.limit, self.minimum, self.maximum))
+      self.thread = threading.Thread(target = self.run)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      self.stopping.set()
+      if self.thread:
+         self.thread.join()
+
+
+class HostPool(object):
+   """
+   Spreads downloads over several NGAS front ends.
+
+   Each host keeps moving averages of the per stream transfer rate, time
+   to first byte and error rate of its recent files. A new file goes to
+   the host expected to finish it soonest, (streams in flight + 1) / (rate
+   * (1 - error rate)), with hosts not yet measured assumed as fast as the
+   best one so they get tried. After FAILURES failures in a row a host is
+   taken out for a cool down that doubles each time, up to COOLDOWN_MAX
+   seconds. Only failures of the host count (see host_fault); a file the
+   archive does not have leaves its health alone. A retry is sent to a
+   different host when there is one.
+   """
+
+   ALPHA = 0.3
+   FAILURES = 3
+   COOLDOWN = 10
+   COOLDOWN_MAX = 300
+
+   class Host(object):
+      def __init__(self, name):
+         self.name = name
+         self.active = 0
+         self.files = 0
+         self.errors = 0
+         self.bytes = 0
+         self.seconds = 0.0
+         self.rate = None
+         self.ttfb = None
+         self.error_rate = 0.0
+         self.failures = 0
+         self.cooldowns = 0
+         self.down_until = 0
+
+   def __init__(self, hosts):
+      self.lock = threading.Lock()
+      self.hosts = [self.Host(h) for h in hosts]
+      self.byname = dict((h.name, h) for h in self.hosts)
+
+   def average(self, old, new):
+      return new if old is None else old + self.ALPHA * (new - old)
+
+   def pick(self, avoid = None):
+      """Name of the host for the next file, counted as in flight until finished."""
+      now = time.time()
+      with self.lock:
+         candidates = [h for h in self.hosts if h.down_until <= now]
+         if not candidates:
+            candidates = [min(self.hosts, key = lambda h: h.down_until)]
+         if len(candidates) > 1:
+            candidates = [h for h in candidates if h.name != avoid] or candidates
+
+         rates = [h.rate for h in candidates if h.rate]
+         best = max(rates) if rates else 1.0
+         host = min(candidates, key = lambda h: (h.active + 1) /
+                                                 ((h.rate or best) * max(0.05, 1.0 - h.error_rate)))
+         host.active += 1
+         return host.name
+
+   def finished(self, download, error = None, fault = True):
+      now = time.time()
+      with self.lock:
+         host = self.byname.get(download.host)
+         if host is None:
+            return
+         host.active -= 1
+         host.files += 1
+         elapsed = now - download.started
+         transferred = download.received - download.resumed
+         host.bytes += transferred
+         host.seconds += elapsed
+
+         if error:
+            if not fault:
+               return
+            host.errors += 1
+            host.failures += 1
+            host.error_rate = self.average(host.error_rate, 1.0)
+            if host.failures >= self.FAILURES and host.down_until <= now:
+               cooldown = min(self.COOLDOWN_MAX, self.COOLDOWN * 2 ** host.cooldowns)
+               host.cooldowns += 1
+               host.down_until = now + cooldown
+               logger.warning('NGAS host %s taken out for %ds after %d failures in a row'
+                              % (host.name, cooldown, host.failures))
+            return
+
+         host.failures = 0
+         host.cooldowns = 0
+         host.error_rate = self.average(host.error_rate, 0.0)
+         if elapsed > 0:
+            host.rate = self.average(host.rate, transferred / elapsed)
+         if download.first_byte:
+            host.ttfb = self.average(host.ttfb, download.first_byte - download.started)
+
+   def summary(self):
+      with self.lock:
+         for h in self.hosts:
+            logger.info('NGAS host %s: %d files, %.1f MB, %.1f MB/s per stream, %s ms to first byte, %d errors'
+                        % (h.name, h.files, h.bytes / 1e6, (h.rate or 0) / 1e6,
+                           '%.0f' % (h.ttfb * 1000) if h.ttfb is not None else '-', h.errors))
+
+
+def pick_host(netloc, attempt):
+   # the NGAS host for a request; a retry avoids the host named in its url
+   if not HOSTS:
+      return netloc
+   return HOSTS.pick(netloc if attempt > 1 else None)
+
+
+class RetryScheduler(object):
+   """
+   Puts failed files back after a jittered exponential backoff.
+
+   A file may be retried up to retries times and the whole job up to
+   budget times. The delay before attempt n + 1 is drawn between half and
+   all of base * 2^n, capped at cap; staging errors start four times higher
+   since the archive needs time to bring the file online. Permanent errors
+   (e.g. 404) are never retried. Waiting files are held in a heap and only
+   handed out once due, after the files not yet tried, to the queue whose
+   window they belong to.
+   """
+
+   FACTOR = {'staging': 4, 'transient': 1}
+
+   def __init__(self, retries, budget, base, cap):
+      self.retries = retries
+      self.budget = budget
+      self.base = base
+      self.cap = cap
+      self.lock = threading.Lock()
+      self.heap = []
+      self.seq = itertools.count()
+      self.attempts = {}
+      self.used = 0
+
+   def failed(self, item, exp):
+      """Schedule item again; returns the delay, or None if it is not retried."""
+      kind = error_kind(exp)
+      filename = item[1]
+      with self.lock:
+         n = self.attempts.get(filename, 0)
+         if kind not in self.FACTOR or n >= self.retries or self.used >= self.budget:
+            return None
+         self.attempts[filename] = n + 1
+         self.used += 1
+         delay = min(self.cap, self.base * self.FACTOR[kind] * 2 ** n) * random.uniform(0.5, 1.0)
+         heapq.heappush(self.heap, (time.time() + delay, next(self.seq), item))
+      return delay
+
+   def pending(self, queue):
+      with self.lock:
+         return sum(1 for entry in self.heap if entry[2][1] in queue)
+
+   def pop_due(self, queue):
+      """(item, None) when one of queue is due, else (None, seconds until the next or None)."""
+      with self.lock:
+         entries = [entry for entry in self.heap if entry[2][1] in queue]
+         if not entries:
+            return None, None
+         entry = min(entries)
+         wait = entry[0] - time.time()
+         if wait > 0:
+            return None, wait
+         self.heap.remove(entry)
+         heapq.heapify(self.heap)
+         return entry[2], None
+
+
+def work_left(queue):
+   return not queue.empty() or (RETRIES is not None and RETRIES.pending(queue) > 0)
+
+
+def take_item(queue):
+   # a new file first, then a retry that is due: (item, None), or (None,
+   # seconds to wait for the next retry), or (None, None) when all is done
+   try:
+      return queue.get_nowait(), None
+   except Empty:
+      pass
+   if RETRIES:
+      return RETRIES.pop_due(queue)
+   return None, None
+
+
+def transfer_failed(download, item, exp):
+   if download.host:
+      # remember the host that failed so the retry goes elsewhere
+      item = (urllib.parse.urlsplit(item[0])._replace(netloc = download.host).geturl(),) + tuple(item[1:])
+   delay = RETRIES.failed(item, exp) if RETRIES else None
+   transfer_done(download, str(exp), delay is not None, host_fault(exp))
+   if delay is None:
+      file_error('%s %s' % (download.filename, str(exp)))
+   else:
+      logging.warning('%s %s, retry %d in %.1fs' % (download.filename, str(exp), download.attempt, delay))
+
+
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+
+def preallocate(fd, offset, length):
+   """
+   Reserve the disk blocks of length bytes from offset so parallel
+   filesystems can lay the file out contiguously. The file size is left
+   alone (FALLOC_FL_KEEP_SIZE), so an interrupted download still looks
+   short to check_complete and --resume. Returns False where fallocate is
+   not available.
+   """
+   global _fallocate
+   if length <= 0:
+      return False
+   if _fallocate is None:
       try:
-         item = queue.get(timeout = 1)
-         download_worker(*item)
-      except Empty:
+         func = ctypes.CDLL(None, use_errno = True).fallocate
+         func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+         func.restype = ctypes.c_int
+         _fallocate = func
+      except (OSError, AttributeError):
+         _fallocate = False
+   if not _fallocate:
+      return False
+   return _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class FileDownload(object):
+   """
+   Writes one archive file into the output directory as its bytes arrive.
+
+   The thread and asyncio engines only move bytes over the network; ranges,
+   append versus overwrite and the final size check are decided here so both
+   engines leave the same files behind. Bytes go to <filename>.part, which
+   is renamed to the final name only once its size has been checked, so a
+   file under its own name is always complete.
+   """
+
+   def __init__(self, filename, size, out, resume = False):
+      self.filename = filename
+      self.size = int(size)
+      self.out = out
+      self.path = out + filename
+      self.part = self.path + PART_SUFFIX
+      self.offset = partial_size(filename, size, out) if resume else 0
+      self.expected = 0
+      self.received = 0
+      self.resumed = 0
+      self.reads = 0
+      self.f = None
+      self.host = None
+      self.attempt = RETRIES.attempts.get(filename, 0) + 1 if RETRIES else 1
+      self.started = time.time()
+      self.first_byte = None
+
+   def request_headers(self, prestage):
+      headers = {}
+      if prestage:
+         headers['prestagefilelist'] = prestage
+      if self.offset > 0:
+         headers['Range'] = 'bytes=%d-' % self.offset
+      return headers
+
+   def begin(self, status, headers):
+      self.first_byte = time.time()
+      self.expected = content_length(headers)
+      mode = 'wb'
+
+      if self.offset > 0:
+         if status == 206 and content_range_start(headers['Content-Range']) == self.offset:
+            # append the remaining bytes to what we already have
+            logging.info('Resuming %s from byte %d' % (self.filename, self.offset))
+            mode = 'ab'
+            if self.expected is not None:
+               self.expected += self.offset
+            self.received = self.offset
+            self.resumed = self.offset
+         else:
+            logging.warning('Range ignored for %s, fetching whole file' % (self.filename))
+
+      # unbuffered: the engines already hand over large chunks
+      self.f = open(self.part, mode, buffering = 0)
+      if PREALLOCATE:
+         length = self.size if self.expected is None else self.expected
+         preallocate(self.f.fileno(), self.received, length - self.received)
+
+   def write(self, buff):
+      view = memoryview(buff)
+      while view:
+         view = view[self.f.write(view):]
+      self.count(len(buff))
+
+   def count(self, n):
+      self.received += n
+      self.reads += 1
+      bytes_received(n)
+
+   def finish(self):
+      self.close()
+      if self.expected is not None and self.received != self.expected:
+         raise TransferError('size mismatch %s %s' % (str(self.expected), str(self.received)), 'transient')
+      if self.received != self.size:
+         raise TransferError('size mismatch %s %s' % (str(self.size), str(self.received)), 'transient')
+      os.replace(self.part, self.path)
+
+   def close(self):
+      if self.f:
+         self.f.close()
+         self.f = None
+
+
+class TarExtractor(object):
+   """
+   Unpacks a tar archive from a stream of byte chunks.
+
+   Headers are parsed with tarfile.TarInfo.frombuf as soon as their 512
+   byte block has arrived and member data is written straight to a .part
+   file in the output directory, renamed once the member has all of its
+   bytes. Members are stored under their base name. GNU long names
+   and pax path/size records are honoured; anything but regular files is
+   skipped, as are members in UNTAR_SKIP, which are downloads of their own
+   that would otherwise race the member for the same path.
+   """
+
+   def __init__(self, out, archive):
+      self.out = out
+      self.archive = archive
+      self.header = bytearray()
+      self.remaining = 0
+      self.padding = 0
+      self.ended = False
+      self.zeros = 0
+      self.members = {}
+      self.f = None
+      self.name = None
+      self.part = None
+      self.size = 0
+      self.meta = None
+      self.meta_type = None
+      self.longname = None
+      self.pax = {}
+
+   def feed(self, buff):
+      view = memoryview(buff)
+      while view:
+         if self.remaining:
+            n = min(self.remaining, len(view))
+            self.data(view[:n])
+            view = view[n:]
+            self.remaining -= n
+            if not self.remaining:
+               self.end_member()
+         elif self.padding:
+            n = min(self.padding, len(view))
+            view = view[n:]
+            self.padding -= n
+         elif self.ended:
+            # the zero blocks that pad the end of the archive
+            return
+         else:
+            n = min(tarfile.BLOCKSIZE - len(self.header), len(view))
+            self.header += view[:n]
+            view = view[n:]
+            if len(self.header) == tarfile.BLOCKSIZE:
+               block = bytes(self.header)
+               self.header = bytearray()
+               self.begin_member(block)
+
+   def begin_member(self, block):
+      if block == tarfile.NUL * tarfile.BLOCKSIZE:
+         self.zeros += 1
+         self.ended = self.zeros == 2
          return
-      
-def download_worker(url, filename, size, out, bufsize, prestage):
+      self.zeros = 0
+
+      try:
+         info = tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+      except tarfile.HeaderError as e:
+         raise TransferError('%s: bad tar header: %s' % (self.archive, str(e)), 'transient')
+
+      size = info.size
+      self.padding = -size % tarfile.BLOCKSIZE
+
+      if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+         self.meta = bytearray()
+         self.meta_type = info.type
+      elif info.isreg():
+         name = self.longname or self.pax.get('path') or info.name
+         if 'size' in self.pax:
+            size = int(self.pax['size'])
+            self.padding = -size % tarfile.BLOCKSIZE
+         self.longname = None
+         self.pax = {}
+
+         self.name = os.path.basename(name)
+         if self.name in ('', '.', '..'):
+            raise TransferError('%s: bad member name %s' % (self.archive, name))
+         if self.name not in UNTAR_SKIP:
+            self.part = self.out + self.name + '.untar' + PART_SUFFIX
+            self.f = open(self.part, 'wb', buffering = 0)
+            if PREALLOCATE:
+               preallocate(self.f.fileno(), 0, size)
+      else:
+         self.longname = None
+         self.pax = {}
+
+      self.size = size
+      self.remaining = size
+      if not size:
+         self.end_member()
+
+   def data(self, view):
+      if self.f:
+         while view:
+            view = view[self.f.write(view):]
+      elif self.meta is not None:
+         self.meta += view
+
+   def end_member(self):
+      if self.f:
+         self.f.close()
+         self.f = None
+         os.replace(self.part, self.out + self.name)
+         self.members[self.name] = self.size
+      elif self.meta is not None:
+         if self.meta_type == tarfile.GNUTYPE_LONGNAME:
+            self.longname = bytes(self.meta).rstrip(tarfile.NUL).decode(tarfile.ENCODING, 'surrogateescape')
+         else:
+            self.pax = self.pax_records(bytes(self.meta))
+         self.meta = None
+
+   def pax_records(self, data):
+      # "<length> <key>=<value>\n" records, length counting the whole record
+      records = {}
+      while data:
+         length, _, _ = data.partition(b' ')
+         try:
+            length = int(length)
+         except ValueError:
+            break
+         record = data[:length].split(b' ', 1)[1].rstrip(b'\n')
+         key, _, value = record.partition(b'=')
+         records[key.decode('utf-8', 'replace')] = value.decode('utf-8', 'surrogateescape')
+         data = data[length:]
+      return records
+
+   def finish(self):
+      if self.remaining or self.header or self.meta is not None:
+         raise TransferError('%s: tar stream ended inside a member' % self.archive, 'transient')
+
+   def close(self):
+      # drop a member left half written by a failed transfer
+      if self.f:
+         self.f.close()
+         self.f = None
+         try:
+            os.remove(self.part)
+         except OSError:
+            pass
+
+
+class TarDownload(FileDownload):
+   """
+   A combined .tar product unpacked into the output directory while it
+   downloads (--untar) instead of being stored. The archive is written
+   nowhere; once it has been read to the end with the right size the list
+   of its members is saved as <filename>.members, which is what marks it
+   complete. Always fetched from the start.
+   """
+
+   def __init__(self, filename, size, out, resume = False):
+      FileDownload.__init__(self, filename, size, out)
+      self.extractor = None
+
+   def begin(self, status, headers):
+      self.first_byte = time.time()
+      self.expected = content_length(headers)
+      self.extractor = TarExtractor(self.out, self.filename)
+
+   def write(self, buff):
+      self.extractor.feed(buff)
+      self.count(len(buff))
+
+   def finish(self):
+      if self.expected is not None and self.received != self.expected:
+         raise TransferError('size mismatch %s %s' % (str(self.expected), str(self.received)), 'transient')
+      if self.received != self.size:
+         raise TransferError('size mismatch %s %s' % (str(self.size), str(self.received)), 'transient')
+      self.extractor.finish()
+
+      fd, tmp = tempfile.mkstemp(dir = self.out, suffix = '.tmp')
+      with os.fdopen(fd, 'w') as f:
+         json.dump({'size': self.size, 'members': self.extractor.members}, f)
+      os.replace(tmp, self.path + MEMBERS_SUFFIX)
+      logging.info('Extracted %d files from %s' % (len(self.extractor.members), self.filename))
+
+   def close(self):
+      if self.extractor:
+         self.extractor.close()
+
+
+def new_download(filename, size, out, resume = False):
+   if UNTAR and filename.endswith('.tar'):
+      return TarDownload(filename, size, out, resume)
+   return FileDownload(filename, size, out, resume)
+
+
+class NGASConnection(object):
+   """
+   Persistent HTTP/1.1 connection to one NGAS server.
+
+   Each download thread owns its connections and reuses them for every file
+   in its queue, so TCP setup and slow start are only paid once per thread.
+   """
+
+   def __init__(self, host, headers, timeout = None):
+      self.host = host
+      self.headers = headers
+      self.timeout = timeout
+      self.conn = None
+
+   def request(self, path, headers):
+      all_headers = dict(self.headers)
+      all_headers.update(headers)
+
+      reused = self.conn is not None and self.conn.sock is not None
+      try:
+         return self._request(path, all_headers)
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+         if not reused:
+            raise
+         # the server dropped an idle keep-alive connection; try again on a fresh one
+         self.close()
+         return self._request(path, all_headers)
+
+   def _request(self, path, headers):
+      if self.conn is None:
+         self.conn = http.client.HTTPConnection(self.host, timeout = self.timeout)
+
+      if self.conn.sock is None:
+         self.conn.connect()
+         connection_opened()
+
+      self.conn.request('GET', path, headers = headers)
+      request_sent()
+      return self.conn.getresponse()
+
+   def close(self):
+      if self.conn:
+         self.conn.close()
+         self.conn = None
+
+
+def download_queue_thread(queue, headers):
+   connections = {}
+   try:
+      while work_left(queue):
+         if CONTROLLER and not CONTROLLER.acquire(queue):
+            return
+         try:
+            item, wait = take_item(queue)
+            if item:
+               queue.lead_done(item[1], download_worker(connections, headers, *item))
+         finally:
+            if CONTROLLER:
+               CONTROLLER.release()
+         if item is None:
+            if wait is None:
+               return
+            time.sleep(min(wait, 1))
+   finally:
+      for conn in connections.values():
+         conn.close()
+
+
+def download_worker(connections, headers, url, filename, size, out, bufsize, prestage, resume = False):
 
     u = None
+    conn = None
+    done = False
+    download = new_download(filename, size, out, resume)
 
     try:
         file_starting(filename)
 
-        request = urllib.request.Request(url)
-        base64string = base64.encodestring(('%s:%s' % (username,password)).encode()).decode().replace('\n', '')
-        request.add_header('Authorization', 'Basic %s' % base64string)
-        request.add_header('prestagefilelist', prestage)
+        parts = urllib.parse.urlsplit(url)
+        download.host = pick_host(parts.netloc, download.attempt)
+        conn = connections.get(download.host)
+        if conn is None:
+            conn = connections[download.host] = NGASConnection(download.host, headers, TIMEOUT)
 
-        u = urllib.request.urlopen(request)
-        u.fp.bufsize = bufsize
+        u = conn.request('%s?%s' % (parts.path, parts.query), download.request_headers(prestage))
 
-        file_size = int(u.headers['Content-Length'])
-        file_size_dl = 0
+        if u.status not in (200, 206):
+            body = u.read()
+            done = True
+            raise http_error(u.status, body)
 
-        with open(out + filename, 'wb') as f:
-           while True:
-               buff = u.read(bufsize)
-               if not buff:
-                 break
-   
-               f.write(buff)
-               file_size_dl += len(buff)
+        download.begin(u.status, u.headers)
 
-        if file_size_dl != file_size:
-          raise Exception('size mismatch %s %s' % (str(file_size), str(file_size_dl)))
-
-        file_complete(filename)
+        buff = memoryview(bytearray(bufsize))
+        while True:
+            n = u.readinto(buff)
+            if not n:
+              break
 
-    except urllib.error.HTTPError as e:
-        file_error('%s %s' % (filename, str(e.read()) ))
+            download.write(buff[:n])
 
-    except urllib.error.URLError as urlerror:
-        if hasattr(urlerror, 'reason'):
-            file_error('%s %s' % (filename, str(urlerror.reason) ))
-        else:
-            file_error('%s %s' % (filename, str(urlerror) ))
+        done = True
+        download.finish()
+        transfer_done(download)
+        file_complete(filename)
+        return True
 
     except Exception as exp:
-        file_error('%s %s' % (filename, str(exp) ))
+        transfer_failed(download, (url, filename, size, out, bufsize, prestage, resume), exp)
+        return False
 
     finally:
+        download.close()
         if u:
             u.close()
+        # a half read response leaves the connection in an unknown state
+        if conn and not done:
+            conn.close()
+
+
+class AsyncNGASConnection(object):
+   """
+   Persistent HTTP/1.1 connection to one NGAS server for the asyncio engine.
+
+   Talks to a non-blocking socket through the event loop and reads response
+   bodies straight into the caller's buffer, so each stream in flight costs
+   one socket and one buffer.
+   """
+
+   def __init__(self, host, headers, timeout = None):
+      self.host = host
+      self.headers = headers
+      self.timeout = timeout
+      self.sock = None
+      self.pending = bytearray()
+      self.remaining = 0
+      self.chunked = False
+      self.will_close = False
+
+   async def request(self, path, headers):
+      all_headers = dict(self.headers)
+      all_headers.update(headers)
+
+      reused = self.sock is not None
+      try:
+         return await self._request(path, all_headers)
+      except (ConnectionError, EOFError):
+         if not reused:
+            raise
+         # the server dropped an idle keep-alive connection; try again on a fresh one
+         self.close()
+         return await self._request(path, all_headers)
+
+   async def _request(self, path, headers):
+      loop = asyncio.get_running_loop()
+
+      if self.sock is None:
+         await self._connect()
+
+      lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % self.host]
+      for key, value in headers.items():
+         lines.append('%s: %s' % (key, value))
+      await self._wait(loop.sock_sendall(self.sock, ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')))
+      request_sent()
+
+      while b'\r\n\r\n' not in self.pending:
+         if not await self._fill():
+            raise EOFError('connection closed before response headers')
+
+      end = self.pending.index(b'\r\n\r\n') + 4
+      head = bytes(self.pending[:end])
+      del self.pending[:end]
+
+      status_line, _, header_lines = head.partition(b'\r\n')
+      status = int(status_line.split()[1])
+      response_headers = http.client.parse_headers(io.BytesIO(header_lines))
+
+      self.chunked = 'chunked' in response_headers.get('Transfer-Encoding', '').lower()
+      if self.chunked:
+         # readinto reads the size of each chunk as it gets to it
+         self.remaining = 0
+         self.will_close = (response_headers.get('Connection', '').lower() == 'close')
+      elif response_headers['Content-Length'] is not None:
+         self.remaining = int(response_headers['Content-Length'])
+         self.will_close = (response_headers.get('Connection', '').lower() == 'close')
+      else:
+         # no length, the body runs until the server closes the connection
+         self.remaining = -1
+         self.will_close = True
+
+      return status, response_headers
+
+   async def _connect(self):
+      loop = asyncio.get_running_loop()
+      host, _, port = self.host.partition(':')
+      infos = await loop.getaddrinfo(host, int(port or 80), type = socket.SOCK_STREAM)
+      family, socktype, proto, _, address = infos[0]
+
+      sock = socket.socket(family, socktype, proto)
+      sock.setblocking(False)
+      try:
+         await self._wait(loop.sock_connect(sock, address))
+      except BaseException:
+         sock.close()
+         raise
+
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.sock = sock
+      self.pending = bytearray()
+      connection_opened()
+
+   async def _fill(self):
+      data = await self._wait(asyncio.get_running_loop().sock_recv(self.sock, 65536))
+      self.pending += data
+      return len(data)
+
+   async def _line(self):
+      while b'\r\n' not in self.pending:
+         if not await self._fill():
+            raise EOFError('connection closed inside a chunked body')
+      end = self.pending.index(b'\r\n')
+      line = bytes(self.pending[:end])
+      del self.pending[:end + 2]
+      return line
+
+   async def _next_chunk(self):
+      # a chunked body is a hex size line, the data and a CRLF per chunk,
+      # ended by a chunk of size 0 and optional trailer lines
+      line = await self._line()
+      try:
+         size = int(line.split(b';')[0], 16)
+      except ValueError:
+         raise EOFError('bad chunk size line %r' % line[:40])
+      if size == 0:
+         while await self._line():
+            pass
+         self.chunked = False
+      return size
+
+   async def _wait(self, future):
+      if self.timeout:
+         try:
+            return await asyncio.wait_for(future, self.timeout)
+         except asyncio.TimeoutError:
+            # asyncio's has no message; log it the way the thread engine does
+            raise socket.timeout('timed out')
+      return await future
+
+   async def readinto(self, buff):
+      """Read the next part of the response body into buff, 0 at the end of the body."""
+      if self.chunked and self.remaining == 0:
+         self.remaining = await self._next_chunk()
+      if self.remaining == 0:
+         return 0
+
+      size = len(buff)
+      if self.remaining > 0:
+         size = min(size, self.remaining)
+
+      if self.pending:
+         n = min(size, len(self.pending))
+         buff[:n] = self.pending[:n]
+         del self.pending[:n]
+      else:
+         n = await self._wait(asyncio.get_running_loop().sock_recv_into(self.sock, memoryview(buff)[:size]))
+         if n == 0:
+            if self.remaining > 0:
+               raise EOFError('connection closed with %d bytes outstanding' % self.remaining)
+            self.remaining = 0
+            return 0
+
+      if self.remaining > 0:
+         self.remaining -= n
+         if self.chunked and self.remaining == 0:
+            await self._line()
+      return n
+
+   async def read(self):
+      buff = memoryview(bytearray(65536))
+      body = bytearray()
+      while True:
+         n = await self.readinto(buff)
+         if not n:
+            return bytes(body)
+         body += buff[:n]
+
+   def release(self):
+      # called once a response has been read to the end
+      if self.will_close:
+         self.close()
+
+   def close(self):
+      if self.sock:
+         self.sock.close()
+         self.sock = None
+      self.pending = bytearray()
+      self.remaining = 0
+
+
+async def download_queue_task(queue, headers):
+   connections = {}
+   try:
+      while True:
+         if CONTROLLER and not await CONTROLLER.acquire_async(queue):
+            return
+         try:
+            item, wait = take_item(queue)
+            if item:
+               queue.lead_done(item[1], await download_worker_async(connections, headers, *item))
+         finally:
+            if CONTROLLER:
+               CONTROLLER.release()
+         if item is None:
+            if wait is None:
+               return
+            await asyncio.sleep(min(wait, 1))
+   finally:
+      for conn in connections.values():
+         conn.close()
+
+
+async def download_worker_async(connections, headers, url, filename, size, out, bufsize, prestage, resume = False):
+
+    # file writes, preallocation and tar extraction run in the loop's
+    # executor so a slow disk does not hold up the other streams
+    loop = asyncio.get_running_loop()
+    conn = None
+    done = False
+    download = new_download(filename, size, out, resume)
+
+    try:
+        file_starting(filename)
+
+        parts = urllib.parse.urlsplit(url)
+        download.host = pick_host(parts.netloc, download.attempt)
+        conn = connections.get(download.host)
+        if conn is None:
+            conn = connections[download.host] = AsyncNGASConnection(download.host, headers, TIMEOUT)
+
+        status, response_headers = await conn.request('%s?%s' % (parts.path, parts.query),
+                                                      download.request_headers(prestage))
+
+        if status not in (200, 206):
+            body = await conn.read()
+            done = True
+            raise http_error(status, body)
+
+        await loop.run_in_executor(None, download.begin, status, response_headers)
+
+        # fill the whole buffer before handing it to the executor, one
+        # write per bufsize rather than one per socket read
+        buff = memoryview(bytearray(bufsize))
+        end = False
+        while not end:
+            n = 0
+            while n < bufsize:
+                got = await conn.readinto(buff[n:])
+                if not got:
+                    end = True
+                    break
+                n += got
+
+            if n:
+                await loop.run_in_executor(None, download.write, buff[:n])
+
+        done = True
+        await loop.run_in_executor(None, download.finish)
+        transfer_done(download)
+        file_complete(filename)
+        return True
+
+    except Exception as exp:
+        transfer_failed(download, (url, filename, size, out, bufsize, prestage, resume), exp)
+        return False
+
+    finally:
+        await loop.run_in_executor(None, download.close)
+        if conn:
+            # a half read response leaves the connection in an unknown state
+            if done:
+                conn.release()
+            else:
+                conn.close()
+
+
+async def download_tasks(queue, numdownload, headers):
+   await asyncio.gather(*[download_queue_task(queue, headers) for _ in range(numdownload)])
+
+
+def download_async(queue, numdownload, headers):
+   loop = asyncio.new_event_loop()
+   asyncio.set_event_loop(loop)
+   # the default executor has min(32, cpus + 4) threads, too few to keep up
+   # with the disk writes of a few hundred streams
+   loop.set_default_executor(ThreadPoolExecutor(max_workers = numdownload))
+   try:
+      loop.run_until_complete(download_tasks(queue, numdownload, headers))
+   finally:
+      loop.close()
+
+
+class SecondTracker(object):
+   """
+   Follows which gps seconds of a raw (type 11) download have all of their
+   lane files on disk, and calls every listener with (second, paths) as soon
+   as one is complete while the other downloads carry on. A second whose
+   files were all on disk before the run started was handled by the run
+   that downloaded it and is not passed to the listeners again.
+   """
+
+   def __init__(self, catalog, indexes, dir):
+      self.lock = threading.Lock()
+      self.dir = dir
+      self.second_of = {}
+      self.pending = {}
+      self.files = {}
+      self.downloaded = set()
+      self.listeners = []
+
+      for i in indexes:
+         second = catalog.gps[i]
+         filename = catalog.names[i]
+         self.second_of[filename] = second
+         self.pending.setdefault(second, set()).add(filename)
+         self.files.setdefault(second, []).append(filename)
+
+   def file_done(self, filename, downloaded = True):
+      with self.lock:
+         second = self.second_of.get(filename)
+         if second is None or second not in self.pending:
+            return
+         if downloaded:
+            self.downloaded.add(second)
+         remaining = self.pending[second]
+         remaining.discard(filename)
+         if remaining:
+            return
+         del self.pending[second]
+         if second not in self.downloaded:
+            return
+
+      logger.info('Second %d ready' % second)
+      paths = [self.dir + f for f in sorted(self.files[second])]
+      for listener in self.listeners:
+         listener(second, paths)
+
+   def incomplete(self):
+      with self.lock:
+         return sorted(self.pending)
+
+
+class SecondDispatcher(object):
+   """Runs a command for each ready second on a bounded pool of processes."""
+
+   def __init__(self, procs):
+      self.pool = ThreadPoolExecutor(max_workers = procs)
+
+   def submit(self, name, second, cmd):
+      self.pool.submit(self.run, name, second, cmd)
+
+   def run(self, name, second, cmd):
+      start = time.time()
+      try:
+         result = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+      except OSError as e:
+         file_error('%s of second %d failed: %s' % (name, second, str(e)))
+         return
+
+      if result.returncode != 0:
+         output = result.stdout.decode(errors = 'replace').strip()
+         file_error('%s of second %d failed (%d): %s' % (name, second, result.returncode, output))
+      else:
+         logging.info('%s of second %d done in %.1fs' % (name, second, time.time() - start))
+
+   def shutdown(self):
+      self.pool.shutdown(wait = True)
+
+
+def split_windows(catalog, indexes, limit):
+   """
+   Group catalog indexes (in second order) into windows of at most limit
+   files. The files of one second always stay in the same window.
+   """
+   windows = []
+   current = []
+   for second, group in itertools.groupby(indexes, key = lambda i: catalog.gps[i]):
+      group = list(group)
+      if current and len(current) + len(group) > limit:
+         windows.append(current)
+         current = []
+      current.extend(group)
+
+   if current:
+      windows.append(current)
+   return windows
+
+
+def run_downloads(queue, numdownload, headers, engine):
+   if engine == 'async':
+      download_async(queue, numdownload, headers)
+   else:
+      threads = []
+      for t in range(numdownload):
+         t = threading.Thread(target = download_queue_thread, args = (queue, headers))
+         t.daemon = True
+         threads.append(t)
+         t.start()
+         
+      for t in threads:
+         while t.is_alive():
+            t.join(timeout = 0.25)
+
+
+def prestage_batches(filenames, max_bytes):
+   """Split filenames into batches whose JSON prestage list fits in max_bytes."""
+   batches = []
+   current = []
+   length = 2
+   for filename in filenames:
+      entry = len(json.dumps(filename)) + 2
+      if current and length + entry > max_bytes:
+         batches.append(current)
+         current = []
+         length = 2
+      current.append(filename)
+      length += entry
+
+   if current:
+      batches.append(current)
+   return batches
+
+
+class StagedQueue(object):
+   """
+   Download queue of one window that hands out files in staging order.
+
+   The files are split into batches whose prestage list fits in a single
+   request header. The first file of each batch is the advisory: it is the
+   only request that carries the batch list. Prestage threads fetch the
+   batch leads ahead of the download workers, and the workers take files
+   from staged batches first, then from advised ones, and only then start
+   on a batch nobody has advised yet (taking its lead themselves and
+   reporting back through lead_done). A batch is only staged once its lead
+   has downloaded; when the lead fails the next file of the batch becomes
+   the advisory.
+
+   Supports the get/get_nowait/empty calls the download engines make on a
+   Queue; all files are known up front so get never blocks. `filename in
+   queue` tells whether a file belongs to the window, so its retries stay
+   with it.
+   """
+
+   PENDING = 0
+   ADVISED = 1
+   STAGED = 2
+
+   def __init__(self, items, max_bytes):
+      self.lock = threading.Lock()
+      self.batches = []
+      self.state = []
+      self.served = [0, 0, 0]
+      self.threads = []
+      self.leads = {}
+      self.names = frozenset(item[1] for item in items)
+
+      byname = dict((item[1], item) for item in items)
+      for names in prestage_batches([item[1] for item in items], max_bytes):
+         prestage = json.dumps(names)
+         batch = deque()
+         for i, filename in enumerate(names):
+            url, filename, filesize, dir, bufsize, resume = byname[filename]
+            batch.append((url, filename, filesize, dir, bufsize,
+                          prestage if i == 0 else None, resume))
+         self.batches.append(batch)
+         self.state.append(self.PENDING)
+
+   def __len__(self):
+      with self.lock:
+         return sum(len(batch) for batch in self.batches)
+
+   def __contains__(self, filename):
+      return filename in self.names
+
+   def empty(self):
+      return len(self) == 0
+
+   def get(self, block = True, timeout = None):
+      return self.get_nowait()
+
+   def get_nowait(self):
+      with self.lock:
+         for state in (self.STAGED, self.ADVISED, self.PENDING):
+            for i, batch in enumerate(self.batches):
+               if batch and self.state[i] == state:
+                  self.served[state] += 1
+                  item = batch.popleft()
+                  if state == self.PENDING:
+                     self.state[i] = self.ADVISED
+                     self.leads[item[1]] = (i, item[5])
+                  return item
+      raise Empty
+
+   def lead_done(self, filename, ok):
+      # a download worker reports on a file from get_nowait; when it was the
+      # lead of a batch that settles the batch as for a prestage thread
+      with self.lock:
+         lead = self.leads.pop(filename, None)
+      if lead is None:
+         return
+      index, prestage = lead
+      if ok:
+         self.mark_staged(index)
+      else:
+         self.lead_failed(index, prestage)
+
+   def claim_lead(self):
+      # next batch nobody has advised yet: (index, lead item) or None
+      with self.lock:
+         for i, batch in enumerate(self.batches):
+            if batch and self.state[i] == self.PENDING:
+               self.state[i] = self.ADVISED
+               return i, batch.popleft()
+      return None
+
+   def mark_staged(self, index):
+      with self.lock:
+         self.state[index] = self.STAGED
+
+   def lead_failed(self, index, prestage):
+      # the archive may not have taken the advisory; the next file of the
+      # batch carries the list instead and goes to whoever starts it first
+      with self.lock:
+         batch = self.batches[index]
+         if batch:
+            batch[0] = batch[0][:5] + (prestage,) + batch[0][6:]
+            self.state[index] = self.PENDING
+
+   def prestage(self, headers, streams, engine = 'thread', after = None):
+      """
+      Start streams downloads working through the batch leads on the given
+      engine: a thread each, or tasks on one event loop of their own. With
+      after (the queue of the window before) they wait until its leads are
+      all done, so no more than streams leads hold a slot at any time.
+      """
+      streams = min(streams, len(self.batches))
+      if engine == 'async':
+         targets = [(self.prestage_loop, (headers, streams, after))]
+      else:
+         targets = [(self.prestage_thread, (headers, after))] * streams
+
+      for target, args in targets:
+         t = threading.Thread(target = target, args = args)
+         t.daemon = True
+         self.threads.append(t)
+         t.start()
+
+   def prestage_thread(self, headers, after = None):
+      if after is not None:
+         after.join()
+      connections = {}
+      try:
+         while True:
+            # a lead is a download like any other and waits for a slot
+            if not CONTROLLER.acquire(self):
+               return
+            try:
+               lead = self.claim_lead()
+               if lead is None:
+                  return
+               index, item = lead
+               if download_worker(connections, headers, *item):
+                  self.mark_staged(index)
+               else:
+                  self.lead_failed(index, item[5])
+            finally:
+               CONTROLLER.release()
+      finally:
+         for conn in connections.values():
+            conn.close()
+
+   def prestage_loop(self, headers, streams, after = None):
+      if after is not None:
+         after.join()
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+         loop.run_until_complete(self.prestage_tasks(headers, streams))
+      finally:
+         loop.close()
+
+   async def prestage_tasks(self, headers, streams):
+      await asyncio.gather(*[self.prestage_task(headers) for _ in range(streams)])
+
+   async def prestage_task(self, headers):
+      connections = {}
+      try:
+         while True:
+            if not await CONTROLLER.acquire_async(self):
+               return
+            try:
+               lead = self.claim_lead()
+               if lead is None:
+                  return
+               index, item = lead
+               if await download_worker_async(connections, headers, *item):
+                  self.mark_staged(index)
+               else:
+                  self.lead_failed(index, item[5])
+            finally:
+               CONTROLLER.release()
+      finally:
+         for conn in connections.values():
+            conn.close()
+
+   def join(self):
+      for t in self.threads:
+         while t.is_alive():
+            t.join(timeout = 0.25)
 
 
 def main():
    global COMPLETE
    global TOTAL_FILES
    global ERRORS
+   global SECONDS
+   global META_URL
+   global METRICS
+   global CONTROLLER
+   global RETRIES
+   global PREALLOCATE
+   global HOSTS
+   global UNTAR
+   global UNTAR_SKIP
+   global TIMEOUT
 
    parser = OptionParser(usage='usage: %prog [options]', version='%prog 1.0')
    parser.add_option('--obs', action='store', dest='obs', help='Observation ID')
@@ -334,18 +2135,80 @@ def main():
    parser.add_option('--duration', default = 0, type = 'int', dest='duration',
                        help='Duration (seconds)')
    parser.add_option('--ngas',  default=server_url, action='store',
-                       dest='ngashost', help='NGAS server (default: %default)')
+                       dest='ngashost', help='NGAS server, or comma separated servers to spread the files over (default: %default)')
    parser.add_option('--dir', default= './', action='store', dest='out',
                        help='Output directory (default: ./')
    parser.add_option('--parallel', default='6', action='store', dest='td',
-                       help='Number of simultaneous downloads (default: 6)')
+                       help='Number of simultaneous downloads, or auto (default: 6)')
+   parser.add_option('--parallel-min', default=1, action='store', type='int', dest='parallelmin',
+                       help='Fewest simultaneous downloads with --parallel=auto (default: %default)')
+   parser.add_option('--parallel-max', action='store', type='int', dest='parallelmax',
+                       help='Most simultaneous downloads with --parallel=auto (default: 12, async 64)')
+   parser.add_option('--parallel-interval', default=5, action='store', type='float', dest='parallelinterval',
+                       help='Seconds between --parallel=auto adjustments (default: %default)')
+   parser.add_option('--engine', default='thread', action='store', dest='engine',
+                       choices=['thread', 'async'],
+                       help='Transfer engine, thread or async (default: thread)')
+   parser.add_option('--meta-url', default=META_URL, action='store', dest='metaurl',
+                       help='Metadata web service (default: %default)')
+   parser.add_option('--meta-cache', default=META_CACHE_DIR, action='store', dest='metacache',
+                       help='Metadata cache directory, empty to disable (default: %default)')
+   parser.add_option('--meta-ttl', default=3600, action='store', type='int', dest='metattl',
+                       help='Seconds a cached metadata query stays valid (default: %default)')
+   parser.add_option('--refresh-meta', default=False, action='store_true', dest='refreshmeta',
+                       help='Ignore the metadata cache and query the archive again')
+   parser.add_option('--prestage-bytes', default=6144, action='store', type='int', dest='prestagebytes',
+                       help='Largest prestage list sent in one request header (default: %default)')
+   parser.add_option('--prestage-streams', default=2, action='store', type='int', dest='prestagestreams',
+                       help='Downloads advising the archive ahead of the others (default: %default)')
+   parser.add_option('--recombine', action='store', dest='recombine',
+                       help='Run this recombine binary on each second as soon as it is downloaded (type 11)')
+   parser.add_option('--metafits', action='store', dest='metafits',
+                       help='Meta-data fits file of the observation, required by --recombine')
+   parser.add_option('--recombine-dir', action='store', dest='recombinedir',
+                       help='Output directory of recombine (default: --dir)')
+   parser.add_option('--on-second', action='store', dest='onsecond',
+                       help='Command run as CMD <obsid> <second> <files...> when a second is downloaded (type 11)')
+   parser.add_option('--second-procs', default=2, action='store', type='int', dest='secondprocs',
+                       help='Recombine or --on-second commands run at once (default: %default)')
+   parser.add_option('--resume', default=False, action='store_true', dest='resume',
+                       help='Resume partially downloaded files instead of fetching them again')
+   parser.add_option('--untar', default=False, action='store_true', dest='untar',
+                       help='Extract combined .tar files while they download instead of storing them (type 16)')
+   parser.add_option('--sweep-partials', default=False, action='store_true', dest='sweeppartials',
+                       help='Remove .part files of earlier runs not written to for %d minutes' % (PARTIAL_AGE // 60))
+   parser.add_option('--bufsize', default=65536, action='store', type='int', dest='bufsize',
+                       help='Bytes read from the server at a time, several MB are fine (default: %default)')
+   parser.add_option('--no-preallocate', default=False, action='store_true', dest='nopreallocate',
+                       help='Do not reserve disk space for each file before writing it')
+   parser.add_option('--timeout', default=TIMEOUT, action='store', type='float', dest='timeout',
+                       help='Seconds to wait for a server to connect or send data before the transfer '
+                            'is abandoned and retried, 0 waits forever (default: %default)')
+   parser.add_option('--retries', default=5, action='store', type='int', dest='retries',
+                       help='Times a failed file is tried again, 0 to disable (default: %default)')
+   parser.add_option('--retry-budget', default=1000, action='store', type='int', dest='retrybudget',
+                       help='Most retries in the whole job (default: %default)')
+   parser.add_option('--retry-delay', default=2, action='store', type='float', dest='retrydelay',
+                       help='Seconds before the first retry, doubled for each further one (default: %default)')
+   parser.add_option('--retry-max-delay', default=300, action='store', type='float', dest='retrymaxdelay',
+                       help='Longest wait before a retry in seconds (default: %default)')
+   parser.add_option('--metrics-json', action='store', dest='metricsjson',
+                       help='Append per file transfer metrics and progress to this JSON lines file')
+   parser.add_option('--metrics-prom', action='store', dest='metricsprom',
+                       help='Write transfer metrics to this Prometheus textfile collector file')
+   parser.add_option('--metrics-interval', default=10, action='store', type='float', dest='metricsinterval',
+                       help='Seconds between metrics updates (default: %default)')
    
-   bufsize = 65536
    (options, args) = parser.parse_args()
    
    if options.ngashost == None:
        print('NGAS host not defined')
        sys.exit(-1)
+
+   ngashosts = [h.strip() for h in options.ngashost.split(',') if h.strip()]
+   if not ngashosts:
+       print('NGAS host not defined')
+       sys.exit(-1)
    
    if options.obs == None:
        print('Observation ID is empty')
@@ -364,33 +2227,86 @@ def main():
           print('Duration must not be negative')
           sys.exit(-1)
    
-   numdownload = int(options.td)
-   
-   if numdownload <= 0 or numdownload > 12:
-       print('Number of simultaneous downloads must be > 0 and <= 12')
+   if options.bufsize <= 0:
+       print('Buffer size must be > 0')
+       sys.exit(-1)
+
+   if options.metricsinterval <= 0:
+       print('Metrics interval must be > 0')
+       sys.exit(-1)
+
+   if options.timeout < 0:
+       print('Timeout must not be negative')
+       sys.exit(-1)
+
+   if options.retries < 0 or options.retrybudget < 0 or options.retrydelay < 0 or options.retrymaxdelay < 0:
+       print('Retry settings must not be negative')
+       sys.exit(-1)
+
+   bufsize = options.bufsize
+   PREALLOCATE = not options.nopreallocate
+   UNTAR = options.untar
+   TIMEOUT = options.timeout or None
+   META_URL = options.metaurl
+   if not META_URL.endswith('/'):
+       META_URL += '/'
+
+   limit = 256 if options.engine == 'async' else 12
+   auto = options.td == 'auto'
+   if auto:
+       if options.parallelmax is None:
+           options.parallelmax = 64 if options.engine == 'async' else 12
+       numdownload = options.parallelmax
+       if options.parallelmin <= 0 or options.parallelmin > numdownload:
+           print('--parallel-min must be > 0 and <= --parallel-max')
+           sys.exit(-1)
+       if options.parallelinterval <= 0:
+           print('--parallel-interval must be > 0')
+           sys.exit(-1)
+   else:
+       try:
+           numdownload = int(options.td)
+       except ValueError:
+           print('--parallel must be a number or auto')
+           sys.exit(-1)
+
+   if numdownload <= 0 or numdownload > limit:
+       print('Number of simultaneous downloads must be > 0 and <= %d' % limit)
        sys.exit(-1)
    
+   if (options.recombine or options.onsecond) and options.filetype != 11:
+       print('--recombine and --on-second need raw voltage data (--type=11)')
+       sys.exit(-1)
+
+   if options.untar and options.filetype != 16:
+       print('--untar needs combined data (--type=16)')
+       sys.exit(-1)
+
+   if options.recombine and options.metafits == None:
+       print('--recombine needs --metafits')
+       sys.exit(-1)
+
    logger.info('Finding observation %s' % options.obs)
    
-   fileresult = query_observation(options.obs, 'ws.mwatelescope.org',
-                                  options.filetype, options.timefrom, options.duration)
-   if len(fileresult) <= 0:
-       logger.info('No files found for observation %s and file type %s' % options.obs,
-                                                                          int(options.filetype))
+   processRange = options.timefrom != None and options.duration != None
+   catalog = query_catalog(options.obs, options.timefrom, options.duration,
+                           options.metacache, options.metattl, options.refreshmeta)
+   selected = catalog.select(filetypes = FILETYPES.get(options.filetype, ()), available = processRange)
+   if len(selected) <= 0:
+       logger.info('No files found for observation %s and file type %s' % (options.obs,
+                                                                           int(options.filetype)))
        sys.exit(1)
    
-   logger.info('Found %s files' % (str(len(fileresult))))
+   logger.info('Found %s files' % (str(len(selected))))
 
-   if len(fileresult) > 12000:
-       logger.error('File limit exceeded 12000, please stagger your download')
-       sys.exit(1)
-   
-   # advise that we want to prestage all the files
-   filelist = []
-   for key, value in fileresult.items():
-      filelist.append(key)
-   
-   prestage_files = json.dumps(filelist)
+   if UNTAR:
+      UNTAR_SKIP = frozenset(catalog.names[i] for i in selected)
+
+   # the archive takes at most FILE_LIMIT files per prestage request, so
+   # longer downloads are split into windows of whole seconds
+   windows = split_windows(catalog, selected, FILE_LIMIT)
+   if len(windows) > 1:
+       logger.info('More than %d files, downloading in %d windows' % (FILE_LIMIT, len(windows)))
    
    if options.out == None or len(options.out) == 0:
        options.out = './' + options.out + '/'
@@ -402,30 +2318,118 @@ def main():
    dir = options.out
    if not os.path.exists(dir):
        os.makedirs(dir)
+
+   if options.sweeppartials:
+       # --resume continues the partial files of this download, however old
+       keep = frozenset(catalog.names[i] for i in selected) if options.resume else ()
+       logger.info('Removed %d stale partial files' % sweep_partials(dir, keep = keep))
    
-   TOTAL_FILES = len(fileresult)
-   download_queue = Queue()
-   
-   for filename, filesize in sorted(fileresult.items()):
-       url = 'http://%s/RETRIEVE?file_id=%s' % (options.ngashost, filename)
-       if not check_complete(filename, int(filesize), dir):
-           download_queue.put((url, filename, filesize, dir,
-                               bufsize, prestage_files))
-           continue
-       file_complete(filename)
-   
-   threads = []
-   for t in range(numdownload):
-      t = threading.Thread(target = download_queue_thread, args = (download_queue,))
-      t.setDaemon(True)
-      threads.append(t)
-      t.start()
-      
-   for t in threads:
-      while t.isAlive():
-         t.join(timeout = 0.25)
+   TOTAL_FILES = len(selected)
+   headers = {'Authorization': basic_auth(username, password)}
+
+   if options.metricsjson or options.metricsprom:
+      METRICS = TransferMetrics(options.obs, options.metricsjson, options.metricsprom,
+                                options.metricsinterval)
+      METRICS.start()
+
+   if options.retries > 0 and options.retrybudget > 0:
+      RETRIES = RetryScheduler(options.retries, options.retrybudget, options.retrydelay, options.retrymaxdelay)
+
+   if len(ngashosts) > 1:
+      HOSTS = HostPool(ngashosts)
+      logger.info('Spreading downloads over %d NGAS hosts' % len(ngashosts))
+
+   if auto:
+      CONTROLLER = ConcurrencyController(options.parallelmin, options.parallelmax, options.parallelinterval)
+      CONTROLLER.start()
+   else:
+      CONTROLLER = ConcurrencyController(numdownload, numdownload, None, numdownload)
+
+   dispatcher = None
+   if options.filetype == 11:
+      SECONDS = SecondTracker(catalog, selected, dir)
+
+      if options.recombine or options.onsecond:
+         dispatcher = SecondDispatcher(options.secondprocs)
+
+      if options.recombine:
+         recombine_dir = options.recombinedir or dir
+         def recombine_second(second, paths):
+            dispatcher.submit('recombine', second,
+                              [options.recombine, '-o', str(options.obs), '-t', str(second),
+                               '-m', options.metafits, '-i', recombine_dir, '-f'] + paths)
+         SECONDS.listeners.append(recombine_second)
+
+      if options.onsecond:
+         def on_second(second, paths):
+            dispatcher.submit(options.onsecond, second,
+                              shlex.split(options.onsecond) + [str(options.obs), str(second)] + paths)
+         SECONDS.listeners.append(on_second)
+
+   def window_queue(window, after = None):
+      # queue the missing files of a window and start advising the archive
+      # once the window before has advised all of its batches
+      items = []
+      for filename, filesize in sorted((catalog.names[i], catalog.size[i]) for i in window):
+          url = 'http://%s/RETRIEVE?file_id=%s' % (ngashosts[0], filename)
+          if not is_complete(filename, int(filesize), dir):
+              items.append((url, filename, filesize, dir, bufsize, options.resume))
+              continue
+          file_complete(filename, False)
+
+      queue = StagedQueue(items, options.prestagebytes)
+      logger.info('Prestaging %d files in %d batches' % (len(queue), len(queue.batches)))
+      queue.prestage(headers, options.prestagestreams, options.engine, after)
+      return queue
+
+   download_queue = window_queue(windows[0])
+
+   for w, window in enumerate(windows):
+      if len(windows) > 1:
+         logger.info('Window %d of %d: %d files, seconds %d to %d' % (w + 1, len(windows), len(window),
+                                                                       catalog.gps[window[0]],
+                                                                       catalog.gps[window[-1]]))
+
+      # get the archive staging the next window while this one transfers
+      next_queue = None
+      if w + 1 < len(windows):
+         next_queue = window_queue(windows[w + 1], download_queue)
+
+      run_downloads(download_queue, numdownload, headers, options.engine)
+      download_queue.join()
+
+      # a batch lead that failed in a prestage thread may still be waiting for its retry
+      while RETRIES and RETRIES.pending(download_queue):
+         run_downloads(download_queue, numdownload, headers, options.engine)
+
+      logger.info('Prestage: %d files taken from staged batches, %d from advised batches, %d unadvised'
+                  % tuple(download_queue.served[::-1]))
+      download_queue = next_queue
                
    logger.info('File Transfer Complete.')
+
+   CONTROLLER.stop()
+   if auto:
+      logger.info('Parallel downloads auto: finished at %d' % CONTROLLER.limit)
+
+   if METRICS:
+      METRICS.stop()
+
+   if SECONDS and SECONDS.incomplete():
+       logger.warning('%d seconds are missing files' % len(SECONDS.incomplete()))
+
+   if dispatcher:
+       logger.info('Waiting for per second processing to finish')
+       dispatcher.shutdown()
+   if HOSTS:
+       HOSTS.summary()
+   if READS:
+       logger.info('Received %.1f MB in %d reads, %d bytes per read' % (RECEIVED / 1e6, READS, RECEIVED // READS))
+   if RETRIES and RETRIES.used:
+       logger.info('Retries: %d of %d files retried, %d retries used of %d'
+                   % (len(RETRIES.attempts), TOTAL_FILES, RETRIES.used, RETRIES.budget))
+   if REQUESTS:
+       logger.info('Connection reuse: %d requests over %d connections' % (REQUESTS, CONNECTIONS))
    
    if ERRORS:
        logger.error('File Transfer Error Summary:')
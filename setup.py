@@ -27,5 +27,6 @@ setup(
       url='',
       packages=find_packages(),
       install_requires=['requests'],
+      extras_require={'recombine': ['astropy', 'numpy']},
       scripts=['scripts/voltdownload.py']
 )
@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+import os
+import sys
+import json
+import socket
+import subprocess
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = os.path.join(ROOT, 'scripts')
+sys.path.insert(0, SCRIPTS)
+sys.path.insert(0, ROOT)
+
+import fakengas
+
+OBS = 1000000000
+
+# runs voltdownload.main() with FILE_LIMIT taken from the first argument,
+# so windowed downloads can be tested on a few files
+RUNNER = 'import sys, voltdownload; voltdownload.FILE_LIMIT = int(sys.argv.pop(1)); voltdownload.main()'
+
+
+class NGAS(object):
+    """A fakengas.py server running in a thread of the test process."""
+
+    def __init__(self, log, seconds=4, types=(11,), scale=0.0005, **faults):
+        self.log = log
+        self.files = fakengas.observation(OBS, OBS, seconds, set(types), scale)
+        self.server = fakengas.FakeNGAS(('127.0.0.1', 0), OBS, self.files, fakengas.Faults(**faults),
+                                        fakengas.RequestLog(log))
+        self.port = self.server.server_address[1]
+        self.host = '127.0.0.1:%d' % self.port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def requests(self):
+        """The RETRIEVE requests served so far, oldest first."""
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def check(self, directory, types=None):
+        """Names of the served files of types that are missing or differ in directory."""
+        bad = []
+        for name, (filetype, second, payload) in sorted(self.files.items()):
+            if types is not None and filetype not in types:
+                continue
+            if not same_content(os.path.join(directory, name), payload):
+                bad.append(name)
+        return bad
+
+
+def same_content(path, payload, offset=0):
+    if not os.path.exists(path) or os.path.getsize(path) != payload.size - offset:
+        return False
+    with open(path, 'rb') as f:
+        while offset < payload.size:
+            data = f.read(1 << 20)
+            if not data or data != payload.read(offset, len(data)):
+                return False
+            offset += len(data)
+    return True
+
+
+def free_port():
+    # a port nothing listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def ngas(tmp_path):
+    servers = []
+
+    def start(**kwargs):
+        server = NGAS(str(tmp_path / ('requests%d.log' % len(servers))), **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def download(tmp_path):
+    """Run voltdownload.py against a NGAS server, returns the CompletedProcess."""
+
+    def run(server, *args, hosts=None, file_limit=12000, timeout=120):
+        env = dict(os.environ, MWAVOLT_USER='test', MWAVOLT_PASS='test', MWAVOLT_SERVER_URL=server.host,
+                   PYTHONPATH=SCRIPTS)
+        cmd = [sys.executable, '-c', RUNNER, str(file_limit), '--obs=%d' % OBS,
+               '--ngas=%s' % (hosts or server.host), '--meta-url=http://%s/' % server.host,
+               '--meta-cache=', '--dir=%s' % (tmp_path / 'out')] + list(args)
+        return subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, timeout=timeout)
+
+    return run
@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+import os
+import json
+import hashlib
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('requests')
+
+from mwa_pulsar_client.cache import CatalogCache
+from mwa_pulsar_client.client import PulsarClient
+
+LAST_MODIFIED = 'Wed, 01 Jan 2025 00:00:00 GMT'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        name = urllib.parse.urlparse(self.path).path.strip('/')
+        server.seen.append((name, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+        body = json.dumps(server.lists.get(name, [])).encode()
+        if server.validator == 'etag':
+            tag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == tag:
+                return self.reply(304, headers=[('ETag', tag)])
+            return self.reply(200, body, [('ETag', tag)])
+        if self.headers.get('If-Modified-Since') == server.modified:
+            return self.reply(304)
+        return self.reply(200, body, [('Last-Modified', server.modified)])
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        fields = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        self.server.lists['pulsar_list'].append({'name': fields['name']})
+        self.server.modified = 'Thu, 02 Jan 2025 00:00:00 GMT'
+        self.reply(200, b'{}')
+
+
+@pytest.fixture(params=['etag', 'last-modified'])
+def server(request):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.validator = request.param
+    server.modified = LAST_MODIFIED
+    server.seen = []
+    server.lists = {'pulsar_list': [{'name': 'J0437-4715'}, {'name': 'J0534+2200'}],
+                    'detection_list': [{'observationid': 1, 'id': i} for i in range(3)]}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.addr = 'http://127.0.0.1:%d' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_store_and_load(tmp_path):
+    cache = CatalogCache(str(tmp_path))
+    entry = cache.store('http://a', 'pulsar_list', {'q': 1}, [1, 2], etag='"x"')
+    assert cache.fresh(entry)
+
+    # a second process sees the reply through the disk
+    other = CatalogCache(str(tmp_path))
+    loaded = other.load('http://a', 'pulsar_list', {'q': 1})
+    assert loaded['data'] == [1, 2] and loaded['etag'] == '"x"'
+    assert other.load('http://b', 'pulsar_list', {'q': 1}) is None
+    assert other.load('http://a', 'pulsar_list', {'q': 2}) is None
+    assert not [name for name in os.listdir(str(tmp_path / 'pulsar_list')) if name.endswith('.tmp')]
+
+
+def test_expiry_and_invalidate(tmp_path):
+    cache = CatalogCache(str(tmp_path), ttl=0)
+    entry = cache.store('http://a', 'pulsar_list', {}, [1])
+    cache.store('http://a', 'detection_list', {}, [2])
+    assert not cache.fresh(entry)
+    assert cache.load('http://a', 'pulsar_list', {})['data'] == [1]
+
+    cache.invalidate('pulsar_list')
+    assert cache.load('http://a', 'pulsar_list', {}) is None
+    assert cache.load('http://a', 'detection_list', {})['data'] == [2]
+    cache.clear()
+    assert cache.load('http://a', 'detection_list', {}) is None
+
+
+def test_unwritable_directory_keeps_replies_in_memory(tmp_path):
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    cache = CatalogCache(str(blocker / 'cache'))
+    cache.store('http://a', 'pulsar_list', {}, [1])
+    assert cache.load('http://a', 'pulsar_list', {})['data'] == [1]
+
+
+def test_fresh_replies_do_not_reach_the_server(server, tmp_path):
+    client = PulsarClient(server.addr, ('a', 'b'), cache=str(tmp_path))
+    assert client.pulsar_list() == server.lists['pulsar_list']
+    assert client.pulsar_list() == server.lists['pulsar_list']
+    assert len(server.seen) == 1
+
+
+def test_stale_replies_are_revalidated(server, tmp_path):
+    client = PulsarClient(server.addr, ('a', 'b'), cache=CatalogCache(str(tmp_path), ttl=0))
+    first = client.pulsar_list()
+    second = client.pulsar_list()
+    assert second == first == server.lists['pulsar_list']
+
+    name, etag, modified = server.seen[1]
+    if server.validator == 'etag':
+        assert etag is not None and modified is None
+    else:
+        assert etag is None and modified == LAST_MODIFIED
+
+    # a change on the server is picked up by the next revalidation
+    server.lists['pulsar_list'] = server.lists['pulsar_list'] + [{'name': 'J1939+2134'}]
+    server.modified = 'Fri, 03 Jan 2025 00:00:00 GMT'
+    assert client.pulsar_list()[-1] == {'name': 'J1939+2134'}
+
+
+def test_create_invalidates_lookups(server, tmp_path):
+    client = PulsarClient(server.addr, ('a', 'b'), cache=str(tmp_path))
+    assert client.pulsar_lookup('J1939+2134') is None
+    client.pulsar_create(name='J1939+2134')
+    assert client.pulsar_lookup('J1939+2134') == {'name': 'J1939+2134'}
+
+
+def test_index_without_cache_is_not_kept(server):
+    client = PulsarClient(server.addr, ('a', 'b'))
+    for i in range(3):
+        assert client.pulsar_lookup('J0437-4715') == {'name': 'J0437-4715'}
+    assert len(server.seen) == 3
+
+
+def test_index_kept_for_index_ttl(server):
+    client = PulsarClient(server.addr, ('a', 'b'), index_ttl=600)
+    for i in range(20):
+        assert client.pulsar_lookup('J0437-4715') == {'name': 'J0437-4715'}
+        assert len(client.detection_lookup(1)) == 3
+    assert sorted(name for name, etag, modified in server.seen) == ['detection_list', 'pulsar_list']
+
+    client.pulsar_create(name='J1939+2134')
+    assert client.pulsar_lookup('J1939+2134') == {'name': 'J1939+2134'}
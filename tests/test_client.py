@@ -0,0 +1,257 @@
+# -*- coding: utf8 -*-
+import os
+import base64
+import hashlib
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from mwa_pulsar_client import client as pulsar_client
+from mwa_pulsar_client.client import PulsarClient, OrderedHash
+
+CONTENT = bytes(range(256)) * 64
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        requested = self.headers.get('Range')
+        server.ranges.append(requested)
+        headers = []
+        if 'drop' in self.path:
+            # the request reached the server, which closes without a reply
+            self.close_connection = True
+            return
+        if 'missing' in self.path:
+            status, body = 404, b'not found'
+        elif server.refuse_ranges:
+            status, body = 416, b''
+        elif requested and server.honour_ranges:
+            first, _, last = requested[len('bytes='):].partition('-')
+            first = int(first)
+            last = int(last) if last else len(CONTENT) - 1
+            status, body = 206, CONTENT[first:last + 1]
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, len(CONTENT))))
+        else:
+            status, body = 200, CONTENT
+        if server.accept_ranges:
+            headers.append(('Accept-Ranges', 'bytes'))
+        if server.digest:
+            headers.append(('Digest', server.digest))
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        server.posts.append(self.rfile.read(int(self.headers['Content-Length'])))
+        status = server.post_status.pop(0) if server.post_status else 200
+        body = b'{"id": 1}' if status == 200 else b'unavailable'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.ranges = []
+    server.refuse_ranges = False
+    server.accept_ranges = False
+    server.honour_ranges = True
+    server.digest = None
+    server.posts = []
+    server.post_status = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.addr = 'http://127.0.0.1:%d' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_failed_stream_is_closed(server):
+    client = PulsarClient(server.addr, ('a', 'b'))
+    with pytest.raises(requests.exceptions.HTTPError) as info:
+        client.get('detection_file_download', {'filename': 'missing.bin'}, stream=True)
+    assert info.value.response.status_code == 404
+    assert info.value.response.raw.closed
+
+
+def test_request_that_reached_the_server_is_not_retried(server):
+    client = PulsarClient(server.addr, ('a', 'b'), retries=3)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get('drop')
+    assert len(server.ranges) == 1
+
+
+def test_upload_is_sent_again_after_a_503(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(pulsar_client.time, 'sleep', lambda seconds: None)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(CONTENT)
+    sent = []
+    client = PulsarClient(server.addr, ('a', 'b'))
+
+    server.post_status = [503, 502]
+    result = client.file_upload('detection_file_upload', lambda n, size: sent.append(n), chunk_size=4096,
+                                filepath=str(path), observationid=1)
+    assert result == {'id': 1}
+    # the whole body each time, the progress starting again
+    assert len(server.posts) == 3 and server.posts[0] == server.posts[2] and CONTENT in server.posts[0]
+    assert sent.count(len(CONTENT)) == 3 and sent[:2] == [4096, 8192]
+
+    server.post_status = [400]
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.file_upload('detection_file_upload', filepath=str(path), observationid=1)
+    assert len(server.posts) == 4
+
+
+def test_download(server, tmp_path):
+    client = PulsarClient(server.addr, ('a', 'b'))
+    path = client.file_download('detection_file_download', 'f.bin', str(tmp_path))
+    assert read(path) == CONTENT
+    assert not os.path.exists(path + '.part')
+
+
+def test_part_file_is_continued(server, tmp_path):
+    server.accept_ranges = True
+    (tmp_path / 'f.bin.part').write_bytes(CONTENT[:5000])
+    client = PulsarClient(server.addr, ('a', 'b'))
+    path = client.file_download('detection_file_download', 'f.bin', str(tmp_path), checksum='md5:' + MD5)
+    assert read(path) == CONTENT
+    assert server.ranges == ['bytes=5000-']
+
+
+def test_checksum_mismatch(server, tmp_path):
+    client = PulsarClient(server.addr, ('a', 'b'))
+    with pytest.raises(Exception, match='does not match its md5 checksum'):
+        client.file_download('detection_file_download', 'f.bin', str(tmp_path), checksum='0' * 32)
+    assert os.listdir(str(tmp_path)) == []
+
+    # the Digest header of the server is checked when no checksum is given
+    server.digest = 'SHA-256=' + base64.b64encode(hashlib.sha256(b'other').digest()).decode()
+    with pytest.raises(Exception, match='does not match its sha256 checksum'):
+        client.file_download('detection_file_download', 'f.bin', str(tmp_path))
+    server.digest = 'SHA-256=' + base64.b64encode(hashlib.sha256(CONTENT).digest()).decode()
+    assert read(client.file_download('detection_file_download', 'f.bin', str(tmp_path))) == CONTENT
+
+
+def test_segmented_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(pulsar_client, 'SEGMENT_SIZE', 1000)
+    server.accept_ranges = True
+    client = PulsarClient(server.addr, ('a', 'b'))
+    path = client.file_download('detection_file_download', 'f.bin', str(tmp_path), parallel=4,
+                                checksum='md5:' + MD5)
+    assert read(path) == CONTENT
+    # the first range comes from the request of the whole file
+    assert server.ranges[0] is None
+    assert sorted(server.ranges[1:]) == sorted('bytes=%d-%d' % (start, min(start + 1000, len(CONTENT)) - 1)
+                                               for start in range(1000, len(CONTENT), 1000))
+
+
+def test_ignored_range_falls_back_to_one_stream(server, tmp_path, monkeypatch):
+    # a proxy that advertises ranges and answers them with the whole file
+    monkeypatch.setattr(pulsar_client, 'SEGMENT_SIZE', 1000)
+    monkeypatch.setattr('mwa_pulsar_client.client.time.sleep', lambda seconds: None)
+    server.accept_ranges = True
+    server.honour_ranges = False
+    client = PulsarClient(server.addr, ('a', 'b'))
+    path = client.file_download('detection_file_download', 'f.bin', str(tmp_path), parallel=4,
+                                checksum='md5:' + MD5)
+    assert read(path) == CONTENT
+    assert any(requested is not None for requested in server.ranges)
+    assert server.ranges[-1] is None
+
+
+def test_ordered_hash_of_ranges_out_of_order():
+    digest = OrderedHash('sha1')
+    for start in (0, 10, 20):
+        digest.start(start)
+    digest.update(20, CONTENT[20:25])
+    digest.update(10, CONTENT[10:20])
+    digest.update(20, CONTENT[25:30])
+    assert digest.position == 0
+    digest.update(0, CONTENT[0:10])
+    assert digest.position == 30
+    assert digest.hexdigest() == hashlib.sha1(CONTENT[:30]).hexdigest()
+
+
+def test_part_file_of_another_file_restarts(server, tmp_path):
+    # the server has fewer bytes than the .part file, so the range is refused
+    server.refuse_ranges = True
+    (tmp_path / 'f.bin.part').write_bytes(b'x' * (len(CONTENT) + 10))
+    client = PulsarClient(server.addr, ('a', 'b'))
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.file_download('detection_file_download', 'f.bin', str(tmp_path), retries=3)
+    assert not os.path.exists(str(tmp_path / 'f.bin.part'))
+    assert len(server.ranges) == 2
+
+
+def test_repeated_416_counts_against_retries(server, tmp_path, monkeypatch):
+    # a server that keeps refusing while something recreates the .part file
+    server.refuse_ranges = True
+    client = PulsarClient(server.addr, ('a', 'b'))
+    fetch = client.fetch
+
+    def refetch(name, filename, part, *args):
+        with open(part, 'wb') as f:
+            f.write(b'x')
+        return fetch(name, filename, part, *args)
+
+    monkeypatch.setattr(client, 'fetch', refetch)
+    monkeypatch.setattr('mwa_pulsar_client.client.time.sleep', lambda seconds: None)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.file_download('detection_file_download', 'f.bin', str(tmp_path), retries=3)
+    assert len(server.ranges) == 4
+
+
+def test_ingest_sends_a_repeated_detection_after_the_first(monkeypatch):
+    client = PulsarClient('http://127.0.0.1:1', ('a', 'b'))
+    calls = []
+
+    def sender(action):
+        def send(**detection):
+            calls.append(('start', action, detection['pulsar'], detection['sn']))
+            time.sleep(0.2 if detection['sn'] == 1 else 0)
+            calls.append(('end', action, detection['pulsar'], detection['sn']))
+            return detection['sn']
+        return send
+
+    monkeypatch.setattr(client, 'detection_create', sender('create'))
+    monkeypatch.setattr(client, 'detection_update', sender('update'))
+
+    def detection(pulsar, sn):
+        return {'observationid': 1, 'pulsar': pulsar, 'subband': 1, 'coherent': True, 'sn': sn}
+
+    existing = [{'observationid': '1', 'pulsar': {'name': 'J2'}, 'subband': 1, 'coherent': 'true'}]
+    report = client.detection_ingest([detection('J1', 1), detection('J2', 2), detection('J1', 3)], workers=4,
+                                     existing=existing)
+
+    assert [(r['action'], r['result'], r['error']) for r in report['results']] == \
+        [('create', 1, None), ('update', 2, None), ('update', 3, None)]
+    assert (report['created'], report['updated'], report['failed']) == (1, 2, 0)
+    # the other detection went ahead, the repeated one waited for the first
+    assert calls.index(('end', 'update', 'J2', 2)) < calls.index(('end', 'create', 'J1', 1))
+    assert calls.index(('end', 'create', 'J1', 1)) < calls.index(('start', 'update', 'J1', 3))
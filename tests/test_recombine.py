@@ -0,0 +1,209 @@
+# -*- coding: utf8 -*-
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+
+from mwa_recombine import driver, ics, reader, reflag
+from mwa_recombine.metadata import (course_channel_swap, source_position, VOLT_FILESIZE, RAW_FILESIZE,
+                                    CHAN_FILESIZE, ICS_FILESIZE, PACKET_SIZE_BYTES, SAMPLES_PER_BLOCK,
+                                    COURSE_CHANS, PFBS, TILES_PER_PFB)
+
+# the order of the course channels in the CHANNELS keyword, some above 128
+CHANNELS = (list(range(57, 69)) + list(range(133, 145)))[5:] + list(range(57, 62))
+
+
+def sparse(path, size, writes=()):
+    """Create a file of size zero bytes with (offset, bytes) written into it."""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset, data in writes:
+            f.seek(offset)
+            f.write(bytes(data))
+    return str(path)
+
+
+def write_metafits(path, flags):
+    from astropy.io import fits
+    primary = fits.PrimaryHDU()
+    primary.header['CHANNELS'] = ','.join(str(c) for c in CHANNELS)
+    table = fits.BinTableHDU.from_columns([fits.Column(name='Flag', format='I', array=np.array(flags))])
+    fits.HDUList([primary, table]).writeto(str(path))
+    return str(path)
+
+
+def scalar_power(pairs, flag_rows):
+    # the recombiner's loop: BYTE_TO_SUM of every byte of an unflagged input
+    keep = []
+    for flags in flag_rows:
+        row = [False] * TILES_PER_PFB
+        for tile in range(TILES_PER_PFB):
+            row[reader.input_position(tile)] = flags[tile] == 0
+        keep += row
+    data = pairs.view(np.uint8).reshape(pairs.shape[:-1] + (-1,))
+    total = np.zeros(pairs.shape[:-1], dtype=np.int64)
+    for position, kept in enumerate(keep):
+        if kept:
+            total += ics.BYTE_TO_SUM[data[..., position]]
+    return total
+
+
+def test_input_position_follows_the_fpfb_order():
+    # byte k of a PFB holds input 0, 16, 32, 48, 1, 17, ...
+    order = [0, 16, 32, 48, 1, 17, 33, 49, 2]
+    assert [reader.input_position(i) for i in order] == list(range(len(order)))
+    assert reader.input_position(TILES_PER_PFB + 16) == TILES_PER_PFB + 1
+    assert sorted(reader.INPUT_POSITIONS) == list(range(reader.INPUTS))
+
+
+@pytest.mark.parametrize('flagged', [3, 40])
+def test_masked_power_matches_the_scalar_sum(flagged):
+    # few flags take the subtract path, many the gather path
+    rng = np.random.default_rng(flagged)
+    flags = np.zeros((2, TILES_PER_PFB), dtype=int)
+    flags.flat[rng.choice(flags.size, size=flagged, replace=False)] = 1
+    pairs = rng.integers(0, 65536, (7, 5, TILES_PER_PFB), dtype=np.uint16)
+
+    groups = ics.pair_groups(flags.tolist())
+    assert any(subtract for table, index, subtract in groups) == (flagged * 2 < TILES_PER_PFB)
+    assert np.array_equal(ics.masked_power(pairs, groups), scalar_power(pairs, flags.tolist()))
+
+
+def test_normalise():
+    sums = np.array([[0, 64, 10000], [50, 50, 50]], dtype=np.uint16)
+    contrib = np.array([[64], [0]])
+    assert ics.normalise(sums, contrib).tolist() == [[0, 5, 255], [0, 0, 0]]
+
+
+def test_contributing_inputs():
+    flags = [[0] * TILES_PER_PFB for p in range(PFBS)]
+    flags[1][:4] = [1] * 4
+    present = [[True] * 8 for p in range(PFBS)]
+    present[2][7] = False
+    contrib = ics.contributing_inputs(flags, present)
+    assert contrib.tolist() == [252] * 7 + [188]
+
+
+def test_identify_lane(tmp_path):
+    header = [0, 0, (5 << 4) | 0x0f, 0, 0x11, (2 << 6) | 0x3f]
+    assert ics.identify_lane(sparse(tmp_path / 'a.dat', 6, [(0, header)])) == (2, 5)
+    # a set top bit in byte 4 is sign extended into receiver 3
+    header[4] = 0x91
+    assert ics.identify_lane(sparse(tmp_path / 'b.dat', 6, [(0, header)])) == (3, 5)
+    with pytest.raises(Exception):
+        ics.identify_lane(sparse(tmp_path / 'c.dat', 3))
+
+
+def test_ics_from_raw_layout(tmp_path):
+    pfb, lane = 1, 3
+    flags = [[0] * TILES_PER_PFB for p in range(PFBS)]
+    flags[pfb][7] = 1
+    freqs, swap_index = course_channel_swap(CHANNELS)
+    course = 20
+    raw_course = source_position(course, swap_index)
+    assert raw_course != course
+
+    def offset(block, group, sample, fine, tile):
+        packet = (raw_course * 4 + group) * SAMPLES_PER_BLOCK + sample
+        return (block * VOLT_FILESIZE + packet * PACKET_SIZE_BYTES + ics.HEADER_BYTES + fine * TILES_PER_PFB +
+                reader.input_position(tile))
+
+    writes = [(0, [0, 0, (lane << 4) | 0x0f, 0, 0x11, (pfb << 6) | 0x3f]),
+              # 0x77 is 7+7j, a power of 98
+              (offset(2, 1, 10, 2, 5), [0x77]),
+              # the same on a flagged input adds nothing
+              (offset(3, 0, 0, 0, 7), [0x77])]
+    path = sparse(tmp_path / 'raw.dat', RAW_FILESIZE, writes)
+
+    result = ics.ics_from_raw([path], CHANNELS, flags)
+    assert result.shape == (reader.SAMPLES_PER_SEC, COURSE_CHANS, reader.FINE_CHANS)
+    time = 2 * SAMPLES_PER_BLOCK + 10
+    fine = lane * 16 + 1 * 4 + 2
+    # five times the power over the 63 unflagged inputs of the only PFB
+    assert result[time, course, fine] == 98 * 5 // 63
+    assert np.count_nonzero(result) == 1
+
+
+def test_channel_file_views(tmp_path):
+    time, fine = 123, 77
+    sample = np.arange(reader.INPUTS, dtype=np.uint8)
+    start = (time * reader.FINE_CHANS + fine) * reader.INPUTS
+    channel = reader.ChannelFile(sparse(tmp_path / 'ch.dat', CHAN_FILESIZE, [(start, sample)]))
+
+    for tile in range(reader.TILES):
+        for pol in (0, 1):
+            value = reader.input_position(2 * tile + pol)
+            assert channel.tile(tile, pol)[time, fine] == value
+            assert channel.voltages[time, fine, tile // 32, tile % 32 // 8, tile % 8, pol] == value
+    assert channel.tile(0, 0)[time, fine + 1] == 0
+
+    gathered = channel.gather(tiles=[1, 40], pols=(1,), start=time, stop=time + 1)
+    assert gathered.shape == (1, reader.FINE_CHANS, 2, 1)
+    assert gathered[0, fine, :, 0].tolist() == [reader.input_position(3), reader.input_position(81)]
+
+
+def test_to_complex():
+    assert reader.to_complex(np.array([0x7f, 0x88, 0x10], dtype=np.uint8)).tolist() == [7 - 1j, -8 - 8j, 1 + 0j]
+
+
+def test_ics_series_across_seconds(tmp_path):
+    last = (reader.SAMPLES_PER_SEC - 1) * COURSE_CHANS * reader.FINE_CHANS
+    paths = [sparse(tmp_path / '1_10_ics.dat', ICS_FILESIZE, [(last, [1])]),
+             sparse(tmp_path / '1_11_ics.dat', ICS_FILESIZE, [(5, [2])])]
+    series = reader.open_ics(str(tmp_path), 1, [10, 11])
+    assert series.paths == paths
+    assert len(series) == 2 * reader.SAMPLES_PER_SEC
+
+    data = series.data(reader.SAMPLES_PER_SEC - 1, reader.SAMPLES_PER_SEC + 1)
+    assert data.shape == (2, COURSE_CHANS, reader.FINE_CHANS)
+    assert data[0, 0, 0] == 1 and data[1, 0, 5] == 2
+    assert np.count_nonzero(data) == 2
+
+    # a read inside one second is a view of its file
+    spectrum = series.spectrum(reader.SAMPLES_PER_SEC, reader.SAMPLES_PER_SEC + 1)
+    assert isinstance(spectrum, np.memmap) and spectrum[0, 5] == 2
+
+
+def test_recombine_range_needs_a_product(tmp_path):
+    with pytest.raises(Exception, match='nothing to recombine'):
+        driver.recombine_range(1, 10, 11, str(tmp_path / 'missing.metafits'), str(tmp_path), str(tmp_path),
+                               skip_chan=True, skip_ics=True)
+
+
+def test_parse_inputs_and_override_flags():
+    assert reflag.parse_inputs('0, 17,64-67,') == {0, 17, 64, 65, 66, 67}
+    with pytest.raises(Exception, match='between 0 and 255'):
+        reflag.parse_inputs('250-256')
+
+    flags = [[0] * TILES_PER_PFB for _ in range(PFBS)]
+    flags[0][3] = 1
+    flags = reflag.override_flags(flags, flag={64, 255}, unflag={3})
+    assert [(p, t) for p in range(PFBS) for t in range(TILES_PER_PFB) if flags[p][t]] == [(1, 0), (3, 63)]
+    with pytest.raises(Exception, match='All the tiles'):
+        reflag.override_flags(flags, flag=range(256))
+
+
+def test_reflag_range_skips_incomplete_seconds(tmp_path):
+    metafits = write_metafits(tmp_path / 'obs.metafits', [0] * (PFBS * TILES_PER_PFB))
+    inputs = tmp_path / 'in'
+    inputs.mkdir()
+    # the second has all its channel files, one of them short
+    freqs, _ = course_channel_swap(CHANNELS)
+    for f in freqs:
+        sparse(inputs / ('1_10_ch%d.dat' % f), CHAN_FILESIZE - (f == freqs[3]))
+    # and a file of another observation
+    sparse(inputs / ('2_11_ch%d.dat' % freqs[0]), CHAN_FILESIZE)
+
+    complete, incomplete = reflag.find_channel_files(str(inputs), 1, 10, 12, freqs)
+    assert complete == {} and incomplete == [10]
+    assert reflag.reflag_range(1, 10, 12, metafits, str(inputs), str(tmp_path / 'out')) == []
+    assert os.listdir(str(tmp_path / 'out')) == []
+
+
+def test_failed_reflag_leaves_no_file(tmp_path):
+    second, elapsed, error = reflag.reflag_second(1, 10, [], [[0] * TILES_PER_PFB] * PFBS, str(tmp_path))
+    assert second == 10 and 'need 24 course channel files' in error
+    assert os.listdir(str(tmp_path)) == []
+    assert driver.summarise([(9, 1.0, None), (10, elapsed, error)], 0, 'rebuilt') == [10]
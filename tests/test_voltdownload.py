@@ -0,0 +1,448 @@
+# -*- coding: utf8 -*-
+import os
+import json
+import time
+import threading
+
+import pytest
+
+import voltdownload
+from conftest import OBS, free_port
+
+
+def out_dir(tmp_path):
+    return str(tmp_path / 'out')
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_download(ngas, download, tmp_path, engine):
+    server = ngas()
+    result = download(server, '--type=11', '--engine=%s' % engine)
+    assert result.returncode == 0, result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+    assert len(server.requests()) == len(server.files)
+
+
+def test_resume(ngas, download, tmp_path):
+    server = ngas()
+    name = '%d_%d_vcs03_1.dat' % (OBS, OBS + 1)
+    payload = server.files[name][2]
+    half = payload.size // 2
+    os.makedirs(out_dir(tmp_path))
+    with open(os.path.join(out_dir(tmp_path), name + voltdownload.PART_SUFFIX), 'wb') as f:
+        f.write(payload.read(0, half))
+
+    result = download(server, '--type=11', '--resume')
+    assert result.returncode == 0, result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+    requests = [r for r in server.requests() if r['file'] == name]
+    assert [(r['status'], r['offset']) for r in requests] == [(206, half)]
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_retry_errors_and_short_bodies(ngas, download, tmp_path, engine):
+    server = ngas(error_rate=0.2, truncate_rate=0.2, seed=1)
+    result = download(server, '--type=11', '--engine=%s' % engine, '--retry-delay=0.05', '--retries=20')
+    assert result.returncode == 0, result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+    faults = [r['fault'] for r in server.requests()]
+    assert 'error' in faults and 'truncate' in faults
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_chunked_replies(ngas, download, tmp_path, engine):
+    # a buffer that is not a multiple of the chunks, and bodies cut off inside a chunk
+    server = ngas(chunked=True, truncate_rate=0.3, seed=3)
+    result = download(server, '--type=11', '--engine=%s' % engine, '--bufsize=100000', '--retry-delay=0.05',
+                      '--retries=20')
+    assert result.returncode == 0, result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+    assert 'truncate' in [r['fault'] for r in server.requests()]
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_stalled_transfer_times_out(ngas, download, tmp_path, engine):
+    server = ngas(seconds=2, stall_rate=0.3, stall=60, seed=2)
+    start = time.time()
+    result = download(server, '--type=11', '--engine=%s' % engine, '--timeout=1', '--retry-delay=0.05',
+                      '--retries=20')
+    assert result.returncode == 0, result.stdout
+    assert time.time() - start < 30
+    assert server.check(out_dir(tmp_path)) == []
+    # a stalled request is only logged by the server once it gives up on it
+    assert 'timed out, retry' in result.stdout
+
+
+def test_metrics(ngas, download, tmp_path):
+    server = ngas(seconds=2, error_rate=0.3, seed=4)
+    json_path, prom_path = str(tmp_path / 'metrics.json'), str(tmp_path / 'voltdownload.prom')
+    result = download(server, '--type=11', '--retry-delay=0.05', '--retries=20', '--metrics-json=%s' % json_path,
+                      '--metrics-prom=%s' % prom_path)
+    assert result.returncode == 0, result.stdout
+    size = sum(payload.size for filetype, second, payload in server.files.values())
+
+    with open(json_path) as f:
+        records = [json.loads(line) for line in f]
+    files = [r for r in records if r['type'] == 'file']
+    done = [r for r in files if r['status'] == 'complete']
+    assert sorted(r['file'] for r in done) == sorted(server.files)
+    assert all(r['host'] == server.host and r['ttfb'] <= r['duration'] for r in done)
+    assert sum(r['bytes'] for r in done) == size
+    retried = [r for r in files if r['status'] == 'retry']
+    assert retried and all('injected error' in r['error'] for r in retried)
+    progress = records[-1]
+    assert progress['type'] == 'progress'
+    assert (progress['files_total'], progress['files_complete'], progress['bytes']) == (len(done), len(done), size)
+
+    with open(prom_path) as f:
+        samples = dict(line.rsplit(' ', 1) for line in f.read().splitlines() if not line.startswith('#'))
+    obs = 'obs="%d"' % OBS
+    assert float(samples['mwa_voltdownload_bytes_total{%s}' % obs]) == size
+    assert float(samples['mwa_voltdownload_files_total{%s,status="complete"}' % obs]) == len(done)
+    assert float(samples['mwa_voltdownload_files_total{%s,status="retry"}' % obs]) == len(retried)
+    assert float(samples['mwa_voltdownload_host_errors_total{%s,host="%s"}' % (obs, server.host)]) == len(retried)
+    assert float(samples['mwa_voltdownload_transfer_seconds_count{%s,host="%s"}' % (obs, server.host)]) == \
+        len(files)
+
+
+def test_host_failover(ngas, download, tmp_path):
+    server = ngas(seconds=2)
+    hosts = '127.0.0.1:%d,%s' % (free_port(), server.host)
+    result = download(server, '--type=11', '--retry-delay=0.05', '--retries=10', hosts=hosts)
+    assert result.returncode == 0, result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+
+
+def test_on_second_skips_seconds_on_disk(ngas, download, tmp_path):
+    server = ngas(seconds=3)
+    calls = str(tmp_path / 'calls')
+    script = str(tmp_path / 'on_second.sh')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\necho "$2" >> %s\n' % calls)
+    os.chmod(script, 0o755)
+
+    def seconds():
+        with open(calls) as f:
+            return sorted(int(line) for line in f)
+
+    assert download(server, '--type=11', '--on-second=%s' % script).returncode == 0
+    assert seconds() == [OBS, OBS + 1, OBS + 2]
+
+    os.remove(os.path.join(out_dir(tmp_path), '%d_%d_vcs05_1.dat' % (OBS, OBS + 1)))
+    assert download(server, '--type=11', '--on-second=%s' % script).returncode == 0
+    assert seconds() == [OBS, OBS + 1, OBS + 1, OBS + 2]
+
+
+def test_meta_cache_is_kept_per_service(ngas, download, tmp_path):
+    first = ngas(seconds=1)
+    second = ngas(seconds=2)
+    cache = '--meta-cache=%s' % (tmp_path / 'cache')
+    for server in (first, second):
+        result = download(server, '--type=11', cache)
+        assert result.returncode == 0, result.stdout
+        assert 'Using cached metadata' not in result.stdout
+        assert 'Found %d files' % len(server.files) in result.stdout
+
+    result = download(first, '--type=11', cache)
+    assert 'Using cached metadata' in result.stdout
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+
+
+def test_meta_cache_path_depends_on_service(monkeypatch, tmp_path):
+    files = {'a.dat': {'size': 1}}
+    monkeypatch.setattr(voltdownload, 'META_URL', 'http://one/')
+    voltdownload.meta_cache_store(str(tmp_path), OBS, None, None, files)
+    assert voltdownload.meta_cache_load(str(tmp_path), OBS, None, None, 60) == files
+
+    monkeypatch.setattr(voltdownload, 'META_URL', 'http://two/')
+    assert voltdownload.meta_cache_load(str(tmp_path), OBS, None, None, 60) is None
+
+
+def catalogue(seconds, lanes=(1, 2), **state):
+    """A data_files result with one raw file per second and lane."""
+    entry = dict({'filetype': 11, 'size': 10, 'remote_archived': True, 'deleted': False}, **state)
+    return dict(('%d_%d_vcs%02d_1.dat' % (OBS, OBS + s, lane), dict(entry)) for s in seconds for lane in lanes)
+
+
+def test_catalog_select():
+    files = catalogue(range(4))
+    files.update(catalogue([4], remote_archived=False))
+    files.update(catalogue([5], deleted=True))
+    files['%d_%d_ics.dat' % (OBS, OBS + 1)] = {'filetype': 15, 'size': 5}
+    files['%d_metafits.fits' % OBS] = {'filetype': 11, 'size': 1}
+    catalog = voltdownload.ObservationCatalog(files)
+
+    def names(*args, **kwargs):
+        return sorted(catalog.names[i] for i in catalog.select(*args, **kwargs))
+
+    # a name that does not parse sorts first, outside every time range
+    assert catalog.unparsed == 1 and catalog.gps[0] == -1
+    assert names(OBS + 1, OBS + 3, filetypes=(11,)) == sorted(catalogue([1, 2]))
+    assert names(OBS + 1, OBS + 2) == sorted(list(catalogue([1])) + ['%d_%d_ics.dat' % (OBS, OBS + 1)])
+    assert names(OBS + 3, lanes=(2,)) == sorted(catalogue([3, 4, 5], lanes=(2,)))
+    assert names(OBS + 3, filetypes=(11,), available=True) == sorted(catalogue([3]))
+    assert len(names()) == len(files)
+    assert catalog.files(OBS, OBS + 1) == dict((name, 10) for name in catalogue([0]))
+
+
+def test_meta_cache_filters_a_wider_window(monkeypatch, tmp_path):
+    monkeypatch.setattr(voltdownload, 'META_URL', 'http://one/')
+    cache = str(tmp_path)
+    voltdownload.meta_cache_store(cache, OBS, OBS, OBS + 6, catalogue(range(6)))
+    assert voltdownload.meta_cache_load(cache, OBS, OBS + 2, OBS + 4, 60) == catalogue(range(2, 4))
+    # not from a window that does not cover the request, nor a stale one
+    assert voltdownload.meta_cache_load(cache, OBS, OBS + 4, OBS + 8, 60) is None
+    assert voltdownload.meta_cache_load(cache, OBS, OBS + 2, OBS + 4, -1) is None
+
+    # the whole observation covers any window
+    voltdownload.meta_cache_store(cache, OBS, None, None, catalogue(range(10)))
+    assert voltdownload.meta_cache_load(cache, OBS, OBS + 4, OBS + 8, 60) == catalogue(range(4, 8))
+
+
+def test_complete_files_are_not_fetched_again(ngas, download, tmp_path):
+    server = ngas()
+    assert download(server, '--type=11').returncode == 0
+    served = len(server.requests())
+
+    result = download(server, '--type=11')
+    assert result.returncode == 0, result.stdout
+    assert len(server.requests()) == served
+
+
+def test_sweep_keeps_the_partial_files_resumed(ngas, download, tmp_path):
+    server = ngas(seconds=2)
+    name = '%d_%d_vcs03_1.dat' % (OBS, OBS + 1)
+    payload = server.files[name][2]
+    half = payload.size // 2
+    out = out_dir(tmp_path)
+    os.makedirs(out)
+    with open(os.path.join(out, name + voltdownload.PART_SUFFIX), 'wb') as f:
+        f.write(payload.read(0, half))
+    with open(os.path.join(out, 'other.dat' + voltdownload.PART_SUFFIX), 'wb') as f:
+        f.write(b'x')
+    old = time.time() - 2 * voltdownload.PARTIAL_AGE
+    for partial in os.listdir(out):
+        os.utime(os.path.join(out, partial), (old, old))
+
+    result = download(server, '--type=11', '--resume', '--sweep-partials')
+    assert result.returncode == 0, result.stdout
+    assert 'Removed 1 stale partial files' in result.stdout
+    assert server.check(out) == []
+    assert not os.path.exists(os.path.join(out, 'other.dat' + voltdownload.PART_SUFFIX))
+    requests = [r for r in server.requests() if r['file'] == name]
+    assert [(r['status'], r['offset']) for r in requests] == [(206, half)]
+
+
+def test_untar(ngas, download, tmp_path):
+    server = ngas(seconds=2, types=(15, 16))
+    result = download(server, '--type=16', '--untar')
+    assert result.returncode == 0, result.stdout
+
+    out = out_dir(tmp_path)
+    assert server.check(out, types=(15,)) == []
+    for second in (OBS, OBS + 1):
+        archive = '%d_%d_combined.tar' % (OBS, second)
+        assert not os.path.exists(os.path.join(out, archive))
+        with open(os.path.join(out, archive + voltdownload.MEMBERS_SUFFIX)) as f:
+            members = json.load(f)['members']
+        # the ics file is a download of its own and is left out of the archive
+        assert len(members) == 24
+        assert '%d_%d_ics.dat' % (OBS, second) not in members
+        for member, size in members.items():
+            assert os.path.getsize(os.path.join(out, member)) == size
+    assert not [name for name in os.listdir(out) if name.endswith(voltdownload.PART_SUFFIX)]
+
+    served = len(server.requests())
+    assert download(server, '--type=16', '--untar').returncode == 0
+    assert len(server.requests()) == served
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_windowed_prestage(ngas, download, tmp_path, engine):
+    server = ngas(seconds=6)
+    result = download(server, '--type=11', '--engine=%s' % engine, '--prestage-bytes=300', '--parallel=3',
+                      file_limit=64)
+    assert result.returncode == 0, result.stdout
+    assert 'downloading in 3 windows' in result.stdout
+    assert server.check(out_dir(tmp_path)) == []
+
+    requests = server.requests()
+    assert len(requests) == len(server.files)
+    advised = set()
+    for r in requests:
+        if r['prestage']:
+            names = json.loads(r['prestage'])
+            assert names[0] == r['file']
+            # a batch never spans windows of two seconds
+            seconds = set(server.files[name][1] for name in names)
+            assert len(set((s - OBS) // 2 for s in seconds)) == 1
+            advised.update(names)
+    assert advised == set(server.files)
+
+
+def items(names):
+    return [('http://127.0.0.1:1/RETRIEVE?file_id=%s' % name, name, 100, '/tmp/', 65536, False)
+            for name in names]
+
+
+def test_retries_stay_in_their_window():
+    retries = voltdownload.RetryScheduler(3, 100, 0, 0)
+    current = voltdownload.StagedQueue(items(['a', 'b']), 1000)
+    following = voltdownload.StagedQueue(items(['c']), 1000)
+    retries.failed(items(['c'])[0], voltdownload.TransferError('short file', 'transient'))
+
+    assert retries.pending(current) == 0
+    assert retries.pop_due(current) == (None, None)
+    assert retries.pending(following) == 1
+    assert retries.pop_due(following)[0][1] == 'c'
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    monkeypatch.setattr(voltdownload, 'CONTROLLER', voltdownload.ConcurrencyController(2, 2, None, 2))
+    monkeypatch.setattr(voltdownload, 'RETRIES', None)
+
+
+def test_batch_staged_only_when_lead_completes(monkeypatch, slots):
+    names = ['a%02d' % i for i in range(4)]
+    queue = voltdownload.StagedQueue(items(names), 1000)
+    leads = []
+
+    def worker(connections, headers, url, filename, size, out, bufsize, prestage, resume=False):
+        leads.append((filename, prestage))
+        return True
+
+    monkeypatch.setattr(voltdownload, 'download_worker', worker)
+    queue.prestage({}, 1)
+    queue.join()
+
+    assert leads == [('a00', json.dumps(names))]
+    assert queue.state == [queue.STAGED]
+    assert queue.get_nowait()[5] is None
+
+
+def test_failed_lead_hands_on_the_advisory(monkeypatch, slots):
+    names = ['a%02d' % i for i in range(4)]
+    queue = voltdownload.StagedQueue(items(names), 1000)
+    leads = []
+
+    def worker(connections, headers, url, filename, size, out, bufsize, prestage, resume=False):
+        leads.append((filename, prestage))
+        return False
+
+    monkeypatch.setattr(voltdownload, 'download_worker', worker)
+    queue.prestage({}, 1)
+    queue.join()
+
+    # every failure passes the list to the next file, which becomes the lead
+    assert leads == [(name, json.dumps(names)) for name in names]
+    assert queue.empty()
+
+
+def test_prestage_runs_on_the_async_engine(monkeypatch, slots):
+    names = ['a%02d' % i for i in range(4)]
+    queue = voltdownload.StagedQueue(items(names), 30)
+    leads = []
+
+    async def worker(connections, headers, url, filename, size, out, bufsize, prestage, resume=False):
+        leads.append(filename)
+        return True
+
+    monkeypatch.setattr(voltdownload, 'download_worker_async', worker)
+    queue.prestage({}, 2, 'async')
+    queue.join()
+
+    assert len(queue.threads) == 1
+    assert leads == [batch[0][1] for batch in voltdownload.StagedQueue(items(names), 30).batches]
+    assert queue.state == [queue.STAGED] * len(queue.batches)
+
+
+def test_next_window_prestage_waits_for_this_one(monkeypatch, slots):
+    current = voltdownload.StagedQueue(items(['a']), 1000)
+    following = voltdownload.StagedQueue(items(['b']), 1000)
+    release = threading.Event()
+    leads = []
+
+    def worker(connections, headers, url, filename, size, out, bufsize, prestage, resume=False):
+        leads.append(filename)
+        return release.wait(5)
+
+    monkeypatch.setattr(voltdownload, 'download_worker', worker)
+    current.prestage({}, 1)
+    following.prestage({}, 1, after=current)
+    time.sleep(0.3)
+    # a slot is free, but the lead of the next window waits its turn
+    assert leads == ['a']
+    release.set()
+    following.join()
+    assert leads == ['a', 'b']
+
+
+def test_lead_taken_by_a_worker_stages_its_batch(monkeypatch, slots):
+    names = ['a%02d' % i for i in range(4)]
+    queue = voltdownload.StagedQueue(items(names), 1000)
+    leads = []
+
+    def worker(connections, headers, url, filename, size, out, bufsize, prestage, resume=False):
+        leads.append((filename, prestage))
+        if filename == 'a00':
+            return False
+        # the batch is staged as soon as a lead got through
+        assert queue.state == [queue.ADVISED if prestage else queue.STAGED]
+        return True
+
+    monkeypatch.setattr(voltdownload, 'download_worker', worker)
+    voltdownload.download_queue_thread(queue, {})
+
+    assert leads == [('a00', json.dumps(names)), ('a01', json.dumps(names)), ('a02', None), ('a03', None)]
+    assert queue.state == [queue.STAGED] and queue.leads == {}
+
+
+def test_preallocated_part_file_keeps_its_size(monkeypatch, tmp_path):
+    size = 1 << 20
+    with open(str(tmp_path / 'probe'), 'wb') as f:
+        if not voltdownload.preallocate(f.fileno(), 0, size):
+            pytest.skip('no fallocate on this filesystem')
+    monkeypatch.setattr(voltdownload, 'PREALLOCATE', True)
+    monkeypatch.setattr(voltdownload, 'RETRIES', None)
+
+    download = voltdownload.FileDownload('a.dat', size, str(tmp_path) + '/')
+    download.begin(200, {'Content-Length': str(size)})
+    download.write(b'x' * 1000)
+    download.close()
+    # the blocks are reserved but an interrupted download still looks short
+    stat = os.stat(download.part)
+    assert stat.st_size == 1000 and stat.st_blocks * 512 >= size
+    assert voltdownload.partial_size('a.dat', size, str(tmp_path) + '/') == 1000
+
+
+def test_controller_ignores_an_odd_failure():
+    controller = voltdownload.ConcurrencyController(1, 8, 1, start=4)
+    limit, reason = controller.step(1e6, 1, 10)
+    assert limit == 5
+    controller.limit = limit
+    limit, reason = controller.step(2e6, 5, 10)
+    assert limit == 2 and '5 of 10' in reason
+
+
+def test_only_host_failures_take_a_host_out():
+    assert voltdownload.host_fault(ConnectionResetError())
+    assert voltdownload.host_fault(voltdownload.http_error(502, b'bad gateway'))
+    assert voltdownload.host_fault(voltdownload.TransferError('size mismatch 2 1', 'transient'))
+    assert not voltdownload.host_fault(voltdownload.http_error(404, b'not found'))
+    assert not voltdownload.host_fault(OSError('No space left on device'))
+
+    pool = voltdownload.HostPool(['a:1'])
+    host = pool.byname['a:1']
+
+    def fail(fault):
+        download = voltdownload.FileDownload('f.dat', 1, '/tmp/')
+        download.host = pool.pick()
+        pool.finished(download, 'error', fault)
+
+    for i in range(2 * pool.FAILURES):
+        fail(False)
+    assert host.down_until == 0 and host.error_rate == 0
+    for i in range(pool.FAILURES):
+        fail(True)
+    assert host.down_until > time.time()